@@ -0,0 +1,53 @@
+"""
+Ansible callback plugin reporting how long each task took,
+for hooks/profiler.py
+
+It does nothing unless CHARM_PROFILE_ANSIBLE_TRACE is set,
+in which case the task timings are written there as JSON.
+"""
+
+# System
+import json
+import os
+import time
+
+
+class CallbackModule(object):
+
+    def __init__(self):
+        self.trace_path = os.environ.get('CHARM_PROFILE_ANSIBLE_TRACE')
+        self.tasks = []
+
+    def start_task(self, name):
+        self.end_task()
+        self.tasks.append(
+            {'name': name, 'start': time.time(), 'duration': None}
+        )
+
+    def end_task(self):
+        if self.tasks and self.tasks[-1]['duration'] is None:
+            task = self.tasks[-1]
+            task['duration'] = time.time() - task['start']
+
+    def playbook_on_setup(self):
+        self.start_task('GATHERING FACTS')
+
+    def playbook_on_task_start(self, name, is_conditional):
+        self.start_task(name)
+
+    def playbook_on_handler_task_start(self, name):
+        self.start_task('handler: ' + name)
+
+    def playbook_on_stats(self, stats):
+        self.end_task()
+
+        if not self.trace_path:
+            return
+
+        trace_dir = os.path.dirname(self.trace_path)
+
+        if not os.path.isdir(trace_dir):
+            os.makedirs(trace_dir)
+
+        with open(self.trace_path, 'w') as trace_file:
+            json.dump(self.tasks, trace_file)
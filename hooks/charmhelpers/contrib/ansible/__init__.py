@@ -66,6 +66,8 @@ Read more online about playbooks[1] and standard ansible modules[2].
 [1] http://www.ansibleworks.com/docs/playbooks.html
 [2] http://www.ansibleworks.com/docs/modules.html
 """
+import hashlib
+import json
 import os
 import subprocess
 import warnings
@@ -82,6 +84,14 @@ ansible_hosts_path = '/etc/ansible/hosts'
 # file in its inventory when run locally.
 ansible_vars_path = '/etc/ansible/host_vars/localhost'
 available_tags = set([])
+# The tags found in a playbook, by playbook_digest, are cached in this
+# file (next to the playbook) so ansible needn't parse it every hook.
+tag_index_file_name = '.playbook-tags.json'
+# The fingerprint of the inputs to the last successful run of each tag
+# (see AnsibleHooks.fingerprint) is kept in this file, next to the playbook.
+playbook_runs_file_name = '.playbook-runs.json'
+# Set this environment variable to run the playbook even if nothing changed.
+force_playbook_env_var = 'FORCE_PLAYBOOK'
 
 
 def install_ansible_support(from_ppa=True, ppa_location='ppa:rquillo/ansible'):
@@ -104,12 +114,18 @@ def install_ansible_support(from_ppa=True, ppa_location='ppa:rquillo/ansible'):
         hosts_file.write('localhost ansible_connection=local')
 
 
-def apply_playbook(playbook, tags=None):
-    tags = tags or []
-    tags = ",".join(tags)
+def write_host_vars():
+    """Write the juju config and relation data as ansible host vars."""
     charmhelpers.contrib.templating.contexts.juju_state_to_yaml(
         ansible_vars_path, namespace_separator='__',
         allow_hyphens_in_keys=False)
+
+
+def apply_playbook(playbook, tags=None, write_vars=True):
+    tags = tags or []
+    tags = ",".join(tags)
+    if write_vars:
+        write_host_vars()
     call = [
         'ansible-playbook',
         '-c',
@@ -118,6 +134,8 @@ def apply_playbook(playbook, tags=None):
     ]
     if tags:
         call.extend(['--tags', '{}'.format(tags)])
+    # Keep buffered log messages ahead of the playbook's output
+    charmhelpers.core.hookenv.flush_log()
     subprocess.check_call(call)
 
 
@@ -148,6 +166,48 @@ def get_tags_for_playbook(playbook_path):
     return playbook_tags
 
 
+def playbook_digest(playbook_path):
+    """Return a digest of the playbook and everything in its roles dir."""
+    playbook_dir = os.path.dirname(os.path.abspath(playbook_path))
+    paths = [os.path.abspath(playbook_path)]
+    for root, dirs, files in os.walk(os.path.join(playbook_dir, 'roles')):
+        dirs.sort()
+        paths.extend(os.path.join(root, name) for name in sorted(files))
+    digest = hashlib.sha1()
+    for path in paths:
+        digest.update(os.path.relpath(path, playbook_dir))
+        with open(path, 'rb') as playbook_file:
+            digest.update(hashlib.sha1(playbook_file.read()).digest())
+    return digest.hexdigest()
+
+
+def load_tag_index(playbook_path, index_path=None):
+    """Return all tags within a playbook, using the on-disk tag index.
+
+    The playbook is only parsed (see get_tags_for_playbook) when
+    playbook_digest has changed since the index was written.
+    """
+    if index_path is None:
+        index_path = os.path.join(
+            os.path.dirname(os.path.abspath(playbook_path)),
+            tag_index_file_name)
+    digest = playbook_digest(playbook_path)
+    try:
+        with open(index_path) as index_file:
+            index = json.load(index_file)
+        if index['digest'] == digest:
+            return set(index['tags'])
+    except (IOError, ValueError, KeyError):
+        pass
+    tags = set(get_tags_for_playbook(playbook_path))
+    try:
+        with open(index_path, 'w') as index_file:
+            json.dump({'digest': digest, 'tags': sorted(tags)}, index_file)
+    except IOError:
+        pass
+    return tags
+
+
 class AnsibleHooks(charmhelpers.core.hookenv.Hooks):
     """Run a playbook with the hook-name as the tag.
 
@@ -182,8 +242,18 @@ class AnsibleHooks(charmhelpers.core.hookenv.Hooks):
             hooks.execute(sys.argv)
     """
 
-    def __init__(self, playbook_path, default_hooks=None):
-        """Register any hooks handled by ansible.
+    def __init__(self, playbook_path, default_hooks=None, always_run=None,
+                 fingerprint_paths=None):
+        """Prepare to register any hooks handled by ansible.
+
+        The playbook's tags are only looked up (see load_tag_index)
+        when a hook is executed, so creating this is cheap.
+
+        The playbook is skipped if the inputs for the hook's tag are the
+        same as at its last successful run (see fingerprint), unless the
+        tag is in always_run or FORCE_PLAYBOOK is set in the environment.
+        fingerprint_paths is an optional function returning paths whose
+        existence the playbook depends on (e.g. downloaded archives).
 
         default_hooks is now deprecated, as we use ansible to
         determine the supported hooks from the playbook.
@@ -191,28 +261,92 @@ class AnsibleHooks(charmhelpers.core.hookenv.Hooks):
         super(AnsibleHooks, self).__init__()
 
         self.playbook_path = playbook_path
-
-        # The hooks decorator is created at module load time, which on the
-        # first run, will be before ansible is itself installed.
-        try:
-            available_tags.update(get_tags_for_playbook(playbook_path))
-        except ImportError:
-            available_tags.add('install')
+        self.tags_loaded = False
+        self.always_run = set(always_run or [])
+        self.fingerprint_paths = fingerprint_paths
+        self.playbook_runs_path = os.path.join(
+            os.path.dirname(os.path.abspath(playbook_path)),
+            playbook_runs_file_name)
 
         if default_hooks is not None:
             warnings.warn(
                 "The use of default_hooks is deprecated. Ansible is now "
                 "used to query your playbook for available tags.",
                 DeprecationWarning)
+
+    def load_tags(self):
+        """Register a hook for each tag in the playbook (once)."""
+        if self.tags_loaded:
+            return
+        self.tags_loaded = True
+
+        # On the first run, this will be before ansible is itself installed.
+        try:
+            available_tags.update(load_tag_index(self.playbook_path))
+        except ImportError:
+            available_tags.add('install')
+
         noop = lambda *args, **kwargs: None
         for hook in available_tags:
-            self.register(hook, noop)
+            # Don't replace hooks registered with the decorator
+            if hook not in self._hooks:
+                self.register(hook, noop)
 
     def execute(self, args):
         """Execute the hook followed by the playbook using the hook as tag."""
+        self.load_tags()
         super(AnsibleHooks, self).execute(args)
         hook_name = os.path.basename(args[0])
 
         if hook_name in available_tags:
+            write_host_vars()
+
+            if not self.playbook_run_needed(hook_name):
+                charmhelpers.core.hookenv.log(
+                    "Nothing changed since the last '{}' playbook run, "
+                    "skipping it (set {} to force it).".format(
+                        hook_name, force_playbook_env_var))
+                return
+
             charmhelpers.contrib.ansible.apply_playbook(
-                self.playbook_path, tags=[hook_name])
+                self.playbook_path, tags=[hook_name], write_vars=False)
+
+            # After the run, as the playbook creates the fingerprint paths
+            if hook_name not in self.always_run:
+                self.record_playbook_run(
+                    hook_name, self.fingerprint(hook_name))
+
+    def fingerprint(self, tag):
+        """A digest of everything a playbook run for tag depends on.
+
+        That's the tag, the host vars (all config and relation data),
+        the playbook and roles, and whether each fingerprint path exists
+        and what it resolves to (so re-pointing a symlink counts).
+        """
+        digest = hashlib.sha1(tag)
+        with open(ansible_vars_path, 'rb') as vars_file:
+            digest.update(hashlib.sha1(vars_file.read()).digest())
+        digest.update(playbook_digest(self.playbook_path))
+        if self.fingerprint_paths is not None:
+            for path in sorted(self.fingerprint_paths()):
+                digest.update('{}={}:{}'.format(
+                    path, os.path.exists(path), os.path.realpath(path)))
+        return digest.hexdigest()
+
+    def playbook_runs(self):
+        try:
+            with open(self.playbook_runs_path) as runs_file:
+                return json.load(runs_file)
+        except (IOError, ValueError):
+            return {}
+
+    def playbook_run_needed(self, tag):
+        if tag in self.always_run or os.environ.get(force_playbook_env_var):
+            return True
+        return self.playbook_runs().get(tag) != self.fingerprint(tag)
+
+    def record_playbook_run(self, tag, fingerprint):
+        runs = self.playbook_runs()
+        runs[tag] = fingerprint
+        with open(self.playbook_runs_path, 'w') as runs_file:
+            json.dump(runs, runs_file)
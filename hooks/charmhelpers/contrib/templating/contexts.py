@@ -20,6 +20,10 @@ def dict_keys_without_hyphens(a_dict):
 
 def update_relations(context, namespace_separator=':'):
     """Update the context with the relation data."""
+    # Fetching all relations first takes a snapshot of the relation
+    # data, which the queries below are then answered from.
+    context['relations'] = charmhelpers.core.hookenv.relations()
+
     # Add any relation data prefixed with the relation type.
     relation_type = charmhelpers.core.hookenv.relation_type()
     relations = []
@@ -46,8 +50,6 @@ def update_relations(context, namespace_separator=':'):
         relation_type = relation_type.replace('-', '_')
         context['relations_deprecated'][relation_type] = relations
 
-    context['relations'] = charmhelpers.core.hookenv.relations()
-
 
 def juju_state_to_yaml(yaml_path, namespace_separator=':',
                        allow_hyphens_in_keys=True):
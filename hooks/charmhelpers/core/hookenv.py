@@ -7,9 +7,13 @@
 import os
 import json
 import yaml
+import atexit
+import datetime
+import inspect
 import subprocess
 import sys
 import UserDict
+from collections import OrderedDict
 from subprocess import CalledProcessError
 
 CRITICAL = "CRITICAL"
@@ -19,7 +23,103 @@ INFO = "INFO"
 DEBUG = "DEBUG"
 MARKER = object()
 
-cache = {}
+CACHE_MAX_ENTRIES = 1024  # Least recently used results are dropped after this
+
+
+class FunctionCache(object):
+    """A bounded cache of function results.
+
+    Results are keyed by the function and its normalized arguments, and
+    indexed by the function name and any unit or relation id they were
+    called with, so that flush() only touches the relevant entries.
+    Hit, miss and eviction counts are kept for profiling (see stats()).
+    """
+
+    index_args = ('unit', 'rid', 'relid', 'relation_id')
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.clear()
+
+    def clear(self):
+        """Drop every entry and reset the counters"""
+        self.entries = OrderedDict()
+        self.index = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, func, args, kwargs):
+        """The cache key, and index tags, for a call of func"""
+        try:
+            callargs = inspect.getcallargs(func, *args, **kwargs)
+        except TypeError:
+            callargs = {'args': args, 'kwargs': kwargs}
+        tags = set([func.__name__])
+        for name in self.index_args:
+            if isinstance(callargs.get(name), basestring):
+                tags.add(callargs[name])
+        key = (func, tuple(sorted(callargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            key = (func, repr(key[1]))
+        return key, tags
+
+    def get(self, key):
+        """Return a cached result, or raise KeyError"""
+        try:
+            value, tags = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        # Re-insert, marking this as the most recently used
+        self.entries[key] = (value, tags)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, tags):
+        """Cache a result, indexed under each of the tags"""
+        if key in self.entries:
+            self.remove(key)
+        self.entries[key] = (value, tags)
+        for tag in tags:
+            self.index.setdefault(tag, set()).add(key)
+        while len(self.entries) > self.max_entries:
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def remove(self, key):
+        """Remove a single entry, and its index references"""
+        value, tags = self.entries.pop(key)
+        for tag in tags:
+            keys = self.index.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.index[tag]
+
+    def flush(self, tag):
+        """Remove all entries indexed under tag"""
+        for key in self.index.pop(tag, ()):
+            if key in self.entries:
+                self.remove(key)
+
+    def stats(self):
+        """Counters for profiling the cache"""
+        return {
+            'entries': len(self.entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def __len__(self):
+        return len(self.entries)
+
+
+cache = FunctionCache()
 
 
 def cached(func):
@@ -36,35 +136,128 @@ def cached(func):
     will cache the result of unit_get + 'test' for future calls.
     """
     def wrapper(*args, **kwargs):
-        global cache
-        key = str((func, args, kwargs))
+        key, tags = cache.key(func, args, kwargs)
         try:
-            return cache[key]
+            return cache.get(key)
         except KeyError:
             res = func(*args, **kwargs)
-            cache[key] = res
+            cache.set(key, res, tags)
             return res
     return wrapper
 
 
 def flush(key):
-    """Flushes any entries from function cache where the
-    key is found in the function+args """
-    flush_list = []
-    for item in cache:
-        if key in item:
-            flush_list.append(item)
-    for item in flush_list:
-        del cache[item]
+    """Flushes any entries from function cache which were called with
+    key as a unit or relation id, or which are results of the function
+    named key"""
+    cache.flush(key)
+
+
+LOG_BUFFER_MAX_MESSAGES = 100  # Send buffered log messages after this many
+LOG_BUFFER_MAX_BYTES = 64 * 1024  # ...or this many bytes (argv limit is 128KiB)
+LOG_BUFFER_FILE_NAME = '.juju-log-buffer'
+LOG_BUFFER_FILE_MAX_BYTES = 1024 * 1024  # Size at which the file is rotated
+
+
+class LogBuffer(object):
+    """Collects log messages in memory, and writes them to the juju log
+    in a few batched juju-log calls rather than forking one per message.
+
+    Messages are sent when max_messages or max_bytes are waiting, when
+    flush() is called, and when the process exits. No juju-log call is
+    passed more than max_bytes, so longer messages are split up. Each message is also appended
+    straight away to a ring-buffer file in the charm directory (rotated
+    at LOG_BUFFER_FILE_MAX_BYTES), so nothing is lost if the hook dies.
+    """
+
+    def __init__(self, max_messages=LOG_BUFFER_MAX_MESSAGES,
+                 max_bytes=LOG_BUFFER_MAX_BYTES):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.messages = []
+        atexit.register(self.flush)
+
+    def file_path(self):
+        if charm_dir():
+            return os.path.join(charm_dir(), LOG_BUFFER_FILE_NAME)
+
+    def add(self, message, level=None):
+        """Buffer a message, sending all messages if the buffer is full"""
+        timestamp = datetime.datetime.now().strftime('%H:%M:%S.%f')[:-3]
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        else:
+            message = str(message)
+        self.write_to_file(level, timestamp, message)
+        # Leave room for the timestamp and the newline joining lines
+        chunk_size = max(self.max_bytes - len(timestamp) - 2, 1)
+        for start in range(0, max(len(message), 1), chunk_size):
+            self.messages.append(
+                (level, timestamp, message[start:start + chunk_size]))
+        if (len(self.messages) >= self.max_messages or
+                self.buffered_bytes() >= self.max_bytes):
+            self.flush()
+
+    def buffered_bytes(self):
+        return sum(
+            len(timestamp) + len(message) + 2
+            for level, timestamp, message in self.messages)
+
+    def write_to_file(self, level, timestamp, message):
+        file_path = self.file_path()
+        if not file_path:
+            return
+        try:
+            if (os.path.exists(file_path) and
+                    os.path.getsize(file_path) > LOG_BUFFER_FILE_MAX_BYTES):
+                os.rename(file_path, file_path + '.1')
+            with open(file_path, 'a') as log_file:
+                log_file.write('{} {} {}\n'.format(
+                    timestamp, level or INFO, message))
+        except (IOError, OSError):
+            pass
+
+    def flush(self):
+        """Send buffered messages, one juju-log call per run of
+        messages with the same level, of at most max_bytes"""
+        messages, self.messages = self.messages, []
+        batch_level, batch, batch_bytes = None, [], 0
+        for level, timestamp, message in messages:
+            line = '{} {}'.format(timestamp, message)
+            if batch and (level != batch_level or
+                          batch_bytes + len(line) + 1 > self.max_bytes):
+                self.send(batch_level, batch)
+                batch, batch_bytes = [], 0
+            batch_level = level
+            batch.append(line)
+            batch_bytes += len(line) + 1
+        if batch:
+            self.send(batch_level, batch)
+
+    def send(self, level, lines):
+        """Run juju-log, ignoring any failure - logging must never
+        be what stops a hook"""
+        command = ['juju-log']
+        if level:
+            command += ['-l', level]
+        command += ['\n'.join(lines)]
+        try:
+            subprocess.call(command)
+        except Exception:
+            pass
+
+
+log_buffer = LogBuffer()
 
 
 def log(message, level=None):
-    """Write a message to the juju log"""
-    command = ['juju-log']
-    if level:
-        command += ['-l', level]
-    command += [message]
-    subprocess.call(command)
+    """Write a message to the juju log (see LogBuffer)"""
+    log_buffer.add(message, level)
+
+
+def flush_log():
+    """Send any buffered messages to the juju log now"""
+    log_buffer.flush()
 
 
 class Serializable(UserDict.IterableUserDict):
@@ -265,9 +458,98 @@ def config(scope=None):
         return None
 
 
+RELATION_SNAPSHOT_WORKERS = 8  # relation-* commands run at once for a snapshot
+
+
+class RelationSnapshot(object):
+    """All the relation data visible to this unit, fetched at once.
+
+    The relation-ids, relation-list and relation-get commands needed are
+    run in parallel by a pool of at most `workers` threads. Once taken
+    (see snapshot_relations()), relation_get, relation_ids, related_units
+    and relations() are served from the snapshot instead of forking.
+    """
+
+    def __init__(self, workers=RELATION_SNAPSHOT_WORKERS):
+        self.workers = workers
+        self.relation_ids = {}
+        self.units = {}
+        self.data = {}
+
+    def _map(self, function, items):
+        items = list(items)
+        if not items:
+            return []
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(self.workers, len(items)))
+        try:
+            return pool.map(function, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def fetch(self, reltypes):
+        """Fetch all the relation data for reltypes"""
+        reltypes = list(reltypes)
+        self.relation_ids = dict(zip(
+            reltypes, self._map(_relation_ids, reltypes)))
+        relids = [
+            relid for reltype in reltypes
+            for relid in self.relation_ids[reltype]]
+        self.units = dict(zip(relids, self._map(_related_units, relids)))
+        keys = [
+            (relid, unit) for relid in relids
+            for unit in [local_unit()] + self.units[relid]]
+        self.data = dict(zip(keys, self._map(
+            lambda key: _relation_get(unit=key[1], rid=key[0]), keys)))
+        return self
+
+    def get(self, attribute=None, unit=None, rid=None):
+        """Relation data from the snapshot, or raise KeyError"""
+        data = self.data[(rid, unit)] or {}
+        if attribute:
+            return data.get(attribute)
+        return dict(data)
+
+    def update(self, relid, unit, settings):
+        """Record relation settings set since the snapshot was taken"""
+        data = self.data.setdefault((relid, unit), {}) or {}
+        for key, value in settings.items():
+            if value is None or value == '':
+                data.pop(key, None)
+            elif isinstance(value, basestring):
+                data[key] = value
+            else:
+                data[key] = str(value)
+        self.data[(relid, unit)] = data
+
+
+relation_snapshot = None
+
+
+def snapshot_relations(workers=RELATION_SNAPSHOT_WORKERS):
+    """Fetch all relation data at once, and serve later relation
+    queries from it for the rest of this hook"""
+    global relation_snapshot
+    relation_snapshot = RelationSnapshot(workers).fetch(relation_types())
+    return relation_snapshot
+
+
 @cached
 def relation_get(attribute=None, unit=None, rid=None):
     """Get relation information"""
+    if relation_snapshot is not None:
+        try:
+            return relation_snapshot.get(
+                attribute,
+                unit or os.environ.get('JUJU_REMOTE_UNIT'),
+                rid or relation_id())
+        except KeyError:
+            pass
+    return _relation_get(attribute, unit, rid)
+
+
+def _relation_get(attribute=None, unit=None, rid=None):
     _args = ['relation-get', '--format=json']
     if rid:
         _args.append('-r')
@@ -296,6 +578,10 @@ def relation_set(relation_id=None, relation_settings={}, **kwargs):
         else:
             relation_cmd_line.append('{}={}'.format(k, v))
     subprocess.check_call(relation_cmd_line)
+    if relation_snapshot is not None:
+        relation_snapshot.update(
+            relation_id or os.environ.get('JUJU_RELATION_ID'), local_unit(),
+            dict(relation_settings, **kwargs))
     # Flush cache of any relation-gets for local unit
     flush(local_unit())
 
@@ -304,6 +590,13 @@ def relation_set(relation_id=None, relation_settings={}, **kwargs):
 def relation_ids(reltype=None):
     """A list of relation_ids"""
     reltype = reltype or relation_type()
+    snapshot = relation_snapshot
+    if snapshot is not None and reltype in snapshot.relation_ids:
+        return list(snapshot.relation_ids[reltype])
+    return _relation_ids(reltype)
+
+
+def _relation_ids(reltype):
     relid_cmd_line = ['relation-ids', '--format=json']
     if reltype is not None:
         relid_cmd_line.append(reltype)
@@ -315,6 +608,12 @@ def relation_ids(reltype=None):
 def related_units(relid=None):
     """A list of related units"""
     relid = relid or relation_id()
+    if relation_snapshot is not None and relid in relation_snapshot.units:
+        return list(relation_snapshot.units[relid])
+    return _related_units(relid)
+
+
+def _related_units(relid):
     units_cmd_line = ['relation-list', '--format=json']
     if relid is not None:
         units_cmd_line.extend(('-r', relid))
@@ -372,17 +671,20 @@ def relation_types():
     return rel_types
 
 
-@cached
 def relations():
-    """Get a nested dictionary of relation data for all related units"""
+    """Get a nested dictionary of relation data for all related units
+
+    The first call takes a snapshot of all relation data (see
+    snapshot_relations()), which later calls are built from.
+    """
+    snapshot = relation_snapshot or snapshot_relations()
     rels = {}
     for reltype in relation_types():
         relids = {}
-        for relid in relation_ids(reltype):
-            units = {local_unit(): relation_get(unit=local_unit(), rid=relid)}
-            for unit in related_units(relid):
-                reldata = relation_get(unit=unit, rid=relid)
-                units[unit] = reldata
+        for relid in snapshot.relation_ids.get(reltype, []):
+            units = {}
+            for unit in [local_unit()] + snapshot.units[relid]:
+                units[unit] = snapshot.get(unit=unit, rid=relid)
             relids[relid] = units
         rels[reltype] = relids
     return rels
@@ -319,7 +319,7 @@ def cmp_pkgrevno(package, revno, pkgcache=None):
       -1 => Installed revno is less than supplied arg
     '''
     if not pkgcache:
-        apt_pkg.init()
-        pkgcache = apt_pkg.Cache()
+        from charmhelpers.fetch import apt_cache
+        pkgcache = apt_cache()
     pkg = pkgcache[package]
     return apt_pkg.version_compare(pkg.current_ver.ver_str, revno)
@@ -1,4 +1,7 @@
+import errno
+import fcntl
 import importlib
+import json
 import time
 from yaml import safe_load
 from charmhelpers.core.host import (
@@ -75,8 +78,24 @@ FETCH_HANDLERS = (
 )
 
 APT_NO_LOCK = 100  # The return code for "couldn't acquire lock" in APT.
-APT_NO_LOCK_RETRY_DELAY = 10  # Wait 10 seconds between apt lock checks.
 APT_NO_LOCK_RETRY_COUNT = 30  # Retry to acquire the lock X times.
+APT_LOCK_PATHS = (
+    '/var/lib/dpkg/lock',
+    '/var/lib/apt/lists/lock',
+    '/var/cache/apt/archives/lock',
+)
+APT_LOCK_TIMEOUT = 300  # Give up waiting for the apt locks after X seconds.
+APT_LOCK_WAIT_INITIAL = 0.05  # First wait between apt lock checks,
+APT_LOCK_WAIT_MAX = 2  # doubling each time up to X seconds.
+
+DPKG_STATUS_PATH = '/var/lib/dpkg/status'
+APT_LISTS_DIR = '/var/lib/apt/lists'
+
+# The shared apt cache (see apt_cache), and the state it was built at
+_apt_cache = {'state': None, 'cache': None}
+
+# Packages known to be installed, for the dpkg status they were checked at
+_installed_packages = {'status': None, 'packages': set()}
 
 
 class SourceConfigError(Exception):
@@ -115,27 +134,108 @@ class BaseFetchHandler(object):
         return urlunparse(parts)
 
 
-def filter_installed_packages(packages):
-    """Returns a list of packages that require installation"""
-    apt_pkg.init()
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def apt_cache():
+    """The apt package cache, shared by the whole process.
+
+    It's built when first needed, and rebuilt once the installed packages
+    (the dpkg status database) or the package lists change.
+    """
+    state = (_dpkg_status(), _mtime(APT_LISTS_DIR))
+    if _apt_cache['cache'] is None or _apt_cache['state'] != state:
+        apt_pkg.init()
+
+        # Tell apt to build an in-memory cache to prevent race conditions (if
+        # another process is already building the cache).
+        apt_pkg.config.set("Dir::Cache::pkgcache", "")
+
+        _apt_cache.update(state=state, cache=apt_pkg.Cache())
+    return _apt_cache['cache']
 
-    # Tell apt to build an in-memory cache to prevent race conditions (if
-    # another process is already building the cache).
-    apt_pkg.config.set("Dir::Cache::pkgcache", "")
 
-    cache = apt_pkg.Cache()
+def installed_packages(packages):
+    """Returns the packages which are installed, looked up together"""
+    cache = apt_cache()
     _pkgs = []
     for package in packages:
         try:
-            p = cache[package]
-            p.current_ver or _pkgs.append(package)
+            cache[package].current_ver and _pkgs.append(package)
         except KeyError:
             log('Package {} has no installation candidate.'.format(package),
                 level='WARNING')
-            _pkgs.append(package)
     return _pkgs
 
 
+def filter_installed_packages(packages):
+    """Returns a list of packages that require installation"""
+    installed = set(installed_packages(packages))
+    return [package for package in packages if package not in installed]
+
+
+def _dpkg_status():
+    """The mtime and size of the dpkg status database, which change
+    whenever packages are installed or removed."""
+    try:
+        status = os.stat(DPKG_STATUS_PATH)
+    except OSError:
+        return None
+    return '{}:{}'.format(status.st_mtime, status.st_size)
+
+
+def _known_installed_packages(status, cache_file_path=None):
+    if _installed_packages['status'] != status and cache_file_path:
+        try:
+            with open(cache_file_path) as cache_file:
+                cached = json.load(cache_file)
+            _installed_packages.update(
+                status=cached['status'], packages=set(cached['packages']))
+        except (IOError, ValueError, KeyError):
+            pass
+    if _installed_packages['status'] != status:
+        return set()
+    return _installed_packages['packages']
+
+
+def _save_installed_packages(status, packages, cache_file_path=None):
+    _installed_packages.update(status=status, packages=set(packages))
+    if cache_file_path:
+        with open(cache_file_path, 'w') as cache_file:
+            json.dump({'status': status, 'packages': sorted(packages)},
+                      cache_file)
+
+
+def ensure_packages(packages, cache_file_path=None, fatal=True):
+    """Install whichever of packages aren't installed, in one apt run.
+
+    Packages found to be installed are remembered (in cache_file_path
+    too, if given, to carry over to later hooks) until the dpkg status
+    database changes, so they aren't looked up again. Returns the
+    packages which were installed.
+    """
+    status = _dpkg_status()
+    known = _known_installed_packages(status, cache_file_path)
+    unknown = [package for package in packages if package not in known]
+    if not unknown:
+        return []
+
+    missing = filter_installed_packages(unknown)
+    installed = set(unknown) - set(missing)
+    if missing:
+        apt_install(missing, fatal=fatal)
+        # The install changes the status database
+        status = _dpkg_status()
+        if fatal:
+            installed.update(missing)
+    _save_installed_packages(status, known | installed, cache_file_path)
+    return missing
+
+
 def apt_install(packages, options=None, fatal=False):
     """Install one or more packages"""
     if options is None:
@@ -312,6 +412,47 @@ def plugins(fetch_handlers=None):
     return plugin_list
 
 
+def _apt_lock_held(lock_path):
+    """Whether another process (dpkg, apt-get...) holds an apt lock file."""
+    try:
+        lock_file = open(lock_path, 'r+')
+    except IOError:
+        # Missing, or we can't take it anyway
+        return False
+    try:
+        fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, e:
+        if e.errno in (errno.EACCES, errno.EAGAIN):
+            return True
+        raise
+    finally:
+        # Closing the file also releases our lock
+        lock_file.close()
+    return False
+
+
+def wait_for_apt_lock(timeout=APT_LOCK_TIMEOUT):
+    """Wait until none of the apt lock files are held.
+
+    The locks are checked again after a short wait which doubles each time,
+    so a lock released soon is noticed soon. Returns how long it waited,
+    or raises AptLockError after timeout seconds.
+    """
+    started = time.time()
+    delay = APT_LOCK_WAIT_INITIAL
+    while any(_apt_lock_held(lock_path) for lock_path in APT_LOCK_PATHS):
+        waited = time.time() - started
+        if waited >= timeout:
+            raise AptLockError(
+                "Apt lock still held after {:.1f} seconds.".format(waited))
+        time.sleep(min(delay, timeout - waited))
+        delay = min(delay * 2, APT_LOCK_WAIT_MAX)
+    waited = time.time() - started
+    if waited > APT_LOCK_WAIT_INITIAL:
+        log("Waited {:.2f} seconds for the apt lock.".format(waited))
+    return waited
+
+
 def _run_apt_command(cmd, fatal=False):
     """
     Run an APT command, checking output and retrying if the fatal flag is set
@@ -331,19 +472,25 @@ def _run_apt_command(cmd, fatal=False):
         result = None
 
         # If the command is considered "fatal", we need to retry if the apt
-        # lock was not acquired.
+        # lock was not acquired (another process can take it between our
+        # check and the command starting).
 
         while result is None or result == APT_NO_LOCK:
+            wait_for_apt_lock()
             try:
                 result = subprocess.check_call(cmd, env=env)
             except subprocess.CalledProcessError, e:
                 retry_count = retry_count + 1
-                if retry_count > APT_NO_LOCK_RETRY_COUNT:
+                if (e.returncode != APT_NO_LOCK or
+                        retry_count > APT_NO_LOCK_RETRY_COUNT):
                     raise
                 result = e.returncode
-                log("Couldn't acquire DPKG lock. Will retry in {} seconds."
-                    "".format(APT_NO_LOCK_RETRY_DELAY))
-                time.sleep(APT_NO_LOCK_RETRY_DELAY)
+                log("Couldn't acquire DPKG lock. Waiting for it to be "
+                    "released.")
 
     else:
+        try:
+            wait_for_apt_lock()
+        except AptLockError, e:
+            log(str(e), level='WARNING')
         subprocess.call(cmd, env=env)
@@ -1,3 +1,5 @@
+import hashlib
+import httplib
 import os
 import urllib2
 import urlparse
@@ -10,8 +12,17 @@ from charmhelpers.payload.archive import (
     get_archive_handler,
     extract,
 )
+from charmhelpers.core.hookenv import log
 from charmhelpers.core.host import mkdir
 
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # Read and write downloads X bytes at a time.
+DOWNLOAD_RETRIES = 3  # Resume an interrupted download up to X times.
+VALIDATOR_SUFFIX = '.validator'  # The part's ETag or Last-Modified, if any.
+
+
+class ChecksumError(ValueError):
+    pass
+
 
 class ArchiveUrlFetchHandler(BaseFetchHandler):
     """Handler for archives via generic URLs"""
@@ -23,7 +34,19 @@ class ArchiveUrlFetchHandler(BaseFetchHandler):
             return True
         return False
 
-    def download(self, source, dest):
+    def download(self, source, dest, checksum=None, hash_type='sha1',
+                 retries=DOWNLOAD_RETRIES):
+        """Download source to dest, a chunk at a time.
+
+        The download goes to "dest.part" first, which is renamed to dest
+        once it's complete (and matches checksum, if given). If it's
+        interrupted, it's resumed from where it got to with an HTTP Range
+        request, even in a later call. The ETag (or Last-Modified) the
+        server sent for the part is sent back with If-Range, so if the
+        source has changed since, it's downloaded again from the start.
+
+        Returns the hex digest (of hash_type) of what was downloaded.
+        """
         # propogate all exceptions
         # URLError, OSError, etc
         proto, netloc, path, params, query, fragment = urlparse.urlparse(source)
@@ -39,25 +62,135 @@ class ArchiveUrlFetchHandler(BaseFetchHandler):
                 authhandler = urllib2.HTTPBasicAuthHandler(passman)
                 opener = urllib2.build_opener(authhandler)
                 urllib2.install_opener(opener)
-        response = urllib2.urlopen(source)
+
+        part_path = dest + '.part'
+        if self._read_validator(part_path) is None:
+            # Without a validator, a part left by an earlier call can't
+            # be told apart from a different version of the source
+            self._discard_part(part_path)
+        attempt = 0
+        while True:
+            try:
+                digest = self._download_part(source, part_path, hash_type)
+                break
+            except (IOError, httplib.HTTPException) as e:
+                attempt += 1
+                if attempt > retries or (
+                        isinstance(e, urllib2.HTTPError) and e.code < 500):
+                    raise
+                log('Download of {} interrupted ({}), resuming'.format(
+                    source, e), level='WARNING')
+
+        if checksum and digest.hexdigest() != checksum:
+            self._discard_part(part_path)
+            raise ChecksumError(
+                'Downloaded {} has {} {}, expected {}'.format(
+                    source, hash_type, digest.hexdigest(), checksum))
+        os.rename(part_path, dest)
+        self._discard_part(part_path)
+        return digest.hexdigest()
+
+    def _discard_part(self, part_path):
+        """Remove a part download, and the validator saved for it."""
+        for path in (part_path, part_path + VALIDATOR_SUFFIX):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def _read_validator(self, part_path):
+        """The validator saved for a part, or None."""
         try:
-            with open(dest, 'w') as dest_file:
-                dest_file.write(response.read())
-        except Exception as e:
-            if os.path.isfile(dest):
-                os.unlink(dest)
-            raise e
-
-    def install(self, source):
+            with open(part_path + VALIDATOR_SUFFIX) as validator_file:
+                return validator_file.read().strip() or None
+        except IOError:
+            return None
+
+    def _save_validator(self, part_path, response):
+        """Save what identifies the version of the source being downloaded.
+
+        Weak ETags can't be used with If-Range, so Last-Modified is
+        used instead for those.
+        """
+        headers = response.info()
+        validator = headers.getheader('ETag')
+        if not validator or validator.startswith('W/'):
+            validator = headers.getheader('Last-Modified')
+        with open(part_path + VALIDATOR_SUFFIX, 'w') as validator_file:
+            validator_file.write(validator or '')
+
+    def _download_part(self, source, part_path, hash_type):
+        """Download source into part_path, continuing from whatever is
+        already there. Returns the digest of the whole file.
+
+        If the server identified the version of the source the part is of
+        (see _save_validator), it's only continued if the source is still
+        that version, otherwise it's downloaded again."""
+        digest = hashlib.new(hash_type)
+        offset = 0
+        validator = self._read_validator(part_path)
+        if os.path.isfile(part_path):
+            with open(part_path, 'rb') as part_file:
+                for chunk in iter(
+                        lambda: part_file.read(DOWNLOAD_CHUNK_SIZE), ''):
+                    digest.update(chunk)
+                    offset += len(chunk)
+
+        request = urllib2.Request(source)
+        if offset:
+            request.add_header('Range', 'bytes={}-'.format(offset))
+            if validator:
+                request.add_header('If-Range', validator)
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError as e:
+            if offset and e.code == 416:
+                # The part is the whole of the same version (unless it's
+                # longer than the source, when it's downloaded again)
+                content_range = e.info().getheader('Content-Range') or ''
+                if content_range == 'bytes */{}'.format(offset):
+                    return digest
+                self._discard_part(part_path)
+                return self._download_part(source, part_path, hash_type)
+            raise
+
+        if offset and response.getcode() != 206:
+            # The source changed (or the range was ignored), so start again
+            digest = hashlib.new(hash_type)
+            offset = 0
+
+        if not offset:
+            self._save_validator(part_path, response)
+
+        length = response.info().getheader('Content-Length')
+        received = 0
+        try:
+            with open(part_path, 'ab' if offset else 'wb') as part_file:
+                for chunk in iter(
+                        lambda: response.read(DOWNLOAD_CHUNK_SIZE), ''):
+                    part_file.write(chunk)
+                    digest.update(chunk)
+                    received += len(chunk)
+                part_file.flush()
+                os.fsync(part_file.fileno())
+        finally:
+            response.close()
+
+        # A dropped connection just looks like the end of the response
+        if length is not None and received < int(length):
+            raise httplib.IncompleteRead('', int(length) - received)
+        return digest
+
+    def install(self, source, checksum=None, hash_type='sha1'):
         url_parts = self.parse_url(source)
         dest_dir = os.path.join(os.environ.get('CHARM_DIR'), 'fetched')
         if not os.path.exists(dest_dir):
             mkdir(dest_dir, perms=0755)
         dld_file = os.path.join(dest_dir, os.path.basename(url_parts.path))
         try:
-            self.download(source, dld_file)
+            self.download(source, dld_file, checksum, hash_type)
         except urllib2.URLError as e:
             raise UnhandledSource(e.reason)
         except OSError as e:
             raise UnhandledSource(e.strerror)
+        except ChecksumError as e:
+            raise UnhandledSource(str(e))
         return extract(dld_file)
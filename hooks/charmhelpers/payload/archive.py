@@ -1,25 +1,61 @@
+import multiprocessing
 import os
+import subprocess
 import tarfile
+import time
 import zipfile
+from contextlib import contextmanager
+from distutils.spawn import find_executable
 from charmhelpers.core import (
     host,
     hookenv,
 )
 
+# The magic bytes each compression format starts with.
+COMPRESSION_MAGIC = (
+    ('bz2', 'BZh'),
+    ('gz', '\x1f\x8b'),
+    ('xz', '\xfd7zXZ\x00'),
+    ('zstd', '\x28\xb5\x2f\xfd'),
+)
+
+# Decompressors which can use several cores, in order of preference.
+# Each reads the archive on stdin and writes the tar stream to stdout.
+PARALLEL_DECOMPRESSORS = {
+    'bz2': (['lbzip2', '-d', '-c', '-n', '{workers}'],
+            ['pbzip2', '-d', '-c', '-p{workers}']),
+    'gz': (['pigz', '-d', '-c', '-p', '{workers}'],),
+    'xz': (['xz', '-d', '-c', '-T', '{workers}'],),
+    'zstd': (['zstd', '-d', '-c', '-T{workers}'],),
+}
+
 
 class ArchiveError(Exception):
     pass
 
 
+def detect_compression(archive_name):
+    """The compression of a file by its first bytes, or None"""
+    with open(archive_name, 'rb') as archive_file:
+        start = archive_file.read(6)
+    for compression, magic in COMPRESSION_MAGIC:
+        if start.startswith(magic):
+            return compression
+
+
 def get_archive_handler(archive_name):
     if os.path.isfile(archive_name):
         if tarfile.is_tarfile(archive_name):
             return extract_tarfile
         elif zipfile.is_zipfile(archive_name):
             return extract_zipfile
+        elif detect_compression(archive_name) in ('xz', 'zstd'):
+            # Compressed tar archives python's tarfile can't read itself
+            return extract_tarfile
     else:
         # look at the file name
-        for ext in ('.tar', '.tar.gz', '.tgz', 'tar.bz2', '.tbz2', '.tbz'):
+        for ext in ('.tar', '.tar.gz', '.tgz', 'tar.bz2', '.tbz2', '.tbz',
+                    '.tar.xz', '.txz', '.tar.zst'):
             if archive_name.endswith(ext):
                 return extract_tarfile
         for ext in ('.zip', '.jar'):
@@ -32,26 +68,116 @@ def archive_dest_default(archive_name):
     return os.path.join(hookenv.charm_dir(), "archives", archive_file)
 
 
-def extract(archive_name, destpath=None):
+def extract(archive_name, destpath=None, workers=None):
     handler = get_archive_handler(archive_name)
     if handler:
         if not destpath:
             destpath = archive_dest_default(archive_name)
         if not os.path.isdir(destpath):
             host.mkdir(destpath)
-        handler(archive_name, destpath)
+        handler(archive_name, destpath, workers)
         return destpath
     else:
         raise ArchiveError("No handler for archive")
 
 
-def extract_tarfile(archive_name, destpath):
+def decompressor_command(compression, workers=None):
+    """The command for the first parallel decompressor installed for
+    compression, or None"""
+    workers = str(workers or multiprocessing.cpu_count())
+    for command in PARALLEL_DECOMPRESSORS.get(compression, ()):
+        if find_executable(command[0]):
+            return [part.format(workers=workers) for part in command]
+
+
+@contextmanager
+def open_tarfile(archive_name, workers=None):
+    """Open a tar archive to be read as a stream, decompressing it with
+    a parallel decompressor (using workers cores) if one is installed.
+
+    Yields the TarFile, and the name of the decompressor used.
+    """
+    command = decompressor_command(detect_compression(archive_name), workers)
+    if not command:
+        archive = tarfile.open(archive_name, 'r|*')
+        try:
+            yield archive, 'tarfile'
+        finally:
+            archive.close()
+        return
+
+    with open(archive_name, 'rb') as archive_file:
+        process = subprocess.Popen(
+            command, stdin=archive_file, stdout=subprocess.PIPE)
+        archive = tarfile.open(fileobj=process.stdout, mode='r|')
+        try:
+            yield archive, command[0]
+        finally:
+            archive.close()
+            process.stdout.close()
+            if process.wait() not in (0, -13):  # -13: we stopped reading
+                raise ArchiveError('{} failed to decompress {}'.format(
+                    command[0], archive_name))
+
+
+def report_throughput(archive_name, extracted_bytes, seconds, method):
+    """Log how fast an archive was extracted, returning the figures"""
+    seconds = max(seconds, 0.001)
+    stats = {
+        'archive': archive_name,
+        'method': method,
+        'seconds': seconds,
+        'archive_mb_per_second':
+            os.path.getsize(archive_name) / seconds / 1024 / 1024,
+        'extracted_mb_per_second': extracted_bytes / seconds / 1024 / 1024,
+    }
+    hookenv.log(
+        'Extracted {archive} with {method} in {seconds:.2f}s: '
+        '{archive_mb_per_second:.1f} MB/s read, '
+        '{extracted_mb_per_second:.1f} MB/s written'.format(**stats))
+    return stats
+
+
+def extract_tarfile(archive_name, destpath, workers=None):
     "Unpack a tar archive, optionally compressed"
-    archive = tarfile.open(archive_name)
-    archive.extractall(destpath)
+    started = time.time()
+    extracted_bytes = 0
+    with open_tarfile(archive_name, workers) as (archive, method):
+        for member in archive:
+            archive.extract(member, destpath)
+            extracted_bytes += member.size
+    return report_throughput(
+        archive_name, extracted_bytes, time.time() - started, method)
+
 
+def _extract_zip_members(args):
+    archive_name, destpath, names = args
+    zipfile.ZipFile(archive_name).extractall(destpath, names)
 
-def extract_zipfile(archive_name, destpath):
-    "Unpack a zip file"
+
+def extract_zipfile(archive_name, destpath, workers=None):
+    "Unpack a zip file, spreading its members over worker processes"
+    started = time.time()
     archive = zipfile.ZipFile(archive_name)
-    archive.extractall(destpath)
+    members = archive.infolist()
+    workers = min(workers or multiprocessing.cpu_count(), len(members)) or 1
+    if workers == 1:
+        archive.extractall(destpath)
+    else:
+        names = [member.filename for member in members]
+        # Made up front, so the workers don't race to create them
+        for name in names:
+            directory = os.path.join(destpath, os.path.dirname(name))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        pool = multiprocessing.Pool(workers)
+        try:
+            pool.map(_extract_zip_members, [
+                (archive_name, destpath, names[worker::workers])
+                for worker in range(workers)])
+        finally:
+            pool.close()
+            pool.join()
+    return report_throughput(
+        archive_name, sum(member.file_size for member in members),
+        time.time() - started, 'zipfile x{}'.format(workers))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+"""
+Compile python modules to bytecode with whichever python runs this,
+so run with the application's interpreter, python 3 applications get
+their bytecode in __pycache__ as they'd expect. deploy.py runs it as:
+
+$ <python> hooks/compile_modules.py <workers> <uid> <gid> < sources.json
+
+where sources.json is a list of module paths. For each module, in order,
+it prints (as a JSON list) whether it was compiled, and any error.
+
+Modules whose bytecode is up to date are skipped. Bytecode is written
+alongside then renamed into place, so bytecode hard-linked from another
+build is never changed. This runs outside the charm, so it only uses
+the standard library, and works on python 2 and 3.
+"""
+
+# System
+import json
+import multiprocessing
+import os
+import py_compile
+import struct
+import sys
+
+try:
+    from importlib.util import cache_from_source, MAGIC_NUMBER
+except ImportError:
+    # Python 2
+    import imp
+
+    MAGIC_NUMBER = imp.get_magic()
+
+    def cache_from_source(source_path):
+        return source_path + ('c' if __debug__ else 'o')
+
+# Where the source's mtime is in the bytecode header
+# (python 3.7 added a flags field before it)
+mtime_offset = 8 if sys.version_info >= (3, 7) else 4
+
+
+def bytecode_up_to_date(source_path, compiled_path):
+    """
+    Whether compiled_path was compiled from source_path as it is now
+    """
+
+    try:
+        with open(compiled_path, 'rb') as compiled_file:
+            header = compiled_file.read(mtime_offset + 4)
+    except IOError:
+        return False
+
+    mtime = struct.pack(
+        '<I', int(os.stat(source_path).st_mtime) & 0xFFFFFFFF
+    )
+
+    return (
+        header[:4] == MAGIC_NUMBER
+        and header[4:mtime_offset] in (b'', b'\0\0\0\0')
+        and header[mtime_offset:] == mtime
+    )
+
+
+def compile_module(arguments):
+    """
+    Compile a module, unless that's already been done.
+    Returns whether it was compiled, and any error.
+    """
+
+    source_path, ownership = arguments
+    compiled_path = cache_from_source(source_path)
+    compiled_dir = os.path.dirname(compiled_path)
+    temp_path = '{0}.{1}'.format(compiled_path, os.getpid())
+
+    try:
+        if bytecode_up_to_date(source_path, compiled_path):
+            return False, None
+
+        if not os.path.isdir(compiled_dir):
+            try:
+                os.mkdir(compiled_dir)
+                os.lchown(compiled_dir, *ownership)
+            except OSError:
+                # e.g. made by another worker meanwhile
+                if not os.path.isdir(compiled_dir):
+                    raise
+
+        py_compile.compile(
+            source_path, cfile=temp_path, dfile=source_path, doraise=True
+        )
+        os.lchown(temp_path, *ownership)
+        os.rename(temp_path, compiled_path)
+    except py_compile.PyCompileError as compile_error:
+        return False, compile_error.msg
+    except EnvironmentError as error:
+        # e.g. a dangling symlink, or an unreadable module
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+        return False, str(error)
+
+    return True, None
+
+
+def compile_modules(sources, workers=None, ownership=(-1, -1)):
+    """
+    Compile modules with a pool of processes
+    (one per core, unless a number of workers is given)
+    """
+
+    pool = multiprocessing.Pool(workers or None)
+
+    try:
+        return pool.map(
+            compile_module, [(source, ownership) for source in sources],
+            chunksize=64
+        )
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4:
+        sys.exit('Usage: {0} <workers> <uid> <gid> < sources.json'.format(
+            sys.argv[0]
+        ))
+
+    workers, uid, gid = [int(argument) for argument in sys.argv[1:]]
+    results = compile_modules(json.load(sys.stdin), workers, (uid, gid))
+    print(json.dumps(results))
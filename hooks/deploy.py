@@ -0,0 +1,1069 @@
+#!/usr/bin/env python
+
+"""
+Deployment steps run by the wsgi-app role
+
+Fetch a code archive into place through a local artifact cache:
+
+$ hooks/deploy.py fetch <url> <dest> <cache_dir> [--sha256 SHA256]
+
+Downloaded archives are stored in cache_dir by the sha256 of their
+content, along with the ETag, Last-Modified and size the server sent
+for each URL. Later fetches of the same URL send a conditional request,
+and if the archive hasn't changed (or a changed URL has the same content
+as an archive already cached) it's hard-linked into place rather than
+downloaded again. Interrupted downloads are resumed, and if a sha256
+is given the archive must match it.
+
+Prints "changed" if dest now has different content, or "unchanged".
+
+Extract a code archive, decompressing it on several cores
+(all of them, unless a number of workers is given):
+
+$ hooks/deploy.py extract <archive> <dest> [--workers N] [--previous DIR]
+                          [--owner USER] [--group GROUP]
+
+The archive is extracted into a new directory which then replaces dest,
+so nothing is left behind from an archive extracted there before.
+A manifest of each file's sha256, size and mode is saved in the build's
+.deploy directory. Files which are the same in the previous build's
+manifest are hard-linked from it rather than written again.
+The extraction speed and how much was reused are printed (and logged).
+Files are given the owner and group as they're written.
+
+Compile a build's python modules with a process per core (or workers),
+using the application's interpreter (by default the build's virtualenv,
+or python), recording how long it took in the build's .deploy/compile.json:
+
+$ hooks/deploy.py compile <build_dir> [--workers N] [--owner USER]
+                          [--group GROUP] [--python PYTHON]
+
+Stage a build in the background, marking it ready when it's done
+(see stage() for the spec), and check whether a build is ready:
+
+$ hooks/deploy.py stage <spec_json>
+$ hooks/deploy.py ready <build_dir>
+
+Point a symlink (e.g. current) at a build by renaming a new link over it,
+keeping a <link>.previous link to the old target, and roll back to it:
+
+$ hooks/deploy.py switch <link> <target> [--owner USER] [--group GROUP]
+$ hooks/deploy.py rollback <link> [--owner USER] [--group GROUP]
+
+Each swap, and how long it took, is logged to .deploy/swaps.log
+in the link's directory. switch prints "changed" or "unchanged".
+"""
+
+# System
+import argparse
+import base64
+import ctypes
+import errno
+import grp
+import hashlib
+import json
+import os
+import pwd
+import shutil
+import subprocess
+import sys
+import time
+import urllib2
+import urlparse
+from os import path
+from tempfile import SpooledTemporaryFile
+
+# Local
+from helpers import parse_json_file, save_to_json_file
+from charmhelpers.core.hookenv import log
+from charmhelpers.fetch.archiveurl import ArchiveUrlFetchHandler
+from charmhelpers.payload import archive
+
+
+# Read and write files this many bytes at a time
+chunk_size = 64 * 1024
+
+# Archive members up to this size are held in memory while they're hashed
+spool_size = 8 * 1024 * 1024
+
+# Where an extracted build's manifest is kept, within the build
+manifest_dir = '.deploy'
+
+# Run with the application's interpreter to compile its modules
+compile_modules_path = path.join(
+    path.dirname(path.abspath(__file__)), 'compile_modules.py'
+)
+
+# Where a build's virtualenv may be, within the build
+virtualenv_names = ['env', 'venv', '.venv']
+
+# For renameat2(), to swap two paths in one step
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+
+def cache_paths(cache_dir, url):
+    """
+    The paths for a URL's metadata, and for the cached content
+    """
+
+    url_key = hashlib.sha1(url).hexdigest()
+
+    return (
+        path.join(cache_dir, 'urls', url_key + '.json'),
+        path.join(cache_dir, 'objects')
+    )
+
+
+def conditional_request(url, metadata):
+    """
+    A request for url, only asking for the content
+    if it has changed since metadata was saved
+    """
+
+    scheme, netloc, url_path, query, fragment = urlparse.urlsplit(url)
+    auth, host = urllib2.splituser(netloc)
+
+    if auth:
+        url = urlparse.urlunsplit((scheme, host, url_path, query, fragment))
+
+    request = urllib2.Request(url)
+
+    if auth:
+        credentials = base64.b64encode(urllib2.unquote(auth))
+        request.add_header('Authorization', 'Basic ' + credentials)
+
+    if metadata.get('etag'):
+        request.add_header('If-None-Match', metadata['etag'])
+
+    if metadata.get('last_modified'):
+        request.add_header('If-Modified-Since', metadata['last_modified'])
+
+    return request
+
+
+def download_object(url, objects_dir, sha256=None):
+    """
+    Download url into the objects directory, named by the sha256
+    of its content (which must be sha256, if that's given)
+
+    The download is resumed if an earlier one was interrupted
+    (see ArchiveUrlFetchHandler.download)
+    """
+
+    download_path = path.join(
+        objects_dir, '.download-' + hashlib.sha1(url).hexdigest()
+    )
+    digest = ArchiveUrlFetchHandler().download(
+        url, download_path, checksum=sha256, hash_type='sha256'
+    )
+    object_path = path.join(objects_dir, digest)
+
+    if path.exists(object_path):
+        # Already cached, from another URL or build
+        os.remove(download_path)
+    else:
+        os.chmod(download_path, 0644)
+        os.rename(download_path, object_path)
+
+    return digest
+
+
+def fetch_to_cache(url, cache_dir, sha256=None):
+    """
+    Make sure the current content of url is in the cache,
+    returning the path to it
+    """
+
+    metadata_path, objects_dir = cache_paths(cache_dir, url)
+
+    for directory in (path.dirname(metadata_path), objects_dir):
+        if not path.isdir(directory):
+            os.makedirs(directory)
+
+    metadata = parse_json_file(metadata_path)
+    cached_path = None
+
+    if metadata.get('sha256') and sha256 in (None, metadata['sha256']):
+        cached_path = path.join(objects_dir, metadata['sha256'])
+
+        if not path.isfile(cached_path):
+            cached_path = None
+
+    if not cached_path:
+        metadata = {}
+
+    try:
+        response = urllib2.urlopen(conditional_request(url, metadata))
+    except urllib2.HTTPError as http_error:
+        if http_error.code == 304 and cached_path:
+            return cached_path
+
+        raise
+
+    # Only the headers are needed from this response,
+    # the content is downloaded resumably by download_object
+    headers = response.info()
+    response.close()
+
+    digest = download_object(url, objects_dir, sha256)
+
+    save_to_json_file(metadata_path, {
+        'sha256': digest,
+        'etag': headers.getheader('ETag'),
+        'last_modified': headers.getheader('Last-Modified'),
+        'size': path.getsize(path.join(objects_dir, digest))
+    })
+
+    return path.join(objects_dir, digest)
+
+
+def file_sha256(file_path):
+    digest = hashlib.sha256()
+
+    with open(file_path, 'rb') as source_file:
+        for chunk in iter(lambda: source_file.read(chunk_size), ''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def temp_path_for(file_path):
+    """
+    A path alongside file_path to create its replacement at
+    """
+
+    return path.join(
+        path.dirname(file_path),
+        '.{0}.{1}'.format(path.basename(file_path), os.getpid())
+    )
+
+
+def link_into_place(source, dest):
+    """
+    Hard-link source to dest, replacing dest in one step
+    """
+
+    temp_link = temp_path_for(dest)
+
+    if path.lexists(temp_link):
+        os.remove(temp_link)
+
+    os.link(source, temp_link)
+    os.rename(temp_link, dest)
+
+
+def fetch(url, dest, cache_dir, sha256=None):
+    """
+    Fetch url to dest through the cache, returning whether dest changed
+
+    If sha256 is given, the content must have that sha256
+    """
+
+    object_path = fetch_to_cache(url, cache_dir, sha256)
+
+    if path.exists(dest):
+        if path.samefile(object_path, dest):
+            return False
+
+        # E.g. the cache was cleared, but the content is the same
+        changed = file_sha256(dest) != path.basename(object_path)
+    else:
+        changed = True
+
+    link_into_place(object_path, dest)
+
+    return changed
+
+
+def safe_member_path(dest, name, is_dir=False):
+    """
+    Where an archive member goes within dest,
+    refusing members which would end up outside it
+
+    A directory for the archive's root (e.g. "./", as archives made with
+    "tar -C dir -c ." have) is dest itself.
+
+    Members are also refused if a symlink extracted earlier (e.g. "link"
+    to /etc, followed by "link/passwd") would take them outside dest.
+    """
+
+    dest = path.normpath(dest)
+    member_path = path.normpath(path.join(dest, name))
+
+    if is_dir and member_path == dest:
+        return member_path
+
+    if not member_path.startswith(dest + os.sep):
+        raise archive.ArchiveError('Unsafe path in archive: ' + name)
+
+    real_dest = path.realpath(dest)
+    real_parent = path.realpath(path.dirname(member_path))
+
+    if not (
+        real_parent == real_dest
+        or real_parent.startswith(real_dest + os.sep)
+    ):
+        raise archive.ArchiveError('Unsafe path in archive: ' + name)
+
+    return member_path
+
+
+def load_manifest(build_dir):
+    """
+    The manifest of a previously extracted build, if it has one
+    """
+
+    if not build_dir:
+        return {}
+
+    return parse_json_file(
+        path.join(build_dir, manifest_dir, 'manifest.json')
+    ).get('files', {})
+
+
+def ownership_ids(owner=None, group=None):
+    """
+    The (uid, gid) for an owner and group name, -1 meaning unchanged
+    """
+
+    return (
+        pwd.getpwnam(owner).pw_uid if owner else -1,
+        grp.getgrnam(group).gr_gid if group else -1
+    )
+
+
+def make_dirs(dir_path, ownership):
+    """
+    Create dir_path and any missing parents, owned by ownership (uid, gid)
+    """
+
+    if path.isdir(dir_path):
+        return
+
+    make_dirs(path.dirname(dir_path), ownership)
+    os.mkdir(dir_path)
+    os.lchown(dir_path, *ownership)
+
+
+def unchanged_file(file_path, entry):
+    """
+    Whether file_path still has the content its manifest entry records
+    """
+
+    return (
+        path.isfile(file_path)
+        and not path.islink(file_path)
+        and path.getsize(file_path) == entry['size']
+        and file_sha256(file_path) == entry['sha256']
+    )
+
+
+def extract_member_file(
+    tar, member, member_path, previous_path, previous, ownership
+):
+    """
+    Extract a file from the archive, or hard-link it from
+    the previous build if it's the same there,
+    owned by ownership (uid, gid)
+
+    The previous build's file is only linked if its content still
+    matches its manifest entry (it may have been changed in place).
+
+    Returns its manifest entry, and whether it was reused.
+    """
+
+    digest = hashlib.sha256()
+    content = SpooledTemporaryFile(max_size=spool_size)
+    source = tar.extractfile(member)
+
+    for chunk in iter(lambda: source.read(chunk_size), ''):
+        digest.update(chunk)
+        content.write(chunk)
+
+    entry = {
+        'sha256': digest.hexdigest(),
+        'size': member.size,
+        'mode': member.mode
+    }
+
+    # Never write through a link to another build's file
+    if path.lexists(member_path):
+        os.remove(member_path)
+    else:
+        make_dirs(path.dirname(member_path), ownership)
+
+    if entry == previous and unchanged_file(previous_path, previous):
+        os.link(previous_path, member_path)
+        os.lchown(member_path, *ownership)
+        return entry, True
+
+    content.seek(0)
+
+    with open(member_path, 'wb') as member_file:
+        shutil.copyfileobj(content, member_file, chunk_size)
+        os.fchown(member_file.fileno(), *ownership)
+
+    os.chmod(member_path, member.mode)
+    os.utime(member_path, (member.mtime, member.mtime))
+
+    return entry, False
+
+
+def extract_tar_with_manifest(
+    archive_path, dest, workers, previous_build, ownership
+):
+    """
+    Extract a tar archive, hard-linking files which haven't changed
+    since the previous build, returning its stats and manifest entries
+
+    Everything extracted is owned by ownership (uid, gid) as it's written
+    """
+
+    started = time.time()
+    previous_files = load_manifest(previous_build)
+    files = {}
+    reused = {'files': 0, 'bytes': 0}
+
+    with archive.open_tarfile(archive_path, workers) as (tar, method):
+        # Rather than the owner recorded in the archive
+        # (which tarfile looks up by name for every member)
+        tar.chown = lambda member, target_path: os.lchown(
+            target_path, *ownership
+        )
+
+        for member in tar:
+            member_path = safe_member_path(
+                dest, member.name, member.isdir()
+            )
+
+            if not member.isfile():
+                make_dirs(path.dirname(member_path), ownership)
+                tar.extract(member, dest)
+                continue
+
+            name = path.relpath(member_path, dest)
+            entry, was_reused = extract_member_file(
+                tar, member, member_path,
+                previous_build and path.join(previous_build, name),
+                previous_files.get(name),
+                ownership
+            )
+            files[name] = entry
+
+            if was_reused:
+                reused['files'] += 1
+                reused['bytes'] += member.size
+
+    total_bytes = sum(entry['size'] for entry in files.values())
+    stats = archive.report_throughput(
+        archive_path, total_bytes, time.time() - started, method
+    )
+    stats.update(
+        previous_build=previous_build,
+        files=len(files),
+        reused_files=reused['files'],
+        reused_bytes=reused['bytes'],
+        reuse_ratio=float(reused['bytes']) / total_bytes if total_bytes else 0
+    )
+
+    log(
+        'Reused {reused_files} of {files} files ({reuse_ratio:.0%} of the '
+        'content) from {previous_build}'.format(**stats)
+    )
+
+    return stats, files
+
+
+def chown_tree(dir_path, ownership):
+    """
+    Set the owner of everything in dir_path
+    """
+
+    os.lchown(dir_path, *ownership)
+
+    for root, dir_names, file_names in os.walk(dir_path):
+        for name in dir_names + file_names:
+            os.lchown(path.join(root, name), *ownership)
+
+
+def exchange_paths(first, second):
+    """
+    Swap two paths in one step, with Linux's renameat2(RENAME_EXCHANGE)
+
+    Returns False if that isn't available here.
+    """
+
+    renameat2 = getattr(ctypes.CDLL(None, use_errno=True), 'renameat2', None)
+
+    if renameat2 is None:
+        return False
+
+    if renameat2(AT_FDCWD, first, AT_FDCWD, second, RENAME_EXCHANGE) == 0:
+        return True
+
+    error = ctypes.get_errno()
+
+    if error in (errno.ENOSYS, errno.EINVAL):
+        return False
+
+    raise OSError(error, os.strerror(error), second)
+
+
+def replace_dir(new_dir, dest):
+    """
+    Put new_dir in dest's place, and remove what was there
+
+    Where the kernel can't swap them in one step, dest is only
+    missing for the moment between two renames.
+    """
+
+    if not path.lexists(dest):
+        os.rename(new_dir, dest)
+        return
+
+    if exchange_paths(new_dir, dest):
+        shutil.rmtree(new_dir)
+        return
+
+    old_dir = temp_path_for(dest) + '.old'
+    os.rename(dest, old_dir)
+    os.rename(new_dir, dest)
+    shutil.rmtree(old_dir)
+
+
+def extract(
+    archive_path, dest, workers=None, previous_build=None,
+    owner=None, group=None
+):
+    """
+    Extract an archive into dest, returning how fast it went
+
+    The archive is extracted into a new directory alongside dest, which
+    then replaces dest. So extracting over a build (e.g. a rebuilt archive
+    with the same build_label) leaves none of its old files behind,
+    and nothing sees it half-extracted.
+
+    Tar archives get a manifest of their files (in dest/.deploy),
+    and files which are the same in previous_build's manifest
+    are hard-linked from there rather than written again.
+    The manifest also records the archive's sha256.
+
+    Everything extracted is given the owner and group (if provided).
+    """
+
+    ownership = ownership_ids(owner, group)
+
+    handler = archive.get_archive_handler(archive_path)
+
+    if not handler:
+        raise archive.ArchiveError('No handler for ' + archive_path)
+
+    dest = path.normpath(dest)
+    new_dest = temp_path_for(dest) + '.new'
+
+    make_dirs(path.dirname(dest), ownership)
+
+    if path.lexists(new_dest):
+        # Left by an extraction which was interrupted
+        shutil.rmtree(new_dest)
+
+    make_dirs(new_dest, ownership)
+
+    if previous_build:
+        previous_build = path.realpath(previous_build)
+
+        if previous_build == path.realpath(dest):
+            previous_build = None
+
+    try:
+        if handler == archive.extract_tarfile:
+            stats, files = extract_tar_with_manifest(
+                archive_path, new_dest, workers, previous_build, ownership
+            )
+        else:
+            stats = handler(archive_path, new_dest, workers)
+            files = {}
+
+            if ownership != (-1, -1):
+                chown_tree(new_dest, ownership)
+
+        make_dirs(path.join(new_dest, manifest_dir), ownership)
+        save_to_json_file(
+            path.join(new_dest, manifest_dir, 'manifest.json'), {
+                'files': files,
+                'stats': stats,
+                'archive_sha256': file_sha256(archive_path)
+            }
+        )
+
+        replace_dir(new_dest, dest)
+    except Exception:
+        if path.lexists(new_dest):
+            shutil.rmtree(new_dest)
+        raise
+
+    return stats
+
+
+def archive_digest(build_dir):
+    """
+    The sha256 of the archive a build was extracted from, if it's known
+    """
+
+    return parse_json_file(
+        path.join(build_dir, manifest_dir, 'manifest.json')
+    ).get('archive_sha256')
+
+
+def app_python(build_dir, python=None):
+    """
+    The interpreter the application runs with: python (a command, or a
+    path within the build), or else the python in the build's virtualenv
+    if it has one, or else "python"
+    """
+
+    if python:
+        if os.sep in python and not path.isabs(python):
+            return path.join(build_dir, python)
+
+        return python
+
+    for venv_name in virtualenv_names:
+        venv_python = path.join(build_dir, venv_name, 'bin', 'python')
+
+        if path.isfile(venv_python):
+            return venv_python
+
+    return 'python'
+
+
+def compile_build(
+    build_dir, workers=None, owner=None, group=None, python=None
+):
+    """
+    Compile all the python modules in a build with a pool of processes
+    running the application's interpreter (see app_python and
+    compile_modules.py), recording how long it took in the build's
+    .deploy/compile.json
+
+    Modules which don't compile (or if the interpreter can't be run)
+    are recorded as failed, rather than failing the build.
+    """
+
+    started = time.time()
+    ownership = ownership_ids(owner, group)
+    sources = []
+    python = app_python(build_dir, python)
+
+    for root, dir_names, file_names in os.walk(build_dir):
+        if root == build_dir:
+            for skipped_dir in [manifest_dir] + virtualenv_names:
+                if skipped_dir in dir_names:
+                    dir_names.remove(skipped_dir)
+
+        sources.extend(
+            path.join(root, name) for name in file_names
+            if name.endswith('.py')
+        )
+
+    try:
+        compiler = subprocess.Popen(
+            [python, compile_modules_path, str(workers or 0)]
+            + [str(ownership_id) for ownership_id in ownership],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+        output = compiler.communicate(json.dumps(sources))[0]
+
+        if compiler.returncode:
+            raise OSError('exited with {0}'.format(compiler.returncode))
+
+        results = json.loads(output)
+    except (OSError, ValueError) as error:
+        error = '{0} could not compile: {1}'.format(python, error)
+        results = [(False, error)] * len(sources)
+
+    failed = dict(
+        (path.relpath(source, build_dir), error)
+        for source, (_, error) in zip(sources, results) if error
+    )
+    stats = {
+        'python': python,
+        'modules': len(sources),
+        'compiled': sum(1 for compiled, _ in results if compiled),
+        'failed': failed,
+        'seconds': time.time() - started
+    }
+
+    log(
+        'Compiled {compiled} of {modules} modules with {python} '
+        'in {seconds:.2f}s ({0} failed)'.format(len(failed), **stats)
+    )
+
+    make_dirs(path.join(build_dir, manifest_dir), ownership)
+    save_to_json_file(
+        path.join(build_dir, manifest_dir, 'compile.json'), stats
+    )
+
+    return stats
+
+
+class BuildNotReadyError(Exception):
+    """
+    Raised when switching to a build which hasn't been fully staged
+    """
+
+    pass
+
+
+def previous_link_path(link_path):
+    """
+    The link kept pointing at link_path's previous target
+    """
+
+    return link_path + '.previous'
+
+
+def record_swap(link_path, target, previous, started):
+    """
+    Append a swap of link_path, and how long it took, to the log
+    of swaps kept alongside it
+    """
+
+    swap = {
+        'link': link_path,
+        'target': target,
+        'previous': previous,
+        'switched': time.time(),
+        'seconds': time.time() - started
+    }
+    log_dir = path.join(path.dirname(link_path), manifest_dir)
+
+    if not path.isdir(log_dir):
+        os.makedirs(log_dir)
+
+    with open(path.join(log_dir, 'swaps.log'), 'a') as swaps_log:
+        swaps_log.write(json.dumps(swap, sort_keys=True) + '\n')
+
+    log('Pointed {link} at {target} in {seconds:.4f}s'.format(**swap))
+
+    return swap
+
+
+def replace_link(link_path, target, ownership):
+    """
+    Create a link to target alongside link_path, and rename it over link_path
+    """
+
+    temp_link = temp_path_for(link_path)
+
+    if path.lexists(temp_link):
+        os.remove(temp_link)
+
+    os.symlink(target, temp_link)
+    os.lchown(temp_link, *ownership)
+    os.rename(temp_link, link_path)
+
+
+def switch_symlink(link_path, target, ownership=(-1, -1)):
+    """
+    Point link_path at target, replacing any existing link in one step
+
+    The previous target is kept in a link alongside, so rolling back
+    is a single rename (see rollback_symlink).
+    Returns the swap recorded, or None if link_path already pointed at target.
+    """
+
+    started = time.time()
+    previous = None
+
+    if path.islink(link_path):
+        previous = os.readlink(link_path)
+
+        if previous == target:
+            return None
+
+    replace_link(link_path, target, ownership)
+
+    if previous:
+        replace_link(previous_link_path(link_path), previous, ownership)
+
+    return record_swap(link_path, target, previous, started)
+
+
+def rollback_symlink(link_path, ownership=(-1, -1)):
+    """
+    Point link_path back at its previous target,
+    by renaming the link to it over link_path
+
+    Rolling back again returns to where link_path pointed before.
+    """
+
+    started = time.time()
+    previous_link = previous_link_path(link_path)
+
+    if not path.islink(previous_link):
+        raise OSError(
+            errno.ENOENT, 'No previous target to roll back to', previous_link
+        )
+
+    rolled_back_from = os.readlink(link_path)
+    os.rename(previous_link, link_path)
+    swap = record_swap(
+        link_path, os.readlink(link_path), rolled_back_from, started
+    )
+    replace_link(previous_link, rolled_back_from, ownership)
+
+    return swap
+
+
+def build_ready(build_dir):
+    """
+    Whether a build has been fully staged, and can be switched to
+
+    Builds from before staging existed are ready once they're extracted.
+    """
+
+    markers_dir = path.join(build_dir, manifest_dir)
+
+    if path.isfile(path.join(markers_dir, 'ready.json')):
+        return True
+
+    return (
+        path.isfile(path.join(build_dir, 'EXTRACTED'))
+        and not path.isfile(path.join(markers_dir, 'staging.json'))
+    )
+
+
+def stage(spec):
+    """
+    Prepare a build to be switched to: fetch and extract its archive,
+    install its requirements and run its make target, then mark it ready
+
+    spec is a dict of:
+    - build_dir, archive_path: where the build and its archive go
+    - archive_url, cache_dir: to download the archive through the cache
+      (checking it against archive_sha256, if given),
+      or charm_archive_path: to copy it from the charm
+    - previous, owner, group, workers: as for extract
+    - requirements_path, pip_cache_path: pip requirements in the build
+    - make_target: run in the build (with this process's environment)
+      before the build's python modules are compiled
+    - python: the interpreter to compile them with (see app_python)
+    - fingerprint: saved in the ready marker
+    """
+
+    build_dir = spec['build_dir']
+    markers_dir = path.join(build_dir, manifest_dir)
+    ready_path = path.join(markers_dir, 'ready.json')
+    ownership = ownership_ids(spec.get('owner'), spec.get('group'))
+    durations = {}
+
+    make_dirs(markers_dir, ownership)
+
+    if path.isfile(ready_path):
+        os.remove(ready_path)
+
+    staging = {'fingerprint': spec.get('fingerprint'), 'started': time.time()}
+    save_to_json_file(path.join(markers_dir, 'staging.json'), staging)
+
+    started = time.time()
+    make_dirs(path.dirname(spec['archive_path']), ownership)
+
+    if spec.get('archive_url'):
+        archive_changed = fetch(
+            spec['archive_url'], spec['archive_path'], spec['cache_dir'],
+            spec.get('archive_sha256')
+        )
+    else:
+        archive_changed = not path.isfile(spec['archive_path'])
+
+        if archive_changed:
+            shutil.copy(spec['charm_archive_path'], spec['archive_path'])
+
+    os.lchown(spec['archive_path'], *ownership)
+    durations['fetch'] = time.time() - started
+
+    previous = spec.get('previous')
+
+    if previous and path.realpath(previous) == path.realpath(build_dir):
+        # e.g. current pointing at latest, which already points at the build
+        previous = None
+
+    if archive_changed or not path.isfile(path.join(build_dir, 'EXTRACTED')):
+        started = time.time()
+        extract(
+            spec['archive_path'], build_dir, spec.get('workers'),
+            previous, spec.get('owner'), spec.get('group')
+        )
+        # The build was replaced by the newly extracted one
+        save_to_json_file(path.join(markers_dir, 'staging.json'), staging)
+        open(path.join(build_dir, 'EXTRACTED'), 'a').close()
+        durations['extract'] = time.time() - started
+
+    if spec.get('requirements_path'):
+        started = time.time()
+        command = [
+            'pip', 'install',
+            '--requirement', path.join(build_dir, spec['requirements_path'])
+        ]
+
+        if spec.get('pip_cache_path'):
+            command.extend([
+                '--no-index',
+                '--find-links', path.join(build_dir, spec['pip_cache_path'])
+            ])
+
+        subprocess.check_call(command)
+        durations['requirements'] = time.time() - started
+
+    if spec.get('make_target'):
+        started = time.time()
+        subprocess.check_call(['make', spec['make_target']], cwd=build_dir)
+        durations['make_target'] = time.time() - started
+
+    # After the make target, which may add modules
+    started = time.time()
+    compile_build(
+        build_dir, spec.get('workers'), spec.get('owner'), spec.get('group'),
+        spec.get('python')
+    )
+    durations['compile'] = time.time() - started
+
+    save_to_json_file(ready_path, {
+        'fingerprint': spec.get('fingerprint'),
+        'durations': durations,
+        'ready': time.time()
+    })
+    os.remove(path.join(markers_dir, 'staging.json'))
+
+    return durations
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description='Deploy code archives')
+    commands = parser.add_subparsers(dest='command')
+
+    fetch_parser = commands.add_parser(
+        'fetch', help='Fetch an archive through the local cache'
+    )
+    fetch_parser.add_argument('url')
+    fetch_parser.add_argument('dest')
+    fetch_parser.add_argument('cache_dir')
+    fetch_parser.add_argument(
+        '--sha256', help='The sha256 the archive must have'
+    )
+
+    extract_parser = commands.add_parser('extract', help='Extract an archive')
+    extract_parser.add_argument('archive')
+    extract_parser.add_argument('dest')
+    extract_parser.add_argument(
+        '--workers', type=int, default=0,
+        help='Cores to decompress with (default: all)'
+    )
+    extract_parser.add_argument(
+        '--previous', help='A build to reuse unchanged files from'
+    )
+    extract_parser.add_argument('--owner', help='Who will own the files')
+    extract_parser.add_argument('--group', help='The group for the files')
+
+    compile_parser = commands.add_parser(
+        'compile', help="Compile a build's python modules"
+    )
+    compile_parser.add_argument('build_dir')
+    compile_parser.add_argument(
+        '--workers', type=int, default=0,
+        help='Processes to compile with (default: one per core)'
+    )
+    compile_parser.add_argument('--owner', help='Who will own the bytecode')
+    compile_parser.add_argument('--group', help='The group for the bytecode')
+    compile_parser.add_argument(
+        '--python',
+        help="The application's interpreter (default: the build's "
+        'virtualenv, or python)'
+    )
+
+    stage_parser = commands.add_parser(
+        'stage', help='Prepare a build in the background'
+    )
+    stage_parser.add_argument('spec', type=json.loads, help='(as JSON)')
+
+    ready_parser = commands.add_parser(
+        'ready', help='Whether a build is ready to be switched to'
+    )
+    ready_parser.add_argument('build_dir')
+
+    switch_parser = commands.add_parser(
+        'switch', help='Point a symlink at a target in one rename'
+    )
+    switch_parser.add_argument('link')
+    switch_parser.add_argument('target')
+    switch_parser.add_argument('--owner', help='Who will own the link')
+    switch_parser.add_argument('--group', help='The group for the link')
+
+    rollback_parser = commands.add_parser(
+        'rollback', help="Point a symlink back at its previous target"
+    )
+    rollback_parser.add_argument('link')
+    rollback_parser.add_argument('--owner', help='Who will own the link')
+    rollback_parser.add_argument('--group', help='The group for the link')
+
+    return parser.parse_args(arguments)
+
+
+if __name__ == "__main__":
+    arguments = parse_arguments(sys.argv[1:])
+
+    if arguments.command == 'fetch':
+        changed = fetch(
+            arguments.url, arguments.dest, arguments.cache_dir,
+            arguments.sha256 or None
+        )
+        print('changed' if changed else 'unchanged')
+    elif arguments.command == 'extract':
+        stats = extract(
+            arguments.archive, arguments.dest,
+            arguments.workers, arguments.previous,
+            arguments.owner, arguments.group
+        )
+        print(
+            'Extracted with {method} in {seconds:.2f}s: '
+            '{archive_mb_per_second:.1f} MB/s read, '
+            '{extracted_mb_per_second:.1f} MB/s written'.format(**stats)
+        )
+
+        if 'reuse_ratio' in stats:
+            print('Reused {reuse_ratio:.0%} from the previous build'.format(
+                **stats
+            ))
+    elif arguments.command == 'compile':
+        stats = compile_build(
+            arguments.build_dir, arguments.workers,
+            arguments.owner, arguments.group, arguments.python or None
+        )
+        print(
+            'Compiled {compiled} of {modules} modules '
+            'in {seconds:.2f}s'.format(**stats)
+        )
+
+        for module, error in sorted(stats['failed'].items()):
+            print('Failed to compile {0}: {1}'.format(module, error))
+    elif arguments.command == 'stage':
+        durations = stage(arguments.spec)
+        print('Staged {0}: {1}'.format(arguments.spec['build_dir'], ', '.join(
+            '{0} {1:.2f}s'.format(step, seconds)
+            for step, seconds in sorted(durations.items())
+        )))
+    elif arguments.command == 'ready':
+        print('ready' if build_ready(arguments.build_dir) else 'not ready')
+    elif arguments.command == 'switch':
+        swap = switch_symlink(
+            arguments.link, arguments.target,
+            ownership_ids(arguments.owner, arguments.group)
+        )
+        print('changed' if swap else 'unchanged')
+    elif arguments.command == 'rollback':
+        swap = rollback_symlink(
+            arguments.link, ownership_ids(arguments.owner, arguments.group)
+        )
+        print('Pointed {link} back at {target}'.format(**swap))
@@ -1,6 +1,10 @@
 # System
+import hashlib
 import json
+import os
+import re
 from os import path, pardir
+from tempfile import NamedTemporaryFile
 from urlparse import urlunparse
 from collections import namedtuple
 
@@ -17,23 +21,28 @@ def literal(**kw):
 def save_to_json_file(json_file_path, data_to_save):
     """
     Save a python object as json in a file
-    """
-
-    with open(json_file_path, 'w') as json_file:
-        json_file.write(json.dumps(data_to_save))
-
 
-def update_property_in_json_file(json_file_path, key, value):
-    """
-    Given a path to a file containing a JSON object
-    Set the value of a property on that JSON object
+    The file is written alongside and then renamed into place,
+    so it's never left half-written
     """
 
-    json_data = parse_json_file(json_file_path)
+    json_file = NamedTemporaryFile(
+        dir=path.dirname(path.abspath(json_file_path)),
+        prefix='.' + path.basename(json_file_path),
+        delete=False
+    )
 
-    json_data[key] = value
+    try:
+        with json_file:
+            json_file.write(json.dumps(data_to_save))
+            json_file.flush()
+            os.fsync(json_file.fileno())
 
-    save_to_json_file(json_file_path, json_data)
+        os.chmod(json_file.name, 0644)
+        os.rename(json_file.name, json_file_path)
+    except Exception:
+        os.unlink(json_file.name)
+        raise
 
 
 def parse_json_file(json_file_path):
@@ -50,6 +59,85 @@ def parse_json_file(json_file_path):
     return env_vars
 
 
+class EnvStore(object):
+    """
+    The environment variables for the app, kept in a JSON file
+
+    The file is read once, changes are collected in memory,
+    and commit() writes them all at once (atomically)
+
+    > env = EnvStore('charm_cache/env.json')
+    > env.set('DATABASE_URL', 'postgresql://db')
+    > env.commit()
+    True
+    """
+
+    def __init__(self, json_file_path):
+        self.json_file_path = json_file_path
+        self.saved = None
+        self.variables = None
+
+    def load(self):
+        if self.saved is None:
+            self.saved = parse_json_file(self.json_file_path)
+            self.variables = dict(self.saved)
+
+    def get(self, key, default=None):
+        self.load()
+        return self.variables.get(key, default)
+
+    def set(self, key, value):
+        self.load()
+        self.variables[key] = value
+
+    def unset(self, key):
+        self.load()
+        self.variables.pop(key, None)
+
+    def as_dict(self):
+        self.load()
+        return dict(self.variables)
+
+    def changed(self):
+        """
+        Whether there are changes which haven't been committed
+        """
+
+        self.load()
+        return self.variables != self.saved
+
+    def commit(self):
+        """
+        Save any changes, returning whether there were any
+        """
+
+        if not self.changed():
+            return False
+
+        save_to_json_file(self.json_file_path, self.variables)
+        self.saved = dict(self.variables)
+
+        return True
+
+    def __contains__(self, key):
+        self.load()
+        return key in self.variables
+
+
+def dict_digest(data):
+    """
+    A stable hex digest of a JSON-serialisable object,
+    which only changes when the data does
+
+    > dict_digest({'a': 1, 'b': 2}) == dict_digest({'b': 2, 'a': 1})
+    True
+    """
+
+    serialised = json.dumps(data, sort_keys=True)
+
+    return hashlib.sha1(serialised).hexdigest()
+
+
 def parent_dir(dir_path):
     """
     Get the parent dir from of the top directory for a path,
@@ -130,68 +218,212 @@ def build_url_host(domain, port=None, username=None, password=None):
     return host
 
 
-def add_ansible_config(charm_dir, config_data):
+# Resolved role variables, by ansible_config_cache_key
+ansible_config_cache = {}
+
+ansible_role_templates = ['defaults/main.yml', 'vars/main.yml']
+
+
+def ansible_config_cache_key(wsgi_role_path, config_data):
+    """
+    A key for the resolved role variables, which changes
+    whenever the config or either role template changes
+    """
+
+    template_mtimes = [
+        path.getmtime(path.join(wsgi_role_path, template_path))
+        for template_path in ansible_role_templates
+    ]
+
+    return dict_digest([config_data, template_mtimes])
+
+
+def add_ansible_config(charm_dir, config_data, cache_file_path=None):
     """
     Collect config settings from an ansible role
     by reading both 'defaults/main.yml'
     and 'vars/main.yml'
     and appending their data to config_data
+
+    The result is memoized for this process, and also
+    in cache_file_path (if provided) for later hooks
     """
 
+    wsgi_role_path = path.join(charm_dir, 'roles', 'wsgi-app')
+    cache_key = ansible_config_cache_key(wsgi_role_path, config_data)
+
+    if cache_key not in ansible_config_cache and cache_file_path:
+        cached = parse_json_file(cache_file_path)
+
+        if cached.get('key') == cache_key:
+            ansible_config_cache[cache_key] = cached['config']
+
+    if cache_key in ansible_config_cache:
+        config_data.update(ansible_config_cache[cache_key])
+        return config_data
+
     # Local imports - 'cos they weren't ready earlier
     from jinja2 import Environment, FileSystemLoader
 
     # Setup template parser environment
-    wsgi_role_path = path.join(charm_dir, 'roles', 'wsgi-app')
     template_env = Environment(loader=FileSystemLoader(wsgi_role_path))
 
-    config_data = update_from_yaml_template(
-        'defaults/main.yml', template_env, config_data
-    )
+    for template_path in ansible_role_templates:
+        config_data = update_from_yaml_template(
+            template_path, template_env, config_data
+        )
 
-    config_data = update_from_yaml_template(
-        'vars/main.yml', template_env, config_data
-    )
+    ansible_config_cache[cache_key] = dict(config_data)
+
+    if cache_file_path and path.isdir(path.dirname(cache_file_path)):
+        save_to_json_file(
+            cache_file_path, {'key': cache_key, 'config': config_data}
+        )
 
     return config_data
 
 
+# A top-level "key:" line in a YAML mapping
+top_level_key = re.compile(r'^([A-Za-z_][\w-]*)\s*:(\s|$)')
+
+
+class TemplateVariableCycleError(Exception):
+    """
+    Raised when template variables depend on each other in a loop
+    """
+
+    pass
+
+
 def update_from_yaml_template(template_path, parser_env, data):
     """
     Given a path to a yaml file and a template parser environment
     add all data in the yaml file to the provided data dictionary
+
+    Each top-level entry is parsed as a template once, and the entries
+    are rendered in dependency order, so chained variables (e.g.
+    code_dir -> application_dir -> app_label) are resolved in a single
+    pass. Each entry is only loaded as YAML after it has been rendered,
+    so templated values needn't be quoted and keep their YAML types.
+    Values in the file take precedence over those already in data.
     """
 
     import yaml
     from jinja2 import meta, UndefinedError
 
-    # Find variables in template
-    content = parser_env.loader.get_source(parser_env, template_path)
-    parsed_template = parser_env.parse(content[0])
-    template_variables = meta.find_undeclared_variables(parsed_template)
+    source = parser_env.loader.get_source(parser_env, template_path)[0]
 
-    # Find undeclared variables not already in context
-    undefined_variables = list(set(template_variables) - set(data))
+    # Parse each templated entry, and find the variables it uses
+    file_variables = {}
+    templates = {}
+    dependencies = {}
 
-    # Parse template
-    template = parser_env.get_template(template_path)
-    yaml_content = template.render(data)
-    new_variables = yaml.load(yaml_content)
-    data.update(new_variables)
+    for name, entry in yaml_template_entries(source):
+        if '{{' in entry or '{%' in entry:
+            parsed_entry = parser_env.parse(entry)
+            templates[name] = parser_env.from_string(parsed_entry)
+            dependencies[name] = meta.find_undeclared_variables(parsed_entry)
+            file_variables[name] = None
+        else:
+            file_variables[name] = yaml.safe_load(entry)[name]
 
-    # If any new variables were in the undeclared variables
-    list_intersection = filter(
-        lambda x: x in undefined_variables, new_variables
-    )
+    # Report anything that can never be defined up front
+    undefined_variables = set()
+
+    for variables in dependencies.values():
+        undefined_variables.update(
+            set(variables) - set(file_variables) - set(data)
+        )
+
+    if undefined_variables:
+        raise UndefinedError(
+            'Undefined variables: ' + str(sorted(undefined_variables))
+        )
 
-    if list_intersection:
-        data = update_from_yaml_template(template_path, parser_env, data)
-    elif undefined_variables:
-        raise UndefinedError('Undefined variables: ' + str(undefined_variables))
+    context = dict(data)
+    context.update(file_variables)
+
+    for name in dependency_order(dependencies, file_variables):
+        rendered_entry = templates[name].render(context)
+        context[name] = yaml.safe_load(rendered_entry)[name]
+
+    data.update(
+        (name, context[name]) for name in file_variables
+    )
 
     return data
 
 
+def yaml_template_entries(source):
+    """
+    Split the source of a YAML mapping into (name, text) pairs,
+    one for each top-level key, without parsing it as YAML.
+    Indented, blank and comment lines belong to the key above them.
+
+    > yaml_template_entries('a: 1\\nb: >\\n  {{ a }}\\n')
+    [('a', 'a: 1\\n'), ('b', 'b: >\\n  {{ a }}\\n')]
+    """
+
+    entries = []
+
+    for line in source.splitlines(True):
+        match = top_level_key.match(line)
+
+        if match:
+            entries.append((match.group(1), [line]))
+        elif entries:
+            entries[-1][1].append(line)
+
+    return [(name, ''.join(lines)) for name, lines in entries]
+
+
+def dependency_order(dependencies, names):
+    """
+    Given a dictionary mapping names to the names they depend on,
+    return the names from that dictionary in an order where
+    each comes after everything it depends on.
+    Only dependencies which are themselves in "names" are followed.
+
+    > dependency_order({'a': ['b'], 'b': ['c']}, ['a', 'b', 'c'])
+    ['b', 'a']
+    """
+
+    ordered = []
+    visited = set()
+
+    for start in sorted(dependencies):
+        if start in visited:
+            continue
+
+        # Depth-first, keeping the current chain to report cycles
+        chain = [start]
+        stack = [iter(sorted(dependencies[start]))]
+        visited.add(start)
+
+        while stack:
+            for dependency in stack[-1]:
+                if dependency not in dependencies or dependency not in names:
+                    continue
+
+                if dependency in chain:
+                    cycle = chain[chain.index(dependency):] + [dependency]
+                    raise TemplateVariableCycleError(
+                        'Variables depend on each other: '
+                        + ' -> '.join(cycle)
+                    )
+
+                if dependency not in visited:
+                    visited.add(dependency)
+                    chain.append(dependency)
+                    stack.append(iter(sorted(dependencies[dependency])))
+                    break
+            else:
+                stack.pop()
+                ordered.append(chain.pop())
+
+    return ordered
+
+
 def items_are_not_empty(test_dictionary, items_to_test):
     """
     For a list of keys, check all items in a dictionary with those key names
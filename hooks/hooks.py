@@ -1,25 +1,34 @@
 #!/usr/bin/env python
 
 # System
+import json
+import os
 import sys
 import re
+import time
+from datetime import datetime
 from shutil import rmtree
 from os import path, mkdir
-from datetime import datetime
 
 # Local
 import sh
+import deploy
+import helpers
+import jobs
+import profiler
 from helpers import (
     add_ansible_config,
     build_url,
     dequote,
+    dict_digest,
     items_are_not_empty,
     parent_dir,
     parse_json_file,
-    save_to_json_file,
-    update_property_in_json_file
+    save_to_json_file
 )
+from reconcile import Reconciler
 import charmhelpers.contrib.ansible
+from charmhelpers.core import hookenv
 from charmhelpers.core.hookenv import (
     close_port,
     config,
@@ -32,24 +41,39 @@ from charmhelpers.core.hookenv import (
     relations,
     UnregisteredHookError
 )
-from charmhelpers.core.host import log
+from charmhelpers.core.host import file_hash, log
+from charmhelpers.fetch import ensure_packages
 from charmhelpers.payload.execd import execd_preinstall
 
 # Globals (unfortunately)
 charm_dir = parent_dir(__file__)
 cache_dir = path.join(charm_dir, 'charm_cache')
 env_file_path = path.join(cache_dir, 'env.json')
+wsgi_settings_file_path = path.join(cache_dir, 'wsgi-settings.json')
+ansible_config_file_path = path.join(cache_dir, 'ansible-config.json')
+make_target_file_path = path.join(cache_dir, 'make-target.json')
+jobs_dir = jobs.default_jobs_dir
+packages_file_path = path.join(cache_dir, 'installed-packages.json')
 
 # Hooks helper for the direct python hooks
 # (ansible hooks are run by ansible_hooks)
 hooks = Hooks()
 
+# Collects the environment, relation settings and make target runs
+# requested by the hook functions, and applies them once at the end
+reconciler = Reconciler(env_file_path)
+
 # Create the hooks helper which automatically registers the
 # required hooks based on the available tags in your playbook.
 # By default, running a hook (such as 'config-changed') will
 # result in running all tasks tagged with that hook name.
+#
+# The playbook is skipped if nothing it depends on has changed since
+# it last ran for that hook (except for the hooks in always_run).
 ansible_hooks = charmhelpers.contrib.ansible.AnsibleHooks(
-    playbook_path='playbook.yml'
+    playbook_path='playbook.yml',
+    always_run=['install', 'upgrade-charm'],
+    fingerprint_paths=lambda: playbook_fingerprint_paths()
 )
 
 
@@ -67,12 +91,31 @@ def wsgi_relation():
     """
     Setup relation for serving the WSGI file (e.g. gunicorn)
 
-    Sets a whole bunch of relation settings
-    including log file locations and environent variables
+    The settings are sent (and the update target run)
+    once the hook has finished, by send_wsgi_settings
     """
 
     log('Hook function: wsgi_relation')
 
+    if relation_ids('wsgi-file'):
+        # Relation changed - re-run update target
+        reconciler.request('update-target')
+
+    reconciler.request('wsgi-settings')
+
+
+def send_wsgi_settings():
+    """
+    Sets a whole bunch of relation settings on any wsgi-file relations
+    including log file locations and environent variables
+
+    Settings are only sent to a relation when they differ from
+    the ones last sent to it, so a hook which changes nothing
+    won't restart the wsgi processes
+    """
+
+    log('Function: send_wsgi_settings')
+
     config_data = ansible_config()
 
     log_file_path = path.join(
@@ -80,13 +123,17 @@ def wsgi_relation():
         config_data['app_label'] + '-access.log'
     )
 
-    env_dictionary = parse_json_file(env_file_path)
-    env_list = ["{0}={1}".format(k, v) for k, v in env_dictionary.items()]
+    env_dictionary = reconciler.env()
+    env_list = [
+        "{0}={1}".format(k, v) for k, v in sorted(env_dictionary.items())
+    ]
     env_string = " ".join(env_list)
 
+    working_dir = path.join(config_data.get('code_dir', ''), 'current')
+
     wsgi_relation_settings = {
         'project_name': config_data.get('app_label', ''),
-        'working_dir': path.join(config_data.get('code_dir', ''), 'current'),
+        'working_dir': working_dir,
         'python_path': config_data.get('python_path', ''),
         'wsgi_user': config_data.get('wsgi_user', ''),
         'wsgi_group': config_data.get('wsgi_group', ''),
@@ -95,11 +142,26 @@ def wsgi_relation():
         'wsgi_wsgi_file': config_data.get('wsgi_application', ''),
         'wsgi_extra': '--error-logfile=' + log_file_path,
         'env_extra': env_string,
-        'timestamp': datetime.now().isoformat()
+        # The wsgi subordinate restarts whenever this changes, so it's
+        # a digest of what affects the running app rather than a time.
+        # The symlink is resolved so switching builds also restarts,
+        # and the archive digest so re-extracting a rebuilt one does.
+        'timestamp': dict_digest({
+            'env': env_dictionary,
+            'working_dir': path.realpath(working_dir),
+            'archive_sha256': deploy.archive_digest(working_dir),
+            'wsgi_file': config_data.get('wsgi_application', '')
+        })
     }
 
-    # Set these settings on any wsgi-file relations
-    for relation_id in relation_ids('wsgi-file'):
+    sent_settings = parse_json_file(wsgi_settings_file_path)
+    relation_ids_to_update = [
+        relation_id for relation_id in relation_ids('wsgi-file')
+        if sent_settings.get(relation_id) != wsgi_relation_settings
+    ]
+
+    # Set these settings on any changed wsgi-file relations
+    for relation_id in relation_ids_to_update:
         log(
             'Setting wsgi-file relation settings: '
             + str(wsgi_relation_settings)
@@ -110,8 +172,10 @@ def wsgi_relation():
             **wsgi_relation_settings
         )
 
-        # Relation changed - re-run update target
-        update_target()
+        sent_settings[relation_id] = wsgi_relation_settings
+
+    if relation_ids_to_update:
+        save_to_json_file(wsgi_settings_file_path, sent_settings)
 
     open_port(config_data['listen_port'])
 
@@ -183,20 +247,16 @@ def unlink_mongo():
 
 def unlink_database(variable_name):
     """
-    Remove "DATABASE_URL" environment variable
+    Remove a database environment variable (e.g. "DATABASE_URL")
     """
 
     log('Function: unlink_database')
 
-    env_vars = parse_json_file(env_file_path)
-
-    if 'DATABASE_URL' in env_vars:
-        del env_vars['DATABASE_URL']
-
-        save_to_json_file(env_file_path, env_vars)
+    if variable_name in reconciler.env():
+        reconciler.unset_env(variable_name)
 
         # Reset wsgi relation settings
-        wsgi_relation()
+        reconciler.request('wsgi-settings')
 
 
 @hooks.hook('webservice-relation-changed')
@@ -236,15 +296,12 @@ def webservice_relation():
         port=relation_get("port")
     )
 
-    update_property_in_json_file(
-        env_file_path, 'WEBSERVICE_URL', webservice_url
-    )
-
-    # Relation changed - re-run update target
-    update_target()
+    if reconciler.set_env('WEBSERVICE_URL', webservice_url):
+        # Relation changed - re-run update target
+        reconciler.request('update-target')
 
     # Reset wsgi relation settings
-    wsgi_relation()
+    reconciler.request('wsgi-settings')
 
 
 @hooks.hook('webservice-relation-broken')
@@ -253,17 +310,13 @@ def unlink_webservice():
     Remove "WEBSERVICE_URL" environment variable
     """
 
-    log('Function: unlink_database')
+    log('Function: unlink_webservice')
 
-    env_vars = parse_json_file(env_file_path)
-
-    if 'WEBSERVICE_URL' in env_vars:
-        del env_vars['WEBSERVICE_URL']
-
-        save_to_json_file(env_file_path, env_vars)
+    if 'WEBSERVICE_URL' in reconciler.env():
+        reconciler.unset_env('WEBSERVICE_URL')
 
         # Reset wsgi relation settings
-        wsgi_relation()
+        reconciler.request('wsgi-settings')
 
 
 def update_env():
@@ -272,14 +325,9 @@ def update_env():
     env_vars_string = config('environment_variables')
 
     if env_vars_string:
-        env_vars = parse_json_file(env_file_path)
-
         for env_var_string in env_vars_string.split(' '):
             key, value = env_var_string.split('=')
-            value = dequote(value)
-            env_vars[key] = value
-
-        save_to_json_file(env_file_path, env_vars)
+            reconciler.set_env(key, dequote(value))
 
 
 @hooks.hook('install', 'upgrade-charm')
@@ -311,11 +359,83 @@ def config_changed():
     """
     update_env()
     wsgi_relation()
-    update_target()
+    reconciler.request('update-target')
     pgsql_relation()
     mongodb_relation()
 
 
+@hooks.hook('set-current-symlink')
+def set_current_symlink():
+    """
+    Point current at the CURRENT_SYMLINK build (e.g. "r2")
+
+    Builds which are still being staged or whose make target
+    is still running in the background (or failed) are refused.
+    The wsgi processes are restarted by the changed wsgi settings.
+    """
+
+    log('Hook function: set_current_symlink')
+
+    config_data = ansible_config()
+    target = path.join(config_data['code_dir'], os.environ['CURRENT_SYMLINK'])
+    build_label = path.basename(path.realpath(target))
+
+    jobs.check_finished(jobs_dir, build_label)
+
+    if not deploy.build_ready(target):
+        raise deploy.BuildNotReadyError(
+            'Build {0} is not ready yet (see {1})'.format(
+                build_label, path.join(jobs_dir, build_label, 'output.log')
+            )
+        )
+
+    deploy.switch_symlink(
+        path.join(config_data['code_dir'], 'current'),
+        target,
+        deploy.ownership_ids(
+            config_data['wsgi_user'], config_data['wsgi_group']
+        )
+    )
+
+    reconciler.request('wsgi-settings')
+
+
+@hooks.hook('rollback-current-symlink')
+def rollback_current_symlink():
+    """
+    Point current back at the build it pointed at before the last switch
+    """
+
+    log('Hook function: rollback_current_symlink')
+
+    config_data = ansible_config()
+
+    swap = deploy.rollback_symlink(
+        path.join(config_data['code_dir'], 'current'),
+        deploy.ownership_ids(
+            config_data['wsgi_user'], config_data['wsgi_group']
+        )
+    )
+    log('Rolled current back to {target}'.format(**swap))
+
+    reconciler.request('wsgi-settings')
+
+
+@hooks.hook('force-playbook')
+def force_playbook():
+    """
+    Run config-changed, including the playbook
+    even if nothing it depends on has changed
+    (e.g. to pick up an archive rebuilt under the same build_label)
+    """
+
+    log('Hook function: force_playbook')
+
+    os.environ[charmhelpers.contrib.ansible.force_playbook_env_var] = '1'
+    ansible_hooks.execute(['config-changed'])
+    config_changed()
+
+
 # Helper functions
 # ===
 
@@ -323,22 +443,100 @@ def ansible_config():
     """
     Build ansible config data, extending current config_data
     and with the local unit name
+
+    (The role variables are cached in ansible_config_file_path)
     """
 
-    config_data = config()
+    # Copy, so the cached hookenv config isn't extended too
+    config_data = dict(config())
     config_data['local_unit'] = local_unit()
-    return add_ansible_config(charm_dir, config_data)
+    return add_ansible_config(
+        charm_dir, config_data, ansible_config_file_path
+    )
+
+
+def playbook_fingerprint_paths():
+    """
+    Paths created by the playbook,
+    so that it's run again if any of them go missing
+    """
+
+    config_data = ansible_config()
+    code_dir = config_data['code_dir']
+
+    # The role's defaults replace the charm config in config_data,
+    # so this is read from the charm config itself
+    current_symlink = config('current_symlink') or 'latest'
+
+    paths = [
+        path.join(code_dir, 'latest'),
+        path.join(code_dir, 'current'),
+        path.join(code_dir, current_symlink),
+        # Current and latest are only switched to a staged build
+        # once it's ready
+        path.join(
+            code_dir, current_symlink, deploy.manifest_dir, 'ready.json'
+        )
+    ]
+
+    if config_data.get('build_label'):
+        paths.append(path.join(
+            code_dir, config_data['build_label'],
+            deploy.manifest_dir, 'ready.json'
+        ))
+
+    if items_are_not_empty(config_data, ['build_label', 'archive_filename']):
+        paths.extend([
+            path.join(
+                charm_dir, 'files',
+                config_data['build_label'], config_data['archive_filename']
+            ),
+            path.join(
+                config_data['current_archive_dir'],
+                config_data['archive_filename']
+            ),
+            path.join(config_data['current_code_dir'], 'EXTRACTED')
+        ])
+
+    return paths
 
 
 def update_target():
     """
     Run the "update-charm" make target within the project
+
+    The run is skipped if the build, target, environment and Makefile
+    are all the same as for the last successful run. The result of
+    the last run is kept in make_target_file_path.
+
+    With update_make_target_async, the target is queued to run
+    in the background by the job runner (see jobs.py) instead,
+    unless the same run is already queued.
+
+    With prestage_builds, the whole build is staged in the background
+    instead, including the make target (see queue_stage).
+
+    Hook functions shouldn't call this directly,
+    but request it with reconciler.request('update-target')
     """
 
     log('Hook function: update_target')
 
     config_data = ansible_config()
 
+    if config_data.get('prestage_builds'):
+        archive_configs = ['build_label', 'archive_filename']
+
+        if items_are_not_empty(config_data, archive_configs):
+            # The stage job runs the make target
+            if config_data.get('update_make_target'):
+                if ensure_packages(['make'], packages_file_path):
+                    log('Installed make')
+
+            queue_stage(config_data, reconciler.env())
+
+        return
+
     required_configs = [
         'build_label',
         'archive_filename',
@@ -352,23 +550,177 @@ def update_target():
         and path.isdir(config_data['current_code_dir'])
     ):
         # Ensure make is installed
-        apt_output = sh.apt_get.install('make')
-        log('Installed make:')
-        log(str(apt_output))
-
-        env_vars = parse_json_file(env_file_path)
-
-        # Execute make target with all environment variables
-        make_output = sh.make(
-            config_data['update_make_target'],
-            directory=path.join(config_data['current_code_dir']),
-            _env=env_vars
-        )
+        if ensure_packages(['make'], packages_file_path):
+            log('Installed make')
+
+        env_vars = reconciler.env()
+
+        fingerprint = make_target_fingerprint(config_data, env_vars)
+        last_run = parse_json_file(make_target_file_path)
+
+        if (
+            last_run.get('fingerprint') == fingerprint
+            and last_run.get('exit_code') == 0
+        ):
+            log('Make target unchanged since its last run, skipping it')
+            return
+
+        if config_data.get('update_make_target_async'):
+            queue_make_target(config_data, env_vars, fingerprint)
+            return
+
+        started = time.time()
+        exit_code = None
+
+        try:
+            # Execute make target with all environment variables
+            make_output = sh.make(
+                config_data['update_make_target'],
+                directory=path.join(config_data['current_code_dir']),
+                _env=env_vars
+            )
+            exit_code = make_output.exit_code
+        except sh.ErrorReturnCode as make_error:
+            exit_code = make_error.exit_code
+            raise
+        finally:
+            save_to_json_file(make_target_file_path, {
+                'fingerprint': fingerprint,
+                'build_label': config_data['build_label'],
+                'target': config_data['update_make_target'],
+                'exit_code': exit_code,
+                'duration': time.time() - started,
+                'finished': datetime.now().isoformat()
+            })
 
         log('Make output:')
         log(str(make_output))
 
 
+def queue_make_target(config_data, env_vars, fingerprint):
+    """
+    Hand the make target to the background job runner
+    """
+
+    build_label = config_data['build_label']
+
+    if jobs.pending_fingerprint(jobs_dir, build_label) == fingerprint:
+        log('Make target already queued for build {0}'.format(build_label))
+        jobs.resume(jobs_dir, build_label)
+        return
+
+    jobs.submit(
+        jobs_dir,
+        build_label,
+        command=['make', config_data['update_make_target']],
+        cwd=config_data['current_code_dir'],
+        env=env_vars,
+        fingerprint=fingerprint,
+        status_file_path=make_target_file_path
+    )
+
+    log('Queued make target for build {0} (see {1})'.format(
+        build_label, path.join(jobs_dir, build_label, 'output.log')
+    ))
+
+
+def queue_stage(config_data, env_vars):
+    """
+    Hand preparing the build (fetching and extracting the archive,
+    pip requirements and the make target) to a background job,
+    at low priority, unless it's already been done or queued
+    """
+
+    build_label = config_data['build_label']
+    build_dir = config_data['current_code_dir']
+    archive_filename = config_data['archive_filename']
+
+    spec = {
+        'build_dir': build_dir,
+        'archive_path': path.join(
+            config_data['current_archive_dir'], archive_filename
+        ),
+        'archive_url': None,
+        'archive_sha256': config_data.get('archive_sha256') or None,
+        'cache_dir': path.join(config_data['archives_dir'], '.cache'),
+        'charm_archive_path': path.join(
+            charm_dir, 'files', build_label, archive_filename
+        ),
+        'previous': path.join(config_data['code_dir'], 'current'),
+        'owner': config_data['wsgi_user'],
+        'group': config_data['wsgi_group'],
+        'workers': config_data.get('extract_workers'),
+        'requirements_path': config_data.get('requirements_path'),
+        'pip_cache_path': config_data.get('pip_cache_path'),
+        'make_target': config_data.get('update_make_target'),
+        'python': config_data.get('app_python') or None
+    }
+
+    if spec['make_target']:
+        # It may change files in the build in place, which mustn't
+        # be hard-linked to the current build's
+        spec['previous'] = None
+
+    if config_data.get('code_assets_uri'):
+        spec['archive_url'] = '/'.join([
+            config_data['code_assets_uri'], build_label, archive_filename
+        ])
+
+    spec['fingerprint'] = dict_digest({'spec': spec, 'env': env_vars})
+
+    ready = parse_json_file(
+        path.join(build_dir, deploy.manifest_dir, 'ready.json')
+    )
+
+    if spec['fingerprint'] in (
+        ready.get('fingerprint'),
+        jobs.pending_fingerprint(jobs_dir, build_label)
+    ):
+        log('Build {0} already staged or queued'.format(build_label))
+        jobs.resume(jobs_dir, build_label)
+        return
+
+    command = jobs.low_priority_command([
+        sys.executable, path.join(charm_dir, 'hooks', 'deploy.py'),
+        'stage', json.dumps(spec)
+    ])
+
+    # The make target gets the app's environment
+    job_env = dict(env_vars, PATH=os.environ.get('PATH', os.defpath))
+
+    jobs.submit(
+        jobs_dir,
+        build_label,
+        command=command,
+        cwd=charm_dir,
+        env=job_env,
+        fingerprint=spec['fingerprint']
+    )
+
+    log('Queued staging build {0} (see {1})'.format(
+        build_label, path.join(jobs_dir, build_label, 'output.log')
+    ))
+
+
+def make_target_fingerprint(config_data, env_vars):
+    """
+    A digest of everything the make target's result depends on:
+    the build, the target, the environment and the Makefile
+    """
+
+    code_dir = config_data['current_code_dir']
+
+    return dict_digest({
+        'build_label': config_data['build_label'],
+        'target': config_data['update_make_target'],
+        'env': env_vars,
+        'makefiles': [
+            file_hash(path.join(code_dir, makefile_name))
+            for makefile_name in ['GNUmakefile', 'makefile', 'Makefile']
+        ]
+    })
+
+
 def link_database(
     scheme,
     database_host,
@@ -392,18 +744,88 @@ def link_database(
         path=database_name
     )
 
-    update_property_in_json_file(
-        env_file_path, variable_name, database_url
+    if reconciler.set_env(variable_name, database_url):
+        # Relation changed - re-run update target
+        reconciler.request('update-target')
+
+    # Reset wsgi relation settings
+    reconciler.request('wsgi-settings')
+
+
+# Reconcile actions, in the order they should be applied
+reconciler.register('update-target', update_target)
+reconciler.register('wsgi-settings', send_wsgi_settings)
+
+
+def profile_hook(hook_name):
+    """
+    Record how long each part of this hook takes
+    (see profiler.py)
+    """
+
+    profile = profiler.start(hook_name, path.join(cache_dir, 'traces'))
+
+    this_module = sys.modules[__name__]
+    profile.instrument(this_module, prefix='hooks')
+    profile.instrument(
+        this_module,
+        names=[
+            'add_ansible_config', 'config', 'ensure_packages',
+            'relation_get', 'relation_ids', 'relation_set', 'relations',
+            'open_port', 'close_port'
+        ],
+        prefix='hooks'
+    )
+    profile.instrument(hooks, names=['execute'], prefix='hooks')
+    profile.instrument(reconciler, names=['apply'], prefix='reconciler')
+    profile.instrument(
+        ansible_hooks,
+        names=['execute', 'load_tags', 'fingerprint'],
+        prefix='ansible_hooks'
     )
+    profile.instrument(helpers)
+    profile.instrument(jobs)
+    profile.instrument(deploy)
+    profile.instrument(
+        hookenv,
+        exclude=[
+            'cached', 'charm_dir', 'flush', 'flush_log', 'hook_name',
+            'in_relation_hook', 'local_unit', 'log', 'relation_id',
+            'relation_type', 'remote_unit', 'service_name'
+        ]
+    )
+    profile.instrument(charmhelpers.contrib.ansible)
+    profile.instrument(charmhelpers.contrib.templating.contexts)
 
-    # Relation changed - re-run update target
-    update_target()
+    trace_registered_functions()
 
-    # Reset wsgi relation settings
-    wsgi_relation()
+
+def trace_registered_functions():
+    """
+    Point the registered hooks and reconcile actions at the
+    (now instrumented) functions of the same name in this module,
+    as they were registered before it was instrumented
+    """
+
+    this_module = sys.modules[__name__]
+
+    for registry in (hooks, ansible_hooks):
+        for hook_name, function in registry._hooks.items():
+            if function.__module__ == __name__:
+                registry.register(
+                    hook_name, getattr(this_module, function.__name__)
+                )
+
+    for action_name, function in reconciler.actions.items():
+        reconciler.register(
+            action_name, getattr(this_module, function.__name__)
+        )
 
 
 if __name__ == "__main__":
+    if profiler.enabled(config() or {}):
+        profile_hook(path.basename(sys.argv[0]))
+
     ansible_failed = False
 
     # Run ansible hooks first
@@ -418,3 +840,6 @@ if __name__ == "__main__":
     except UnregisteredHookError as hook_error:
         if ansible_failed:
             raise hook_error
+
+    # Apply everything the hook asked for, once
+    reconciler.apply()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+"""
+A local runner for long jobs (e.g. the make target), which runs them
+in the background, outliving the hook which submitted them
+
+Each build has its own job directory, containing:
+
+- queued.json: the next job to run (a newer submission replaces it)
+- state.json: the state of the last job run ("running", "succeeded"
+  or "failed"), its exit code and how long it took
+- output.log: the output of each job run
+- lock: held by the runner while it's running jobs for the build
+
+Only one job runs per build at a time. A job left "running" by a runner
+which died (e.g. killed, or the machine rebooted) is "interrupted",
+and can be submitted again. To check a build's job state:
+
+$ hooks/jobs.py status r2
+
+(or "status /srv/<app>/code/latest" for the build a symlink points at)
+"""
+
+# System
+import fcntl
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+from distutils.spawn import find_executable
+from os import path
+
+# Local
+from helpers import parent_dir, parse_json_file, save_to_json_file
+
+
+# Outside charm_cache, which is recreated on upgrade-charm
+# while jobs may still be running
+default_jobs_dir = path.join(parent_dir(__file__), 'charm_jobs')
+
+# States in which a build's job hasn't (yet) succeeded
+unfinished_states = ['queued', 'running', 'interrupted', 'failed']
+
+# How many times (0.1s apart) a runner tries to take a build's lock,
+# in case runner_active() is holding it for a moment
+lock_attempts = 10
+
+
+class JobNotFinishedError(Exception):
+    """
+    Raised when a build's job is still queued or running, or failed
+    """
+
+    pass
+
+
+def low_priority_command(command):
+    """
+    Wrap a command to run with the lowest CPU and I/O priority
+    """
+
+    prefix = ['nice', '-n', '19']
+
+    if find_executable('ionice'):
+        prefix.extend(['ionice', '-c', '3'])
+
+    return prefix + command
+
+
+def job_dir(jobs_dir, build_label):
+    return path.join(jobs_dir, build_label)
+
+
+def submit(
+    jobs_dir, build_label, command, cwd, env=None,
+    fingerprint=None, status_file_path=None
+):
+    """
+    Queue a command to run for a build, replacing any job
+    already queued for it, and make sure a runner is running
+
+    Once the job has finished, its result is also saved
+    to status_file_path (if provided) along with the fingerprint
+    """
+
+    build_job_dir = job_dir(jobs_dir, build_label)
+
+    if not path.isdir(build_job_dir):
+        os.makedirs(build_job_dir)
+
+    save_to_json_file(path.join(build_job_dir, 'queued.json'), {
+        'build_label': build_label,
+        'command': command,
+        'cwd': cwd,
+        'env': env,
+        'fingerprint': fingerprint,
+        'status_file_path': status_file_path,
+        'submitted': datetime.now().isoformat()
+    })
+
+    start_runner(build_job_dir)
+
+
+def start_runner(build_job_dir):
+    """
+    Start a runner for the build in its own session, so it isn't
+    stopped with the hook. If one is already running, the new
+    one will just exit, leaving the running one to pick up the job.
+    """
+
+    with open(os.devnull, 'r+') as devnull:
+        subprocess.Popen(
+            [sys.executable, path.abspath(__file__), 'run', build_job_dir],
+            stdin=devnull,
+            stdout=devnull,
+            stderr=devnull,
+            close_fds=True,
+            preexec_fn=os.setsid
+        )
+
+
+def resume(jobs_dir, build_label):
+    """
+    Start a runner for a job left queued with none running
+    (e.g. as the machine rebooted before it started)
+    """
+
+    build_job_dir = job_dir(jobs_dir, build_label)
+
+    if (
+        path.isfile(path.join(build_job_dir, 'queued.json'))
+        and not runner_active(build_job_dir)
+    ):
+        start_runner(build_job_dir)
+
+
+def runner_active(build_job_dir):
+    """
+    Whether a runner holds the build's lock
+    """
+
+    lock_path = path.join(build_job_dir, 'lock')
+
+    if not path.isfile(lock_path):
+        return False
+
+    with open(lock_path, 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return True
+
+    return False
+
+
+def build_label_for(build):
+    """
+    The build label for build, which is either a build label or the path
+    of a build directory (or of a symlink to one, like code_dir/latest)
+    """
+
+    if os.sep in build:
+        return path.basename(path.realpath(build))
+
+    return build
+
+
+def job_state(jobs_dir, build_label):
+    """
+    The state of a build's job: "queued", "running", "interrupted",
+    "succeeded", "failed", or None if no job has been submitted for it
+    """
+
+    build_job_dir = job_dir(jobs_dir, build_label)
+
+    if path.isfile(path.join(build_job_dir, 'queued.json')):
+        return 'queued'
+
+    state = parse_json_file(path.join(build_job_dir, 'state.json'))
+    state = state.get('state')
+
+    if state == 'running' and not runner_active(build_job_dir):
+        return 'interrupted'
+
+    return state
+
+
+def pending_fingerprint(jobs_dir, build_label):
+    """
+    The fingerprint of the build's queued or running job, if any
+    (a job whose runner died isn't pending)
+    """
+
+    build_job_dir = job_dir(jobs_dir, build_label)
+    queued = parse_json_file(path.join(build_job_dir, 'queued.json'))
+
+    if queued:
+        return queued.get('fingerprint')
+
+    running = parse_json_file(path.join(build_job_dir, 'running.json'))
+
+    if running and runner_active(build_job_dir):
+        return running.get('fingerprint')
+
+
+def check_finished(jobs_dir, build_label):
+    """
+    Raise JobNotFinishedError unless the build's job (if any) succeeded
+    """
+
+    state = job_state(jobs_dir, build_label)
+
+    if state in unfinished_states:
+        raise JobNotFinishedError(
+            'The job for build {0} is {1} (see {2})'.format(
+                build_label, state,
+                path.join(job_dir(jobs_dir, build_label), 'output.log')
+            )
+        )
+
+
+def run(build_job_dir):
+    """
+    Run queued jobs for a build until there are none left
+    """
+
+    queued_path = path.join(build_job_dir, 'queued.json')
+
+    while path.isfile(queued_path):
+        with open(path.join(build_job_dir, 'lock'), 'a') as lock_file:
+            if not take_lock(lock_file):
+                # Another runner has the build, and will run the job
+                return
+
+            while path.isfile(queued_path):
+                run_queued_job(build_job_dir)
+
+        # Check again now the lock is released, in case a job was
+        # queued by a runner which gave up just before that
+
+
+def take_lock(lock_file):
+    """
+    Take a build's lock, unless another runner has it
+    """
+
+    for attempt in range(lock_attempts):
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except IOError:
+            time.sleep(0.1)
+
+    return False
+
+
+def run_queued_job(build_job_dir):
+    running_path = path.join(build_job_dir, 'running.json')
+    state_path = path.join(build_job_dir, 'state.json')
+
+    os.rename(path.join(build_job_dir, 'queued.json'), running_path)
+    job = parse_json_file(running_path)
+
+    started = time.time()
+    save_to_json_file(state_path, {
+        'state': 'running',
+        'command': job['command'],
+        'started': datetime.now().isoformat()
+    })
+
+    with open(path.join(build_job_dir, 'output.log'), 'a') as output:
+        output.write('=== {0}: {1}\n'.format(
+            datetime.now().isoformat(), ' '.join(job['command'])
+        ))
+        output.flush()
+
+        try:
+            exit_code = subprocess.call(
+                job['command'],
+                cwd=job['cwd'],
+                env=job['env'],
+                stdout=output,
+                stderr=subprocess.STDOUT
+            )
+        except OSError as error:
+            output.write(str(error) + '\n')
+            exit_code = 127
+
+    result = {
+        'state': 'succeeded' if exit_code == 0 else 'failed',
+        'command': job['command'],
+        'exit_code': exit_code,
+        'duration': time.time() - started,
+        'finished': datetime.now().isoformat()
+    }
+    save_to_json_file(state_path, result)
+
+    if job.get('status_file_path'):
+        result.update(
+            fingerprint=job['fingerprint'], build_label=job['build_label']
+        )
+        save_to_json_file(job['status_file_path'], result)
+
+    os.remove(running_path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == 'run':
+        run(sys.argv[2])
+    elif len(sys.argv) == 3 and sys.argv[1] == 'status':
+        build_label = build_label_for(sys.argv[2])
+        print(job_state(default_jobs_dir, build_label) or 'none')
+    else:
+        sys.exit('Usage: {0} (run <job_dir> | status <build>)'.format(
+            sys.argv[0]
+        ))
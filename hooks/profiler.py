@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+
+"""
+Opt-in profiling of hook execution
+
+When enabled (with the "profile_hooks" config option, or the
+CHARM_PROFILE environment variable), each hook records a tree of
+timed spans: the instrumented helper functions, every subprocess
+started through "subprocess" or "sh", and each ansible task
+(reported by callback_plugins/profile_trace.py).
+
+The trace is written as JSON to charm_cache/traces/ when the hook exits.
+To see the slowest spans across the last 10 hooks:
+
+$ hooks/profiler.py summary 10
+"""
+
+# System
+import atexit
+import inspect
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from functools import wraps
+from os import path
+
+# Local
+from helpers import parent_dir
+
+
+# Tells the ansible callback plugin where to write the task timings
+ansible_trace_env_var = 'CHARM_PROFILE_ANSIBLE_TRACE'
+
+# Only the most recent traces are kept
+max_traces = 100
+
+default_trace_dir = path.join(parent_dir(__file__), 'charm_cache', 'traces')
+
+# The active profiler, if profiling is enabled
+current = None
+
+
+class Profiler(object):
+    """
+    Record a tree of timed spans for a single hook
+    """
+
+    def __init__(self, hook_name, trace_dir):
+        self.hook_name = hook_name
+        self.trace_dir = trace_dir
+        self.started = time.time()
+        self.root = {
+            'name': hook_name, 'start': 0, 'duration': None, 'children': []
+        }
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.main_stack = self.stack()
+
+    def stack(self):
+        """
+        The open spans in this thread. Spans opened in other threads
+        are added below the span open in the main thread.
+        """
+
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+
+        return self.local.stack
+
+    def open_span(self, name):
+        span = {
+            'name': name,
+            'start': time.time() - self.started,
+            'duration': None,
+            'children': []
+        }
+
+        stack = self.stack()
+        parent = (stack or self.main_stack or [self.root])[-1]
+
+        with self.lock:
+            parent['children'].append(span)
+
+        stack.append(span)
+
+        return span
+
+    def close_span(self, span):
+        span['duration'] = time.time() - self.started - span['start']
+        self.stack().pop()
+
+    def traced(self, name, function):
+        """
+        Wrap a function so each call is recorded as a span
+        """
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            span = self.open_span(name)
+
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.close_span(span)
+
+        wrapper.profiler_traced = True
+
+        return wrapper
+
+    def traced_subprocess(self, function):
+        """
+        Wrap a subprocess function, adding any ansible task timings
+        the process reports below its span
+        """
+
+        @wraps(function)
+        def wrapper(command, *args, **kwargs):
+            if isinstance(command, basestring):
+                name = command
+            else:
+                name = ' '.join(str(part) for part in command)
+
+            span = self.open_span('subprocess: ' + name)
+
+            try:
+                return function(command, *args, **kwargs)
+            finally:
+                self.add_ansible_tasks(span)
+                self.close_span(span)
+
+        wrapper.profiler_traced = True
+
+        return wrapper
+
+    def add_ansible_tasks(self, span):
+        trace_path = os.environ.get(ansible_trace_env_var)
+
+        if not trace_path or not path.isfile(trace_path):
+            return
+
+        with open(trace_path) as trace_file:
+            tasks = json.load(trace_file)
+
+        os.remove(trace_path)
+
+        for task in tasks:
+            span['children'].append({
+                'name': 'ansible task: ' + task['name'],
+                'start': task['start'] - self.started,
+                'duration': task['duration'],
+                'children': []
+            })
+
+    def instrument(self, target, names=None, prefix=None, exclude=()):
+        """
+        Record a span for each call of the named functions of target
+        (a module or an object). Without names, all the functions
+        defined in a module are instrumented.
+        """
+
+        prefix = prefix or getattr(target, '__name__', '')
+
+        if names is None:
+            names = [
+                name for name, value in vars(target).items()
+                if inspect.isfunction(value)
+                and value.__module__ == target.__name__
+            ]
+
+        for name in names:
+            function = getattr(target, name)
+
+            if name in exclude or getattr(function, 'profiler_traced', False):
+                continue
+
+            setattr(
+                target, name, self.traced(prefix + '.' + name, function)
+            )
+
+    def instrument_subprocesses(self):
+        """
+        Record a span for every process run through subprocess or sh
+        """
+
+        for name in ('call', 'check_call', 'check_output'):
+            function = getattr(subprocess, name)
+
+            if not getattr(function, 'profiler_traced', False):
+                setattr(subprocess, name, self.traced_subprocess(function))
+
+        import sh
+
+        command_call = sh.Command.__call__
+
+        if not getattr(command_call, 'profiler_traced', False):
+            profiler = self
+
+            def traced_command_call(command, *args, **kwargs):
+                name = 'sh: ' + ' '.join(
+                    [command._path] + [str(arg) for arg in args]
+                )
+                span = profiler.open_span(name)
+
+                try:
+                    return command_call(command, *args, **kwargs)
+                finally:
+                    profiler.close_span(span)
+
+            traced_command_call.profiler_traced = True
+            sh.Command.__call__ = traced_command_call
+
+    def save(self):
+        """
+        Write the trace, and remove old ones
+        """
+
+        self.root['duration'] = time.time() - self.started
+
+        if not path.isdir(self.trace_dir):
+            os.makedirs(self.trace_dir)
+
+        trace_name = '{0}-{1}.json'.format(
+            datetime.fromtimestamp(self.started).strftime('%Y%m%d%H%M%S%f'),
+            self.hook_name
+        )
+
+        with open(path.join(self.trace_dir, trace_name), 'w') as trace_file:
+            json.dump(self.root, trace_file)
+
+        for old_trace in trace_paths(self.trace_dir)[:-max_traces]:
+            os.remove(old_trace)
+
+
+def enabled(config_data):
+    """
+    Whether profiling has been asked for
+    """
+
+    return bool(
+        os.environ.get('CHARM_PROFILE') or config_data.get('profile_hooks')
+    )
+
+
+def start(hook_name, trace_dir=default_trace_dir):
+    """
+    Start profiling this hook, saving the trace when it exits
+    """
+
+    global current
+
+    current = Profiler(hook_name, trace_dir)
+    current.instrument_subprocesses()
+
+    os.environ[ansible_trace_env_var] = path.join(
+        trace_dir, '.ansible-{0}.json'.format(os.getpid())
+    )
+
+    atexit.register(current.save)
+
+    return current
+
+
+def trace_paths(trace_dir):
+    """
+    Trace files, oldest first
+    """
+
+    if not path.isdir(trace_dir):
+        return []
+
+    return sorted(
+        path.join(trace_dir, name) for name in os.listdir(trace_dir)
+        if name.endswith('.json') and not name.startswith('.')
+    )
+
+
+def iterate_spans(span):
+    yield span
+
+    for child in span['children']:
+        for descendant in iterate_spans(child):
+            yield descendant
+
+
+def summarise(trace_dir, hook_count=10, span_count=20):
+    """
+    The slowest spans in the last hook_count traces,
+    as (name, calls, total seconds, max seconds) sorted by total time
+    """
+
+    totals = {}
+
+    for trace_path in trace_paths(trace_dir)[-hook_count:]:
+        with open(trace_path) as trace_file:
+            root = json.load(trace_file)
+
+        for span in iterate_spans(root):
+            duration = span['duration'] or 0
+            calls, total, longest = totals.get(span['name'], (0, 0, 0))
+            totals[span['name']] = (
+                calls + 1, total + duration, max(longest, duration)
+            )
+
+    spans = [(name,) + figures for name, figures in totals.items()]
+    spans.sort(key=lambda span: span[2], reverse=True)
+
+    return spans[:span_count]
+
+
+def print_summary(trace_dir, hook_count):
+    print('Slowest spans across the last {0} hook(s):'.format(hook_count))
+    print('{0:>10} {1:>10} {2:>6}  {3}'.format(
+        'total (s)', 'max (s)', 'calls', 'span'
+    ))
+
+    for name, calls, total, longest in summarise(trace_dir, hook_count):
+        print('{0:>10.3f} {1:>10.3f} {2:>6}  {3}'.format(
+            total, longest, calls, name
+        ))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != 'summary':
+        sys.exit('Usage: {0} summary [hook_count] [trace_dir]'.format(
+            sys.argv[0]
+        ))
+
+    print_summary(
+        sys.argv[3] if len(sys.argv) > 3 else default_trace_dir,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    )
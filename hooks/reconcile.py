@@ -0,0 +1,89 @@
+# System
+from collections import OrderedDict
+
+# Local
+from helpers import EnvStore
+
+
+class Reconciler(object):
+    """
+    Collect everything a hook wants to change
+    (environment variables, relation settings, make targets)
+    and apply the result exactly once when the hook has finished
+
+    Hook functions only describe the state they want:
+
+    > reconciler.set_env('DATABASE_URL', 'postgresql://db')
+    > reconciler.request('update-target')
+    > reconciler.request('wsgi-settings')
+
+    and reconciler.apply() then saves the environment once
+    and runs each requested action once, in registration order,
+    no matter how many hook functions asked for it.
+    """
+
+    def __init__(self, env_file_path):
+        self.env_store = EnvStore(env_file_path)
+        self.actions = OrderedDict()
+        self.reset()
+
+    def reset(self):
+        """
+        Forget all requested actions
+        """
+
+        self.requested = set()
+
+    def register(self, name, function):
+        """
+        Register an action to run when apply() is called,
+        if it has been requested
+        """
+
+        self.actions[name] = function
+
+    def request(self, name):
+        """
+        Ask for a registered action to be run once on apply()
+        """
+
+        if name not in self.actions:
+            raise KeyError('Unknown action: ' + name)
+
+        self.requested.add(name)
+
+    def set_env(self, key, value):
+        """
+        Set an environment variable,
+        returning whether that changes its value
+        """
+
+        changed = self.env_store.get(key) != value
+        self.env_store.set(key, value)
+
+        return changed
+
+    def unset_env(self, key):
+        self.env_store.unset(key)
+
+    def env(self):
+        """
+        The environment variables as they will be once applied
+        """
+
+        return self.env_store.as_dict()
+
+    def apply(self):
+        """
+        Save the environment (if it changed)
+        then run each requested action once
+        """
+
+        self.env_store.commit()
+
+        requested = self.requested
+        self.reset()
+
+        for name, function in self.actions.items():
+            if name in requested:
+                function()
@@ -0,0 +1,175 @@
+import imp
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+    import mock
+except ImportError:
+    raise ImportError(
+        "Please ensure both python-mock and python-nose are installed.")
+
+
+import charmhelpers.contrib.ansible as ansible_helpers
+
+
+class TagIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(TagIndexTestCase, self).setUp()
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+
+        self.playbook_path = os.path.join(self.temp_dir, 'playbook.yml')
+        self.role_path = os.path.join(
+            self.temp_dir, 'roles', 'wsgi-app', 'tasks', 'main.yml')
+        os.makedirs(os.path.dirname(self.role_path))
+
+        for file_path in (self.playbook_path, self.role_path):
+            with open(file_path, 'w') as playbook_file:
+                playbook_file.write('---\n')
+
+        patcher = mock.patch.object(
+            ansible_helpers, 'get_tags_for_playbook',
+            return_value=['config-changed', 'install'])
+        self.get_tags = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_writes_index(self):
+        tags = ansible_helpers.load_tag_index(self.playbook_path)
+
+        self.assertEqual(set(['config-changed', 'install']), tags)
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.temp_dir, ansible_helpers.tag_index_file_name)))
+
+    def test_reuses_index_while_playbook_unchanged(self):
+        ansible_helpers.load_tag_index(self.playbook_path)
+        tags = ansible_helpers.load_tag_index(self.playbook_path)
+
+        self.assertEqual(1, self.get_tags.call_count)
+        self.assertEqual(set(['config-changed', 'install']), tags)
+
+    def test_rebuilds_index_after_roles_change(self):
+        ansible_helpers.load_tag_index(self.playbook_path)
+
+        with open(self.role_path, 'a') as role_file:
+            role_file.write('- name: Another task\n')
+
+        ansible_helpers.load_tag_index(self.playbook_path)
+
+        self.assertEqual(2, self.get_tags.call_count)
+
+    def test_module_does_not_import_ansible(self):
+        blocked = dict.fromkeys([
+            'ansible', 'ansible.callbacks', 'ansible.playbook',
+            'ansible.utils'
+        ])
+
+        with mock.patch.dict(sys.modules, blocked):
+            imp.load_source(
+                'ansible_helpers_copy', ansible_helpers.__file__.rstrip('c'))
+            ansible_helpers.AnsibleHooks(self.playbook_path)
+
+
+class PlaybookRunTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(PlaybookRunTestCase, self).setUp()
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+
+        self.playbook_path = os.path.join(self.temp_dir, 'playbook.yml')
+        with open(self.playbook_path, 'w') as playbook_file:
+            playbook_file.write('---\n')
+
+        self.vars_path = os.path.join(self.temp_dir, 'localhost')
+        self.write_vars('build_label: r1\n')
+
+        self.archive_path = os.path.join(self.temp_dir, 'r1.tar.gz')
+        open(self.archive_path, 'w').close()
+
+        for name, value in [
+            ('ansible_vars_path', self.vars_path),
+            ('available_tags', set()),
+            ('apply_playbook', mock.Mock()),
+            ('write_host_vars', mock.Mock()),
+            ('load_tag_index', mock.Mock(
+                return_value=set(['config-changed', 'install'])))
+        ]:
+            patcher = mock.patch.object(ansible_helpers, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        patcher = mock.patch('charmhelpers.core.hookenv.log')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch.dict(os.environ)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        os.environ.pop(ansible_helpers.force_playbook_env_var, None)
+
+        self.hooks = ansible_helpers.AnsibleHooks(
+            self.playbook_path,
+            always_run=['install'],
+            fingerprint_paths=lambda: [self.archive_path]
+        )
+
+    def write_vars(self, host_vars):
+        with open(self.vars_path, 'w') as vars_file:
+            vars_file.write(host_vars)
+
+    def run_count(self, *hook_names):
+        for hook_name in hook_names:
+            self.hooks.execute([hook_name])
+
+        return ansible_helpers.apply_playbook.call_count
+
+    def test_skips_unchanged_run(self):
+        self.assertEqual(1, self.run_count('config-changed', 'config-changed'))
+
+    def test_runs_when_host_vars_change(self):
+        self.run_count('config-changed')
+        self.write_vars('build_label: r2\n')
+
+        self.assertEqual(2, self.run_count('config-changed'))
+
+    def test_runs_when_fingerprint_path_is_missing(self):
+        self.run_count('config-changed')
+        os.remove(self.archive_path)
+
+        self.assertEqual(2, self.run_count('config-changed'))
+
+    def test_runs_when_fingerprint_symlink_is_repointed(self):
+        for name in ('r2.tar.gz', 'r3.tar.gz'):
+            open(os.path.join(self.temp_dir, name), 'w').close()
+        link_path = os.path.join(self.temp_dir, 'latest')
+        os.symlink('r2.tar.gz', link_path)
+        self.hooks.fingerprint_paths = lambda: [link_path]
+
+        self.run_count('config-changed')
+        os.remove(link_path)
+        os.symlink('r3.tar.gz', link_path)
+
+        self.assertEqual(2, self.run_count('config-changed'))
+
+    def test_always_run(self):
+        self.assertEqual(2, self.run_count('install', 'install'))
+
+    def test_force_playbook(self):
+        self.run_count('config-changed')
+        os.environ[ansible_helpers.force_playbook_env_var] = '1'
+
+        self.assertEqual(2, self.run_count('config-changed'))
+
+    def test_failed_run_is_not_recorded(self):
+        ansible_helpers.apply_playbook.side_effect = Exception('failed')
+
+        self.assertRaises(
+            Exception, self.hooks.execute, ['config-changed'])
+        self.assertEqual({}, self.hooks.playbook_runs())
+        self.assertTrue(self.hooks.playbook_run_needed('config-changed'))
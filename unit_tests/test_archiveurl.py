@@ -0,0 +1,185 @@
+import BaseHTTPServer
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+try:
+    import mock
+except ImportError:
+    raise ImportError(
+        "Please ensure both python-mock and python-nose are installed.")
+
+
+from charmhelpers.fetch import archiveurl
+
+
+class ArchiveRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serve the server's payload with the server's etag, honouring Range
+    requests (unless If-Range doesn't match the etag), and dropping the
+    connection after the server's drop_after bytes (once per entry)
+    """
+
+    def do_GET(self):
+        payload = self.server.payload
+        start = 0
+        range_header = self.headers.getheader('Range')
+        if_range = self.headers.getheader('If-Range')
+        self.server.ranges.append(range_header)
+
+        if if_range and if_range != self.server.etag:
+            range_header = None
+
+        if range_header:
+            start = int(range_header.split('=')[1].rstrip('-'))
+
+            if start >= len(payload):
+                self.send_response(416)
+                self.send_header(
+                    'Content-Range', 'bytes */{0}'.format(len(payload)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, len(payload) - 1, len(payload)))
+        else:
+            self.send_response(200)
+
+        if self.server.etag:
+            self.send_header('ETag', self.server.etag)
+        self.send_header('Content-Length', str(len(payload) - start))
+        self.end_headers()
+
+        body = payload[start:]
+
+        if self.server.drop_after:
+            body = body[:self.server.drop_after.pop(0)]
+
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ArchiveUrlFetchHandlerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(ArchiveUrlFetchHandlerTestCase, self).setUp()
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.dest = os.path.join(self.temp_dir, 'code.tar.gz')
+
+        self.server = BaseHTTPServer.HTTPServer(
+            ('127.0.0.1', 0), ArchiveRequestHandler)
+        self.server.payload = os.urandom(300 * 1024)
+        self.server.drop_after = []
+        self.server.ranges = []
+        self.server.etag = '"v1"'
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.url = 'http://127.0.0.1:{0}/code.tar.gz'.format(
+            self.server.server_port)
+        self.handler = archiveurl.ArchiveUrlFetchHandler()
+
+        patcher = mock.patch('charmhelpers.fetch.archiveurl.log')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def downloaded(self):
+        with open(self.dest, 'rb') as dest_file:
+            return dest_file.read()
+
+    def test_download(self):
+        self.handler.download(self.url, self.dest)
+
+        self.assertEqual(self.server.payload, self.downloaded())
+        self.assertEqual([self.dest], [
+            os.path.join(self.temp_dir, name)
+            for name in os.listdir(self.temp_dir)
+        ])
+
+    def test_resumes_interrupted_download(self):
+        self.server.drop_after = [100 * 1024]
+
+        self.handler.download(self.url, self.dest)
+
+        self.assertEqual(self.server.payload, self.downloaded())
+        self.assertEqual([None, 'bytes=102400-'], self.server.ranges)
+
+    def test_resumes_in_a_later_call(self):
+        self.server.drop_after = [100 * 1024]
+
+        self.assertRaises(
+            Exception, self.handler.download, self.url, self.dest, retries=0)
+        self.assertFalse(os.path.exists(self.dest))
+
+        self.handler.download(self.url, self.dest)
+
+        self.assertEqual(self.server.payload, self.downloaded())
+
+    def test_verifies_checksum(self):
+        self.handler.download(
+            self.url, self.dest,
+            checksum=hashlib.sha256(self.server.payload).hexdigest(),
+            hash_type='sha256')
+
+        self.assertEqual(self.server.payload, self.downloaded())
+
+    def test_bad_checksum(self):
+        self.assertRaises(
+            archiveurl.ChecksumError,
+            self.handler.download, self.url, self.dest, checksum='0' * 40)
+
+        self.assertEqual([], os.listdir(self.temp_dir))
+
+    def test_restarts_if_source_changed_since_earlier_call(self):
+        self.server.drop_after = [100 * 1024]
+        self.assertRaises(
+            Exception, self.handler.download, self.url, self.dest, retries=0)
+
+        self.server.payload = os.urandom(300 * 1024)
+        self.server.etag = '"v2"'
+        self.handler.download(self.url, self.dest)
+
+        self.assertEqual(self.server.payload, self.downloaded())
+
+    def test_restarts_part_without_validator_from_earlier_call(self):
+        self.server.etag = None
+        self.server.drop_after = [100 * 1024]
+        self.assertRaises(
+            Exception, self.handler.download, self.url, self.dest, retries=0)
+
+        self.handler.download(self.url, self.dest)
+
+        self.assertEqual(self.server.payload, self.downloaded())
+        self.assertEqual([None, None], self.server.ranges)
+
+    def test_resumes_without_validator_within_a_call(self):
+        self.server.etag = None
+        self.server.drop_after = [100 * 1024]
+
+        self.handler.download(self.url, self.dest)
+
+        self.assertEqual(self.server.payload, self.downloaded())
+        self.assertEqual([None, 'bytes=102400-'], self.server.ranges)
+
+    def test_restarts_part_longer_than_source(self):
+        with open(self.dest + '.part', 'wb') as part_file:
+            part_file.write(os.urandom(400 * 1024))
+        with open(self.dest + '.part.validator', 'w') as validator_file:
+            validator_file.write('"v1"')
+
+        self.handler.download(self.url, self.dest)
+
+        self.assertEqual(self.server.payload, self.downloaded())
+        self.assertEqual(['bytes=409600-', None], self.server.ranges)
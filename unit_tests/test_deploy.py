@@ -0,0 +1,573 @@
+import BaseHTTPServer
+import json
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import unittest
+from distutils.spawn import find_executable
+
+try:
+    import mock
+except ImportError:
+    raise ImportError(
+        "Please ensure both python-mock and python-nose are installed.")
+
+
+import deploy
+from charmhelpers.payload import archive
+from helpers import parse_json_file
+
+
+class ArtifactRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serve the server's payload with an ETag,
+    answering matching conditional requests with 304
+    """
+
+    def do_GET(self):
+        etag = '"{0}"'.format(hash(self.server.payload))
+        self.server.requests.append(self.headers.getheader('If-None-Match'))
+
+        if self.headers.getheader('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(self.server.payload)))
+        self.end_headers()
+        self.wfile.write(self.server.payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(FetchTestCase, self).setUp()
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.cache_dir = os.path.join(self.temp_dir, '.cache')
+        for build_label in ('r1', 'r2'):
+            os.mkdir(os.path.join(self.temp_dir, build_label))
+
+        self.server = BaseHTTPServer.HTTPServer(
+            ('127.0.0.1', 0), ArtifactRequestHandler)
+        self.server.payload = 'code archive r1'
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def url(self, build_label):
+        return 'http://127.0.0.1:{0}/{1}/code.tgz'.format(
+            self.server.server_port, build_label)
+
+    def fetch(self, build_label):
+        dest = os.path.join(self.temp_dir, build_label, 'code.tgz')
+        changed = deploy.fetch(self.url(build_label), dest, self.cache_dir)
+
+        with open(dest) as dest_file:
+            return changed, dest_file.read()
+
+    def test_revalidates_unchanged_archive(self):
+        self.assertEqual((True, 'code archive r1'), self.fetch('r1'))
+        self.assertEqual((False, 'code archive r1'), self.fetch('r1'))
+
+        # The first fetch downloads after its (unconditional) request
+        self.assertEqual(3, len(self.server.requests))
+        self.assertIsNone(self.server.requests[0])
+        self.assertIsNotNone(self.server.requests[2])
+
+    def test_checks_sha256(self):
+        from charmhelpers.fetch.archiveurl import ChecksumError
+
+        dest = os.path.join(self.temp_dir, 'r1', 'code.tgz')
+
+        self.assertRaises(
+            ChecksumError,
+            deploy.fetch, self.url('r1'), dest, self.cache_dir, '0' * 64)
+        self.assertFalse(os.path.exists(dest))
+
+    def test_refreshes_rebuilt_archive(self):
+        self.fetch('r1')
+        self.server.payload = 'code archive r1, rebuilt'
+
+        self.assertEqual(
+            (True, 'code archive r1, rebuilt'), self.fetch('r1'))
+
+    def test_links_identical_archives(self):
+        self.fetch('r1')
+        self.fetch('r2')
+
+        self.assertTrue(os.path.samefile(
+            os.path.join(self.temp_dir, 'r1', 'code.tgz'),
+            os.path.join(self.temp_dir, 'r2', 'code.tgz')
+        ))
+        self.assertEqual(
+            1, len(os.listdir(os.path.join(self.cache_dir, 'objects'))))
+
+    def test_refetches_missing_cache_object(self):
+        self.fetch('r1')
+        shutil.rmtree(os.path.join(self.cache_dir, 'objects'))
+
+        self.assertEqual((False, 'code archive r1'), self.fetch('r1'))
+        self.assertIsNone(self.server.requests[1])
+
+
+class ExtractTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(ExtractTestCase, self).setUp()
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.dest = os.path.join(self.temp_dir, 'r1')
+
+        for target in ('charmhelpers.payload.archive.hookenv', 'deploy.log'):
+            patcher = mock.patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def make_archive(self, name, mode, files=None):
+        source_dir = tempfile.mkdtemp(dir=self.temp_dir)
+        files = files or {'app/wsgi.py': 'application = None\n'}
+
+        for file_name, content in files.items():
+            file_path = os.path.join(source_dir, file_name)
+
+            if not os.path.isdir(os.path.dirname(file_path)):
+                os.makedirs(os.path.dirname(file_path))
+
+            with open(file_path, 'w') as source_file:
+                source_file.write(content)
+
+        archive_path = os.path.join(self.temp_dir, name)
+        archive_file = tarfile.open(archive_path, mode)
+        archive_file.add(os.path.join(source_dir, 'app'), 'app')
+        archive_file.close()
+
+        return archive_path
+
+    def extracted(self):
+        with open(os.path.join(self.dest, 'app', 'wsgi.py')) as wsgi:
+            return wsgi.read()
+
+    def test_extracts_with_tarfile(self):
+        archive_path = self.make_archive('code.tar.bz2', 'w:bz2')
+
+        with mock.patch(
+            'charmhelpers.payload.archive.find_executable', return_value=None
+        ):
+            stats = deploy.extract(archive_path, self.dest)
+
+        self.assertEqual('tarfile', stats['method'])
+        self.assertEqual('application = None\n', self.extracted())
+
+    def test_extracts_with_parallel_decompressor(self):
+        archive_path = self.make_archive('code.tar.gz', 'w:gz')
+
+        # gzip stands in for pigz, which may not be installed
+        with mock.patch.dict(
+            'charmhelpers.payload.archive.PARALLEL_DECOMPRESSORS',
+            {'gz': (['gzip', '-d', '-c'],)}
+        ):
+            stats = deploy.extract(archive_path, self.dest, workers=2)
+
+        self.assertEqual('gzip', stats['method'])
+        self.assertEqual('application = None\n', self.extracted())
+
+    def test_detects_compression(self):
+        archive_path = self.make_archive('code', 'w:bz2')
+
+        self.assertEqual('bz2', archive.detect_compression(archive_path))
+
+    def test_reuses_unchanged_files_from_previous_build(self):
+        r1 = self.make_archive('r1.tar.gz', 'w:gz', {
+            'app/wsgi.py': 'application = None\n',
+            'app/static/site.css': 'body {}\n'
+        })
+        r2 = self.make_archive('r2.tar.gz', 'w:gz', {
+            'app/wsgi.py': 'application = 2\n',
+            'app/static/site.css': 'body {}\n'
+        })
+        r2_dest = os.path.join(self.temp_dir, 'r2')
+
+        deploy.extract(r1, self.dest)
+        stats = deploy.extract(r2, r2_dest, previous_build=self.dest)
+
+        self.assertTrue(os.path.samefile(
+            os.path.join(self.dest, 'app', 'static', 'site.css'),
+            os.path.join(r2_dest, 'app', 'static', 'site.css')
+        ))
+        self.assertFalse(os.path.samefile(
+            os.path.join(self.dest, 'app', 'wsgi.py'),
+            os.path.join(r2_dest, 'app', 'wsgi.py')
+        ))
+        self.assertEqual('application = None\n', self.extracted())
+        self.assertEqual((2, 1), (stats['files'], stats['reused_files']))
+        self.assertAlmostEqual(8.0 / (8 + 16), stats['reuse_ratio'])
+
+        manifest = deploy.load_manifest(r2_dest)
+        self.assertEqual(
+            ['app/static/site.css', 'app/wsgi.py'], sorted(manifest))
+
+    def test_does_not_link_files_changed_in_place(self):
+        files = {'app/wsgi.py': 'application = None\n'}
+        r2_dest = os.path.join(self.temp_dir, 'r2')
+
+        deploy.extract(
+            self.make_archive('r1.tar.gz', 'w:gz', files), self.dest)
+        with open(os.path.join(self.dest, 'app', 'wsgi.py'), 'w') as wsgi:
+            wsgi.write('application = 1\n')
+
+        stats = deploy.extract(
+            self.make_archive('r2.tar.gz', 'w:gz', files), r2_dest,
+            previous_build=self.dest)
+
+        self.assertEqual(0, stats['reused_files'])
+        with open(os.path.join(r2_dest, 'app', 'wsgi.py')) as wsgi:
+            self.assertEqual('application = None\n', wsgi.read())
+
+    def test_refuses_paths_through_symlinks(self):
+        archive_path = os.path.join(self.temp_dir, 'evil.tar')
+        archive_file = tarfile.open(archive_path, 'w')
+        link = tarfile.TarInfo('link')
+        link.type = tarfile.SYMTYPE
+        link.linkname = self.temp_dir
+        archive_file.addfile(link)
+        archive_file.addfile(tarfile.TarInfo('link/evil.py'))
+        archive_file.close()
+
+        self.assertRaises(
+            archive.ArchiveError, deploy.extract, archive_path, self.dest)
+        self.assertFalse(
+            os.path.exists(os.path.join(self.temp_dir, 'evil.py')))
+
+    def test_refuses_paths_outside_dest(self):
+        archive_path = os.path.join(self.temp_dir, 'evil.tar')
+        archive_file = tarfile.open(archive_path, 'w')
+        member = tarfile.TarInfo('../evil.py')
+        archive_file.addfile(member)
+        archive_file.close()
+
+        self.assertRaises(
+            archive.ArchiveError, deploy.extract, archive_path, self.dest)
+
+    def test_extracts_archive_with_root_entry(self):
+        source_dir = tempfile.mkdtemp(dir=self.temp_dir)
+        os.mkdir(os.path.join(source_dir, 'pkg'))
+        open(os.path.join(source_dir, 'pkg', 'a.py'), 'w').close()
+
+        # As made by "tar -C source_dir -c ."
+        archive_path = os.path.join(self.temp_dir, 'code.tar.bz2')
+        archive_file = tarfile.open(archive_path, 'w:bz2')
+        archive_file.add(source_dir, '.')
+        archive_file.close()
+
+        stats = deploy.extract(archive_path, self.dest)
+
+        self.assertEqual(1, stats['files'])
+        self.assertTrue(
+            os.path.isfile(os.path.join(self.dest, 'pkg', 'a.py')))
+        self.assertEqual(
+            ['pkg/a.py'], list(deploy.load_manifest(self.dest)))
+
+    def test_refuses_root_entry_which_is_not_a_directory(self):
+        archive_path = os.path.join(self.temp_dir, 'evil.tar')
+        archive_file = tarfile.open(archive_path, 'w')
+        archive_file.addfile(tarfile.TarInfo('.'))
+        archive_file.close()
+
+        self.assertRaises(
+            archive.ArchiveError, deploy.extract, archive_path, self.dest)
+
+    def test_sets_ownership_as_files_are_written(self):
+        archive_path = self.make_archive('code.tar.gz', 'w:gz')
+
+        with mock.patch('os.lchown') as lchown, \
+                mock.patch('os.fchown') as fchown, \
+                mock.patch('deploy.ownership_ids', return_value=(1500, 1501)):
+            deploy.extract(
+                archive_path, self.dest, owner='wsgi', group='wsgi')
+
+        # (As it's extracted, before it's moved into place)
+        self.assertEqual((1500, 1501), fchown.call_args[0][1:])
+        self.assertEqual([(1500, 1501)], [
+            args[1:] for args, kwargs in lchown.call_args_list
+            if os.path.basename(args[0]) == 'app'
+        ])
+
+    def test_extracting_again_replaces_the_build(self):
+        deploy.extract(
+            self.make_archive('r1.tar.gz', 'w:gz', {
+                'app/wsgi.py': 'application = None\n',
+                'app/removed.py': ''
+            }),
+            self.dest
+        )
+        archive_path = self.make_archive('r1-rebuilt.tar.gz', 'w:gz', {
+            'app/wsgi.py': 'application = 1\n'
+        })
+        deploy.extract(archive_path, self.dest)
+
+        self.assertEqual('application = 1\n', self.extracted())
+        self.assertFalse(
+            os.path.exists(os.path.join(self.dest, 'app', 'removed.py')))
+        self.assertEqual(['r1'], [
+            name for name in os.listdir(self.temp_dir)
+            if not name.startswith('tmp') and not name.endswith('.tar.gz')
+        ])
+        self.assertEqual(
+            deploy.file_sha256(archive_path), deploy.archive_digest(self.dest))
+
+
+class StageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(StageTestCase, self).setUp()
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.code_dir = os.path.join(self.temp_dir, 'code')
+        self.build_dir = os.path.join(self.code_dir, 'r2')
+
+        for target in ('charmhelpers.payload.archive.hookenv', 'deploy.log'):
+            patcher = mock.patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        source_dir = os.path.join(self.temp_dir, 'source')
+        os.mkdir(source_dir)
+
+        with open(os.path.join(source_dir, 'Makefile'), 'w') as makefile:
+            makefile.write('update:\n\ttouch updated\n')
+
+        self.charm_archive_path = os.path.join(self.temp_dir, 'r2.tar.gz')
+        archive_file = tarfile.open(self.charm_archive_path, 'w:gz')
+        archive_file.add(os.path.join(source_dir, 'Makefile'), 'Makefile')
+        archive_file.close()
+
+    def spec(self):
+        return {
+            'build_dir': self.build_dir,
+            'archive_path': os.path.join(
+                self.code_dir, 'archives', 'r2', 'r2.tar.gz'),
+            'charm_archive_path': self.charm_archive_path,
+            'make_target': 'update',
+            'fingerprint': 'abc'
+        }
+
+    def test_stage_marks_build_ready(self):
+        self.assertFalse(deploy.build_ready(self.build_dir))
+
+        durations = deploy.stage(self.spec())
+
+        self.assertTrue(deploy.build_ready(self.build_dir))
+        self.assertTrue(
+            os.path.isfile(os.path.join(self.build_dir, 'updated')))
+        self.assertEqual(
+            ['compile', 'extract', 'fetch', 'make_target'], sorted(durations))
+
+    def test_stage_does_not_reuse_files_from_itself(self):
+        # current -> latest -> the build being staged
+        os.makedirs(self.build_dir)
+        os.symlink(self.build_dir, os.path.join(self.code_dir, 'latest'))
+        os.symlink(
+            os.path.join(self.code_dir, 'latest'),
+            os.path.join(self.code_dir, 'current'))
+        spec = self.spec()
+        spec['previous'] = os.path.join(self.code_dir, 'current')
+        spec['make_target'] = None
+
+        with mock.patch('deploy.extract') as extract:
+            deploy.stage(spec)
+
+        self.assertIsNone(extract.call_args[0][3])
+
+    def test_failed_stage_is_not_ready(self):
+        spec = self.spec()
+        spec['make_target'] = 'missing-target'
+
+        self.assertRaises(Exception, deploy.stage, spec)
+        self.assertFalse(deploy.build_ready(self.build_dir))
+
+    def test_extracted_builds_from_before_staging_are_ready(self):
+        os.makedirs(self.build_dir)
+        open(os.path.join(self.build_dir, 'EXTRACTED'), 'w').close()
+
+        self.assertTrue(deploy.build_ready(self.build_dir))
+
+
+class SwitchSymlinkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(SwitchSymlinkTestCase, self).setUp()
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.code_dir = os.path.join(self.temp_dir, 'code')
+        self.build_dir = os.path.join(self.code_dir, 'r2')
+
+        patcher = mock.patch('deploy.log')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_switch_symlink(self):
+        link_path = os.path.join(self.temp_dir, 'current')
+        os.symlink(self.code_dir, link_path)
+
+        swap = deploy.switch_symlink(link_path, self.build_dir)
+
+        self.assertEqual(self.build_dir, os.readlink(link_path))
+        self.assertEqual(self.code_dir, os.readlink(link_path + '.previous'))
+        self.assertEqual(
+            ['.deploy', 'current', 'current.previous'],
+            sorted(os.listdir(self.temp_dir))
+        )
+
+        swaps_log_path = os.path.join(self.temp_dir, '.deploy', 'swaps.log')
+
+        with open(swaps_log_path) as swaps_log:
+            self.assertEqual([swap], [json.loads(line) for line in swaps_log])
+
+        self.assertEqual(self.code_dir, swap['previous'])
+        self.assertIsNone(deploy.switch_symlink(link_path, self.build_dir))
+
+    def test_rollback_symlink(self):
+        link_path = os.path.join(self.temp_dir, 'current')
+        os.symlink(self.code_dir, link_path)
+        deploy.switch_symlink(link_path, self.build_dir)
+
+        deploy.rollback_symlink(link_path)
+
+        self.assertEqual(self.code_dir, os.readlink(link_path))
+        self.assertEqual(self.build_dir, os.readlink(link_path + '.previous'))
+
+        deploy.rollback_symlink(link_path)
+
+        self.assertEqual(self.build_dir, os.readlink(link_path))
+
+    def test_rollback_without_previous_target(self):
+        link_path = os.path.join(self.temp_dir, 'current')
+        os.symlink(self.code_dir, link_path)
+
+        self.assertRaises(OSError, deploy.rollback_symlink, link_path)
+        self.assertEqual(self.code_dir, os.readlink(link_path))
+
+
+class CompileBuildTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(CompileBuildTestCase, self).setUp()
+
+        self.build_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.build_dir)
+        os.mkdir(os.path.join(self.build_dir, 'app'))
+
+        for name, source in [
+            ('app/__init__.py', ''),
+            ('app/wsgi.py', 'application = None\n'),
+            ('app/broken.py', 'def (\n')
+        ]:
+            with open(os.path.join(self.build_dir, name), 'w') as module:
+                module.write(source)
+
+        patcher = mock.patch('deploy.log')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def compile_build(self, python=sys.executable):
+        return deploy.compile_build(self.build_dir, workers=2, python=python)
+
+    def test_compiles_modules(self):
+        stats = self.compile_build()
+
+        self.assertEqual(3, stats['modules'])
+        self.assertEqual(2, stats['compiled'])
+        self.assertEqual(['app/broken.py'], list(stats['failed']))
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.build_dir, 'app', 'wsgi.pyc')))
+        self.assertEqual(
+            2,
+            parse_json_file(os.path.join(
+                self.build_dir, '.deploy', 'compile.json'))['compiled']
+        )
+
+    def test_records_unreadable_modules(self):
+        os.symlink(
+            os.path.join(self.build_dir, 'missing.py'),
+            os.path.join(self.build_dir, 'app', 'dangling.py'))
+
+        stats = self.compile_build()
+
+        self.assertEqual(
+            ['app/broken.py', 'app/dangling.py'], sorted(stats['failed']))
+        self.assertEqual(2, stats['compiled'])
+
+    def test_compiles_with_application_python(self):
+        python3 = find_executable('python3')
+
+        if not python3:
+            raise unittest.SkipTest('python3 is not installed')
+
+        stats = self.compile_build(python3)
+
+        self.assertEqual(python3, stats['python'])
+        self.assertEqual(2, stats['compiled'])
+        self.assertEqual(['wsgi'], [
+            name.split('.')[0] for name in os.listdir(
+                os.path.join(self.build_dir, 'app', '__pycache__'))
+            if name.startswith('wsgi')
+        ])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.build_dir, 'app', 'wsgi.pyc')))
+        self.assertEqual(0, self.compile_build(python3)['compiled'])
+
+    def test_defaults_to_build_virtualenv(self):
+        venv_python = os.path.join(self.build_dir, 'venv', 'bin', 'python')
+        os.makedirs(os.path.dirname(venv_python))
+        open(venv_python, 'w').close()
+
+        self.assertEqual(venv_python, deploy.app_python(self.build_dir))
+        self.assertEqual(
+            'python3', deploy.app_python(self.build_dir, 'python3'))
+
+    def test_records_missing_interpreter(self):
+        stats = self.compile_build(
+            os.path.join(self.build_dir, 'missing-python'))
+
+        self.assertEqual(0, stats['compiled'])
+        self.assertEqual(3, len(stats['failed']))
+
+    def test_skips_up_to_date_bytecode(self):
+        self.compile_build()
+        stats = self.compile_build()
+
+        self.assertEqual(0, stats['compiled'])
+
+    def test_does_not_write_through_hard_links(self):
+        self.compile_build()
+
+        compiled_path = os.path.join(self.build_dir, 'app', 'wsgi.pyc')
+        previous_build_path = os.path.join(self.build_dir, 'previous.pyc')
+        os.link(compiled_path, previous_build_path)
+
+        wsgi_path = os.path.join(self.build_dir, 'app', 'wsgi.py')
+
+        with open(wsgi_path, 'w') as module:
+            module.write('application = 2\n')
+        os.utime(wsgi_path, (0, 0))
+
+        self.compile_build()
+
+        self.assertFalse(
+            os.path.samefile(compiled_path, previous_build_path))
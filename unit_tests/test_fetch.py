@@ -0,0 +1,175 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+try:
+    import mock
+except ImportError:
+    raise ImportError(
+        "Please ensure both python-mock and python-nose are installed.")
+
+
+from charmhelpers import fetch
+
+
+class EnsurePackagesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(EnsurePackagesTestCase, self).setUp()
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.cache_file_path = os.path.join(self.temp_dir, 'packages.json')
+
+        status_path = os.path.join(self.temp_dir, 'status')
+        open(status_path, 'w').close()
+
+        patcher = mock.patch.object(fetch, 'DPKG_STATUS_PATH', status_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch.dict(
+            fetch._installed_packages, status=None, packages=set())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch.object(fetch, 'filter_installed_packages')
+        self.filter_installed_packages = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch.object(fetch, 'apt_install')
+        self.apt_install = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_installs_missing_packages_together(self):
+        self.filter_installed_packages.return_value = ['make', 'git']
+
+        self.assertEqual(
+            ['make', 'git'],
+            fetch.ensure_packages(['make', 'git', 'curl']))
+        self.apt_install.assert_called_once_with(['make', 'git'], fatal=True)
+
+    def test_installed_packages_are_only_checked_once(self):
+        self.filter_installed_packages.return_value = []
+
+        fetch.ensure_packages(['make'], self.cache_file_path)
+
+        # As if in a new hook
+        fetch._installed_packages.update(status=None, packages=set())
+        self.assertEqual(
+            [], fetch.ensure_packages(['make'], self.cache_file_path))
+
+        self.assertEqual(1, self.filter_installed_packages.call_count)
+        self.assertFalse(self.apt_install.called)
+
+    def test_dpkg_status_change_invalidates_cache(self):
+        self.filter_installed_packages.return_value = []
+        fetch.ensure_packages(['make'], self.cache_file_path)
+
+        with open(fetch.DPKG_STATUS_PATH, 'w') as status:
+            status.write('Package: make\n')
+
+        fetch.ensure_packages(['make'], self.cache_file_path)
+
+        self.assertEqual(2, self.filter_installed_packages.call_count)
+
+
+class WaitForAptLockTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(WaitForAptLockTestCase, self).setUp()
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.lock_path = os.path.join(self.temp_dir, 'lock')
+        open(self.lock_path, 'w').close()
+
+        patcher = mock.patch.object(
+            fetch, 'APT_LOCK_PATHS',
+            (self.lock_path, os.path.join(self.temp_dir, 'missing')))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def hold_lock(self, seconds):
+        """Hold the lock in another process, as dpkg would"""
+        holder = subprocess.Popen([
+            sys.executable, '-c',
+            'import fcntl, sys, time\n'
+            'lock = open(sys.argv[1], "r+")\n'
+            'fcntl.lockf(lock, fcntl.LOCK_EX)\n'
+            'print("locked")\n'
+            'sys.stdout.flush()\n'
+            'time.sleep(float(sys.argv[2]))\n',
+            self.lock_path, str(seconds)
+        ], stdout=subprocess.PIPE)
+        self.addCleanup(holder.wait)
+        holder.stdout.readline()
+
+    def test_free_lock(self):
+        self.assertLess(fetch.wait_for_apt_lock(), 0.5)
+
+    def test_waits_until_lock_is_released(self):
+        self.hold_lock(0.3)
+
+        waited = fetch.wait_for_apt_lock()
+
+        self.assertGreater(waited, 0.2)
+        self.assertLess(waited, 2)
+
+    def test_timeout(self):
+        self.hold_lock(2)
+
+        self.assertRaises(
+            fetch.AptLockError, fetch.wait_for_apt_lock, timeout=0.2)
+
+
+class AptCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(AptCacheTestCase, self).setUp()
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.lists_dir = os.path.join(self.temp_dir, 'lists')
+        os.mkdir(self.lists_dir)
+        status_path = os.path.join(self.temp_dir, 'status')
+        open(status_path, 'w').close()
+
+        patcher = mock.patch.multiple(
+            fetch, DPKG_STATUS_PATH=status_path, APT_LISTS_DIR=self.lists_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch.dict(fetch._apt_cache, state=None, cache=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch.object(fetch, 'apt_pkg')
+        self.apt_pkg = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        make = mock.Mock(current_ver='4.0')
+        git = mock.Mock(current_ver=None)
+        self.apt_pkg.Cache.return_value = {'make': make, 'git': git}
+
+    def test_cache_is_shared(self):
+        self.assertIs(fetch.apt_cache(), fetch.apt_cache())
+        self.assertEqual(1, self.apt_pkg.Cache.call_count)
+
+    def test_lists_change_invalidates_cache(self):
+        fetch.apt_cache()
+        os.utime(self.lists_dir, (0, 0))
+        fetch.apt_cache()
+
+        self.assertEqual(2, self.apt_pkg.Cache.call_count)
+
+    def test_installed_packages(self):
+        self.assertEqual(
+            ['make'], fetch.installed_packages(['make', 'git', 'missing']))
+        self.assertEqual(
+            ['git', 'missing'],
+            fetch.filter_installed_packages(['make', 'git', 'missing']))
+        self.assertEqual(1, self.apt_pkg.Cache.call_count)
@@ -0,0 +1,180 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import mock
+except ImportError:
+    raise ImportError(
+        "Please ensure both python-mock and python-nose are installed.")
+
+
+import helpers
+
+
+charm_dir = os.path.join(os.path.dirname(__file__), os.pardir)
+
+
+class AddAnsibleConfigTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(AddAnsibleConfigTestCase, self).setUp()
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.cache_file_path = os.path.join(self.temp_dir, 'config.json')
+
+        helpers.ansible_config_cache.clear()
+        self.addCleanup(helpers.ansible_config_cache.clear)
+
+    def config_data(self):
+        return {'local_unit': 'wsgi-app/0', 'build_label': 'r1'}
+
+    def test_adds_role_variables(self):
+        config_data = helpers.add_ansible_config(
+            charm_dir, self.config_data())
+
+        self.assertEqual('wsgi-app-0', config_data['app_label'])
+        self.assertEqual(
+            '/srv/wsgi-app-0/code/r1', config_data['current_code_dir'])
+        self.assertEqual(8080, config_data['listen_port'])
+
+    def test_reuses_cache_file_across_processes(self):
+        expected = helpers.add_ansible_config(
+            charm_dir, self.config_data(), self.cache_file_path)
+
+        # As if in a new hook
+        helpers.ansible_config_cache.clear()
+
+        with mock.patch('helpers.update_from_yaml_template') as update:
+            config_data = helpers.add_ansible_config(
+                charm_dir, self.config_data(), self.cache_file_path)
+
+        self.assertFalse(update.called)
+        self.assertEqual(expected, config_data)
+
+    def test_config_change_invalidates_cache(self):
+        helpers.add_ansible_config(
+            charm_dir, self.config_data(), self.cache_file_path)
+
+        config_data = self.config_data()
+        config_data['build_label'] = 'r2'
+        config_data = helpers.add_ansible_config(
+            charm_dir, config_data, self.cache_file_path)
+
+        self.assertEqual(
+            '/srv/wsgi-app-0/code/r2', config_data['current_code_dir'])
+
+
+class UpdateFromYamlTemplateTestCase(unittest.TestCase):
+
+    def update(self, template, data):
+        from jinja2 import DictLoader, Environment
+
+        parser_env = Environment(loader=DictLoader({'main.yml': template}))
+
+        return helpers.update_from_yaml_template(
+            'main.yml', parser_env, data)
+
+    def test_resolves_chains_in_any_order(self):
+        data = self.update(
+            'd: "{{ c }}/d"\n'
+            'c: "{{ b }}/c"\n'
+            'b: "{{ a }}/b"\n'
+            'port: 8080\n',
+            {'a': 'a'}
+        )
+
+        self.assertEqual('a/b/c/d', data['d'])
+        self.assertEqual(8080, data['port'])
+
+    def test_renders_unquoted_values_with_their_types(self):
+        data = self.update(
+            'port: {{ base_port + 1 }}\n'
+            'url: http://localhost:{{ port }}/\n',
+            {'base_port': 8079}
+        )
+
+        self.assertEqual(8080, data['port'])
+        self.assertEqual('http://localhost:8080/', data['url'])
+
+    def test_renders_multi_line_blocks(self):
+        data = self.update(
+            '---\n'
+            'names:\n'
+            '{% for name in source %}\n'
+            '  - {{ name }}\n'
+            '{% endfor %}\n'
+            'count: {{ names | length }}\n',
+            {'source': ['a', 'b']}
+        )
+
+        self.assertEqual(['a', 'b'], data['names'])
+        self.assertEqual(2, data['count'])
+
+    def test_file_values_take_precedence(self):
+        data = self.update(
+            'a: "{{ b }}"\nb: file\n', {'a': 'data', 'b': 'data'})
+
+        self.assertEqual({'a': 'file', 'b': 'file'}, data)
+
+    def test_reports_undefined_variables(self):
+        from jinja2 import UndefinedError
+
+        self.assertRaises(
+            UndefinedError, self.update, 'a: "{{ missing }}"\n', {})
+
+    def test_reports_cycles(self):
+        self.assertRaises(
+            helpers.TemplateVariableCycleError,
+            self.update,
+            'a: "{{ b }}"\nb: "{{ c }}"\nc: "{{ a }}"\n',
+            {}
+        )
+
+
+class EnvStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(EnvStoreTestCase, self).setUp()
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.env_file_path = os.path.join(self.temp_dir, 'env.json')
+        helpers.save_to_json_file(self.env_file_path, {'A': '1', 'B': '2'})
+
+    def test_changes_are_committed_together(self):
+        env = helpers.EnvStore(self.env_file_path)
+        env.set('C', '3')
+        env.unset('A')
+
+        self.assertEqual(
+            {'A': '1', 'B': '2'},
+            helpers.parse_json_file(self.env_file_path))
+        self.assertTrue(env.commit())
+        self.assertEqual(
+            {'B': '2', 'C': '3'},
+            helpers.parse_json_file(self.env_file_path))
+        self.assertEqual(['env.json'], os.listdir(self.temp_dir))
+
+    def test_unchanged_store_is_not_written(self):
+        env = helpers.EnvStore(self.env_file_path)
+        env.set('A', '1')
+
+        with mock.patch('helpers.save_to_json_file') as save:
+            self.assertFalse(env.commit())
+
+        self.assertFalse(save.called)
+
+    def test_file_is_only_read_once(self):
+        env = helpers.EnvStore(self.env_file_path)
+
+        with mock.patch(
+            'helpers.parse_json_file', return_value={}
+        ) as parse:
+            env.get('A')
+            env.set('A', '2')
+            'A' in env
+
+        self.assertEqual(1, parse.call_count)
@@ -0,0 +1,235 @@
+import os
+import unittest
+
+try:
+    import mock
+except ImportError:
+    raise ImportError(
+        "Please ensure both python-mock and python-nose are installed.")
+
+
+from charmhelpers.core import hookenv
+
+
+class CachedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(CachedTestCase, self).setUp()
+
+        patcher = mock.patch.object(hookenv, 'cache', hookenv.FunctionCache())
+        self.cache = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.calls = []
+
+        @hookenv.cached
+        def get(attribute=None, unit=None, rid=None):
+            self.calls.append((attribute, unit, rid))
+            return len(self.calls)
+
+        self.get = get
+
+    def test_normalizes_arguments(self):
+        self.assertEqual(1, self.get('host', 'db/0'))
+        self.assertEqual(1, self.get(attribute='host', unit='db/0'))
+        self.assertEqual(1, self.get('host', unit='db/0', rid=None))
+
+        self.assertEqual(1, len(self.calls))
+        self.assertEqual(2, self.cache.stats()['hits'])
+        self.assertEqual(1, self.cache.stats()['misses'])
+
+    def test_flush_by_unit_and_relation_id(self):
+        self.get('host', 'db/0', 'pgsql:1')
+        self.get('host', 'db/1', 'pgsql:1')
+        self.get('host', 'web/0', 'website:2')
+
+        hookenv.flush('db/0')
+        self.assertEqual(2, len(self.cache))
+
+        hookenv.flush('pgsql:1')
+        self.assertEqual(1, len(self.cache))
+
+        self.get('host', 'web/0', 'website:2')
+        self.assertEqual(3, len(self.calls))
+
+    def test_flush_by_function_name(self):
+        self.get('host')
+
+        hookenv.flush('get')
+
+        self.assertEqual(0, len(self.cache))
+
+    def test_least_recently_used_are_evicted(self):
+        self.cache.max_entries = 2
+
+        self.get('a')
+        self.get('b')
+        self.get('a')
+        self.get('c')
+
+        self.get('a')
+        self.assertEqual(3, len(self.calls))
+        self.get('b')
+        self.assertEqual(4, len(self.calls))
+        self.assertEqual(2, self.cache.stats()['evictions'])
+
+
+class RelationSnapshotTestCase(unittest.TestCase):
+
+    relation_data = {
+        ('pgsql:1', 'wsgi-app/0'): {'private-address': '10.0.0.1'},
+        ('pgsql:1', 'postgresql/0'): {'host': 'db', 'port': '5432'},
+        ('website:2', 'wsgi-app/0'): {},
+        ('website:2', 'haproxy/0'): {'private-address': '10.0.0.2'},
+        ('website:2', 'haproxy/1'): {'private-address': '10.0.0.3'},
+    }
+
+    def setUp(self):
+        super(RelationSnapshotTestCase, self).setUp()
+
+        self.calls = []
+
+        def relation_get(attribute=None, unit=None, rid=None):
+            self.calls.append(('relation-get', rid, unit))
+            return dict(self.relation_data[(rid, unit)])
+
+        def relation_ids(reltype):
+            self.calls.append(('relation-ids', reltype))
+            return {'pgsql': ['pgsql:1'], 'website': ['website:2']}.get(
+                reltype, [])
+
+        def related_units(relid):
+            self.calls.append(('relation-list', relid))
+            return {'pgsql:1': ['postgresql/0'],
+                    'website:2': ['haproxy/0', 'haproxy/1']}[relid]
+
+        for name, replacement in (
+            ('_relation_get', relation_get),
+            ('_relation_ids', relation_ids),
+            ('_related_units', related_units),
+            ('relation_types', lambda: ['pgsql', 'website', 'mongodb']),
+            ('local_unit', lambda: 'wsgi-app/0'),
+            ('relation_snapshot', None),
+            ('cache', hookenv.FunctionCache()),
+        ):
+            patcher = mock.patch.object(hookenv, name, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_relations_fetches_everything_once(self):
+        rels = hookenv.relations()
+
+        self.assertEqual({}, rels['mongodb'])
+        self.assertEqual(
+            {'host': 'db', 'port': '5432'},
+            rels['pgsql']['pgsql:1']['postgresql/0'])
+        self.assertEqual(
+            ['haproxy/0', 'haproxy/1', 'wsgi-app/0'],
+            sorted(rels['website']['website:2']))
+
+        calls = len(self.calls)
+        self.assertEqual(10, calls)
+
+        hookenv.relations()
+        self.assertEqual(
+            'db', hookenv.relation_get('host', 'postgresql/0', 'pgsql:1'))
+        self.assertEqual(['pgsql:1'], hookenv.relation_ids('pgsql'))
+        self.assertEqual(
+            ['haproxy/0', 'haproxy/1'], hookenv.related_units('website:2'))
+        self.assertEqual(calls, len(self.calls))
+
+    @mock.patch('subprocess.check_call')
+    def test_relation_set_updates_snapshot(self, check_call):
+        hookenv.snapshot_relations()
+
+        hookenv.relation_set(
+            relation_id='website:2', hostname='example.com', port=80)
+
+        self.assertEqual(
+            {'hostname': 'example.com', 'port': '80'},
+            hookenv.relations()['website']['website:2']['wsgi-app/0'])
+
+
+class LogBufferTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(LogBufferTestCase, self).setUp()
+
+        import shutil
+        import tempfile
+
+        charm_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, charm_dir)
+        self.file_path = os.path.join(charm_dir, hookenv.LOG_BUFFER_FILE_NAME)
+
+        patcher = mock.patch.dict('os.environ', {'CHARM_DIR': charm_dir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch('subprocess.call')
+        self.call = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.log_buffer = hookenv.LogBuffer(max_messages=4)
+        self.addCleanup(self.log_buffer.flush)
+
+    def test_messages_are_batched_by_level(self):
+        self.log_buffer.add('one')
+        self.log_buffer.add('two')
+        self.log_buffer.add('three', hookenv.ERROR)
+        self.assertFalse(self.call.called)
+
+        self.log_buffer.flush()
+
+        self.assertEqual(2, self.call.call_count)
+        first, second = [c[0][0] for c in self.call.call_args_list]
+        self.assertEqual('juju-log', first[0])
+        self.assertEqual(
+            [' one', ' two'], [line[12:] for line in first[1].split('\n')])
+        self.assertEqual(['juju-log', '-l', 'ERROR'], second[:3])
+
+    def test_full_buffer_is_sent(self):
+        for number in range(4):
+            self.log_buffer.add(str(number))
+
+        self.assertEqual(1, self.call.call_count)
+        self.assertEqual([], self.log_buffer.messages)
+
+    def test_messages_are_kept_in_file(self):
+        self.log_buffer.add('kept', hookenv.WARNING)
+
+        with open(self.file_path) as log_file:
+            self.assertTrue(log_file.read().endswith(' WARNING kept\n'))
+
+    def test_batches_are_limited_in_size(self):
+        log_buffer = hookenv.LogBuffer(max_messages=100, max_bytes=100)
+        self.addCleanup(log_buffer.flush)
+
+        for number in range(10):
+            log_buffer.add('x' * 30)
+        log_buffer.flush()
+
+        self.assertTrue(self.call.call_count > 1)
+        for args in self.call.call_args_list:
+            self.assertTrue(len(args[0][0][-1]) <= 100)
+
+    def test_long_messages_are_split(self):
+        log_buffer = hookenv.LogBuffer(max_messages=100, max_bytes=100)
+        self.addCleanup(log_buffer.flush)
+
+        log_buffer.add(u'\xe9' + 'x' * 1000)
+        log_buffer.flush()
+
+        sent = [args[0][0][-1] for args in self.call.call_args_list]
+        self.assertTrue(all(len(message) <= 100 for message in sent))
+        self.assertEqual(
+            '\xc3\xa9' + 'x' * 1000,
+            ''.join(message[13:] for message in sent))
+
+    def test_send_failures_are_ignored(self):
+        self.call.side_effect = OSError(7, 'Argument list too long')
+
+        self.log_buffer.add('one')
+        self.log_buffer.flush()
+
+        self.assertEqual([], self.log_buffer.messages)
@@ -1,4 +1,8 @@
+import os
+import shutil
+import tempfile
 import unittest
+from collections import OrderedDict
 
 try:
     import mock
@@ -7,6 +11,7 @@ except ImportError:
         "Please ensure both python-mock and python-nose are installed.")
 
 
+import hooks as charm_hooks
 from hooks import hooks
 
 
@@ -46,3 +51,327 @@ class InstallHookTestCase(unittest.TestCase):
                 mock.call('playbook.yml',
                           tags=[hook]),
             ], self.mock_apply_playbook.call_args_list)
+
+
+class SendWsgiSettingsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(SendWsgiSettingsTestCase, self).setUp()
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+
+        self.code_dir = os.path.join(self.temp_dir, 'code')
+        for build_label in ('r1', 'r2'):
+            os.makedirs(os.path.join(self.code_dir, build_label))
+        os.symlink(
+            os.path.join(self.code_dir, 'r1'),
+            os.path.join(self.code_dir, 'current')
+        )
+
+        self.env = OrderedDict([('A', '1'), ('B', '2')])
+
+        for target, value in [
+            ('hooks.wsgi_settings_file_path',
+                os.path.join(self.temp_dir, 'wsgi-settings.json')),
+            ('hooks.ansible_config', mock.Mock(return_value={
+                'code_dir': self.code_dir,
+                'log_dir': self.temp_dir,
+                'app_label': 'wsgi-app-0',
+                'listen_port': 8080,
+                'wsgi_application': 'wsgi.py'
+            })),
+            ('hooks.reconciler', mock.Mock(env=lambda: self.env)),
+            ('hooks.relation_ids', mock.Mock(return_value=['wsgi-file:1'])),
+            ('hooks.relation_set', mock.Mock()),
+            ('hooks.open_port', mock.Mock()),
+            ('hooks.log', mock.Mock())
+        ]:
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def sent_timestamps(self):
+        return [
+            call[1]['timestamp']
+            for call in charm_hooks.relation_set.call_args_list
+        ]
+
+    def test_sends_settings(self):
+        charm_hooks.send_wsgi_settings()
+
+        settings = charm_hooks.relation_set.call_args[1]
+        self.assertEqual('wsgi-file:1', settings['relation_id'])
+        self.assertEqual('A=1 B=2', settings['env_extra'])
+        self.assertEqual(
+            os.path.join(self.code_dir, 'current'), settings['working_dir'])
+
+    def test_unchanged_settings_are_not_sent_again(self):
+        charm_hooks.send_wsgi_settings()
+        charm_hooks.send_wsgi_settings()
+
+        self.assertEqual(1, charm_hooks.relation_set.call_count)
+
+    def test_changed_env_is_sent(self):
+        charm_hooks.send_wsgi_settings()
+        self.env['A'] = '3'
+        charm_hooks.send_wsgi_settings()
+
+        timestamps = self.sent_timestamps()
+        self.assertEqual(2, len(timestamps))
+        self.assertNotEqual(timestamps[0], timestamps[1])
+
+    def test_switched_build_is_sent(self):
+        charm_hooks.send_wsgi_settings()
+
+        current_path = os.path.join(self.code_dir, 'current')
+        os.remove(current_path)
+        os.symlink(os.path.join(self.code_dir, 'r2'), current_path)
+
+        charm_hooks.send_wsgi_settings()
+
+        timestamps = self.sent_timestamps()
+        self.assertEqual(2, len(timestamps))
+        self.assertNotEqual(timestamps[0], timestamps[1])
+
+    def test_rebuilt_archive_is_sent(self):
+        charm_hooks.send_wsgi_settings()
+
+        with mock.patch('hooks.deploy.archive_digest', return_value='abc'):
+            charm_hooks.send_wsgi_settings()
+
+        timestamps = self.sent_timestamps()
+        self.assertEqual(2, len(timestamps))
+        self.assertNotEqual(timestamps[0], timestamps[1])
+
+    def test_timestamp_does_not_depend_on_env_order(self):
+        charm_hooks.send_wsgi_settings()
+        os.remove(charm_hooks.wsgi_settings_file_path)
+        self.env = OrderedDict([('B', '2'), ('A', '1')])
+        charm_hooks.send_wsgi_settings()
+
+        timestamps = self.sent_timestamps()
+        self.assertEqual(2, len(timestamps))
+        self.assertEqual(timestamps[0], timestamps[1])
+
+
+class PlaybookFingerprintPathsTestCase(unittest.TestCase):
+
+    def test_uses_configured_current_symlink(self):
+        config_data = {
+            'code_dir': '/srv/wsgi-app-0/code',
+            # As the role's defaults replace it
+            'current_symlink': 'latest'
+        }
+
+        with mock.patch('hooks.ansible_config', return_value=config_data):
+            with mock.patch('hooks.config', return_value='r1'):
+                paths = charm_hooks.playbook_fingerprint_paths()
+
+        self.assertIn('/srv/wsgi-app-0/code/r1/.deploy/ready.json', paths)
+        self.assertNotIn(
+            '/srv/wsgi-app-0/code/latest/.deploy/ready.json', paths)
+
+
+class ForcePlaybookTestCase(unittest.TestCase):
+
+    def test_runs_config_changed_playbook_with_force(self):
+        forced = []
+
+        def execute(args):
+            forced.append(os.environ.get(
+                charm_hooks.charmhelpers.contrib.ansible
+                .force_playbook_env_var))
+
+        with mock.patch.dict(os.environ), \
+                mock.patch.object(
+                    charm_hooks.ansible_hooks, 'execute',
+                    side_effect=execute) as ansible_execute, \
+                mock.patch('hooks.config_changed') as config_changed, \
+                mock.patch('hooks.log'):
+            hooks.execute(['force-playbook'])
+
+        ansible_execute.assert_called_once_with(['config-changed'])
+        self.assertEqual(['1'], forced)
+        self.assertTrue(config_changed.called)
+
+
+class RoleConditionsTestCase(unittest.TestCase):
+    """
+    The "when" conditions of the role's tasks, evaluated as ansible does
+    """
+
+    def evaluate_when(self, task_name, variables):
+        import yaml
+        from jinja2 import Template
+
+        role_tasks_path = os.path.join(
+            charm_hooks.charm_dir, 'roles', 'wsgi-app', 'tasks', 'main.yml')
+
+        with open(role_tasks_path) as role_tasks_file:
+            tasks = yaml.safe_load(role_tasks_file)
+
+        task = [task for task in tasks if task.get('name') == task_name][0]
+        condition = Template(
+            '{% if ' + task['when'] + ' %}True{% else %}False{% endif %}')
+
+        return condition.render(variables) == 'True'
+
+    def test_missing_latest_is_allowed_while_fresh_unit_stages(self):
+        variables = {
+            'stat_current_symlink': {'stat': {'exists': False}},
+            'prestage_builds': True,
+            'build_label_ready': {'stdout': 'not ready'}
+        }
+        fail_task = 'Fail if the configured current_symlink does not exist.'
+
+        self.assertFalse(self.evaluate_when(fail_task, variables))
+
+        variables['build_label_ready']['stdout'] = 'ready'
+        self.assertTrue(self.evaluate_when(fail_task, variables))
+
+        variables['prestage_builds'] = False
+        variables['build_label_ready'] = {}
+        self.assertTrue(self.evaluate_when(fail_task, variables))
+
+    def test_links_wait_for_async_make_target(self):
+        variables = {
+            'prestage_builds': False,
+            'update_make_target_async': True,
+            'update_make_target': 'update',
+            'build_label_job': {'stdout': 'none'},
+            'current_symlink_job': {'stdout': 'running'}
+        }
+        latest_task = 'Symlink latest tarball of application code'
+        current_task = 'Update the current symlink.'
+
+        self.assertFalse(self.evaluate_when(latest_task, variables))
+        self.assertFalse(self.evaluate_when(current_task, variables))
+
+        variables['build_label_job']['stdout'] = 'succeeded'
+        variables['current_symlink_job']['stdout'] = 'succeeded'
+        self.assertTrue(self.evaluate_when(latest_task, variables))
+        self.assertTrue(self.evaluate_when(current_task, variables))
+
+        variables = {
+            'prestage_builds': False,
+            'update_make_target_async': False,
+            'update_make_target': 'update'
+        }
+        self.assertTrue(self.evaluate_when(latest_task, variables))
+
+
+class TraceRegisteredFunctionsTestCase(unittest.TestCase):
+
+    def test_registrations_use_instrumented_functions(self):
+        traced_install = mock.Mock()
+        traced_update_target = mock.Mock()
+
+        with mock.patch.dict(hooks._hooks), \
+                mock.patch.dict(charm_hooks.reconciler.actions), \
+                mock.patch('hooks.install', traced_install), \
+                mock.patch('hooks.update_target', traced_update_target):
+            charm_hooks.trace_registered_functions()
+
+            self.assertIs(traced_install, hooks._hooks['install'])
+            self.assertIs(
+                traced_update_target,
+                charm_hooks.reconciler.actions['update-target'])
+
+        self.assertIs(charm_hooks.install, hooks._hooks['install'])
+
+
+class UpdateTargetTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(UpdateTargetTestCase, self).setUp()
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+
+        self.code_dir = os.path.join(self.temp_dir, 'r1')
+        os.mkdir(self.code_dir)
+        self.write_makefile('update:\n\techo run >> runs\n')
+
+        self.status_file_path = os.path.join(self.temp_dir, 'make-target.json')
+
+        for target, value in [
+            ('hooks.make_target_file_path', self.status_file_path),
+            ('hooks.ansible_config', mock.Mock(return_value={
+                'build_label': 'r1',
+                'archive_filename': 'r1.tar.gz',
+                'current_code_dir': self.code_dir,
+                'update_make_target': 'update'
+            })),
+            ('hooks.reconciler', mock.Mock(env=lambda: {'A': '1'})),
+            ('hooks.ensure_packages', mock.Mock(return_value=[])),
+            ('hooks.log', mock.Mock())
+        ]:
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def write_makefile(self, content):
+        with open(os.path.join(self.code_dir, 'Makefile'), 'w') as makefile:
+            makefile.write(content)
+
+    def run_count(self):
+        runs_path = os.path.join(self.code_dir, 'runs')
+
+        if not os.path.exists(runs_path):
+            return 0
+
+        with open(runs_path) as runs_file:
+            return len(runs_file.readlines())
+
+    def test_records_run(self):
+        charm_hooks.update_target()
+
+        status = charm_hooks.parse_json_file(self.status_file_path)
+        self.assertEqual(0, status['exit_code'])
+        self.assertTrue(status['duration'] >= 0)
+        self.assertEqual('update', status['target'])
+
+    def test_skips_unchanged_target(self):
+        charm_hooks.update_target()
+        charm_hooks.update_target()
+
+        self.assertEqual(1, self.run_count())
+
+    def test_reruns_after_failure(self):
+        self.write_makefile('update:\n\techo run >> runs\n\tfalse\n')
+
+        for _ in range(2):
+            self.assertRaises(
+                charm_hooks.sh.ErrorReturnCode, charm_hooks.update_target)
+
+        self.assertEqual(2, self.run_count())
+        self.assertEqual(
+            2, charm_hooks.parse_json_file(self.status_file_path)['exit_code'])
+
+    def test_reruns_after_makefile_change(self):
+        charm_hooks.update_target()
+        self.write_makefile('update:\n\techo run again >> runs\n')
+        charm_hooks.update_target()
+
+        self.assertEqual(2, self.run_count())
+
+    def test_fingerprint_includes_env(self):
+        config_data = charm_hooks.ansible_config()
+
+        self.assertNotEqual(
+            charm_hooks.make_target_fingerprint(config_data, {'A': '1'}),
+            charm_hooks.make_target_fingerprint(config_data, {'A': '2'}))
+
+    def test_prestaged_build_gets_make(self):
+        config_data = dict(
+            charm_hooks.ansible_config(), prestage_builds=True)
+
+        with mock.patch('hooks.ansible_config', return_value=config_data), \
+                mock.patch('hooks.queue_stage') as queue_stage:
+            charm_hooks.update_target()
+
+        charm_hooks.ensure_packages.assert_called_once_with(
+            ['make'], charm_hooks.packages_file_path)
+        self.assertTrue(queue_stage.called)
+        self.assertEqual(0, self.run_count())
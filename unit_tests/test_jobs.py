@@ -0,0 +1,154 @@
+import fcntl
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+try:
+    import mock
+except ImportError:
+    raise ImportError(
+        "Please ensure both python-mock and python-nose are installed.")
+
+
+import jobs
+from helpers import parse_json_file, save_to_json_file
+
+
+class JobsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(JobsTestCase, self).setUp()
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.jobs_dir = os.path.join(self.temp_dir, 'jobs')
+        self.status_file_path = os.path.join(self.temp_dir, 'status.json')
+
+    def submit(self, command, fingerprint='abc'):
+        with mock.patch('jobs.start_runner'):
+            jobs.submit(
+                self.jobs_dir, 'r1', command, self.temp_dir,
+                env={'GREETING': 'hello'},
+                fingerprint=fingerprint,
+                status_file_path=self.status_file_path
+            )
+
+    def run_jobs(self):
+        jobs.run(jobs.job_dir(self.jobs_dir, 'r1'))
+
+    def output(self):
+        with open(os.path.join(self.jobs_dir, 'r1', 'output.log')) as log:
+            return log.read()
+
+    def test_runs_job_and_logs_output(self):
+        self.submit([sys.executable, '-c', (
+            'import os; print(os.environ["GREETING"])'
+        )])
+
+        self.assertEqual('queued', jobs.job_state(self.jobs_dir, 'r1'))
+        self.assertEqual('abc', jobs.pending_fingerprint(self.jobs_dir, 'r1'))
+
+        self.run_jobs()
+
+        self.assertEqual('succeeded', jobs.job_state(self.jobs_dir, 'r1'))
+        self.assertIsNone(jobs.pending_fingerprint(self.jobs_dir, 'r1'))
+        self.assertIn('hello\n', self.output())
+
+        status = parse_json_file(self.status_file_path)
+        self.assertEqual(0, status['exit_code'])
+        self.assertEqual('abc', status['fingerprint'])
+        self.assertEqual('r1', status['build_label'])
+
+    def test_only_latest_queued_job_runs(self):
+        self.submit([sys.executable, '-c', 'print("first")'], 'first')
+        self.submit([sys.executable, '-c', 'print("second")'], 'second')
+
+        self.run_jobs()
+
+        self.assertNotIn('first\n', self.output())
+        self.assertIn('second\n', self.output())
+
+    def test_failed_job(self):
+        self.submit([sys.executable, '-c', 'import sys; sys.exit(3)'])
+        self.run_jobs()
+
+        self.assertEqual('failed', jobs.job_state(self.jobs_dir, 'r1'))
+        self.assertEqual(
+            3, parse_json_file(self.status_file_path)['exit_code'])
+        self.assertRaises(
+            jobs.JobNotFinishedError,
+            jobs.check_finished, self.jobs_dir, 'r1'
+        )
+
+    def test_builds_without_jobs_are_finished(self):
+        self.assertIsNone(jobs.job_state(self.jobs_dir, 'r2'))
+        jobs.check_finished(self.jobs_dir, 'r2')
+
+    def test_build_label_for_symlinked_build(self):
+        os.mkdir(os.path.join(self.temp_dir, 'r2'))
+        link_path = os.path.join(self.temp_dir, 'latest')
+        os.symlink('r2', link_path)
+
+        self.assertEqual('r2', jobs.build_label_for(link_path))
+        self.assertEqual('r2', jobs.build_label_for('r2'))
+
+    def test_runner_outlives_submission(self):
+        marker_path = os.path.join(self.temp_dir, 'marker')
+
+        jobs.submit(
+            self.jobs_dir, 'r1',
+            [sys.executable, '-c', 'open("marker", "w")'],
+            self.temp_dir
+        )
+
+        for _ in range(100):
+            if jobs.job_state(self.jobs_dir, 'r1') == 'succeeded':
+                break
+            time.sleep(0.1)
+
+        self.assertTrue(os.path.exists(marker_path))
+
+    def test_low_priority_command(self):
+        with mock.patch('jobs.find_executable', return_value=None):
+            self.assertEqual(
+                ['nice', '-n', '19', 'make'],
+                jobs.low_priority_command(['make']))
+
+    def test_job_left_running_is_interrupted(self):
+        self.submit([sys.executable, '-c', 'pass'])
+        build_job_dir = jobs.job_dir(self.jobs_dir, 'r1')
+
+        # As if the runner died after starting the job
+        os.rename(
+            os.path.join(build_job_dir, 'queued.json'),
+            os.path.join(build_job_dir, 'running.json'))
+        save_to_json_file(
+            os.path.join(build_job_dir, 'state.json'), {'state': 'running'})
+        open(os.path.join(build_job_dir, 'lock'), 'a').close()
+
+        self.assertEqual('interrupted', jobs.job_state(self.jobs_dir, 'r1'))
+        self.assertIsNone(jobs.pending_fingerprint(self.jobs_dir, 'r1'))
+        self.assertRaises(
+            jobs.JobNotFinishedError,
+            jobs.check_finished, self.jobs_dir, 'r1'
+        )
+
+        # While a runner holds the lock, it's still running
+        with open(os.path.join(build_job_dir, 'lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            self.assertEqual('running', jobs.job_state(self.jobs_dir, 'r1'))
+            self.assertEqual(
+                'abc', jobs.pending_fingerprint(self.jobs_dir, 'r1'))
+
+    def test_resume_starts_runner_for_queued_job(self):
+        self.submit([sys.executable, '-c', 'pass'])
+
+        with mock.patch('jobs.start_runner') as start_runner:
+            jobs.resume(self.jobs_dir, 'r1')
+
+        start_runner.assert_called_once_with(
+            jobs.job_dir(self.jobs_dir, 'r1'))
@@ -0,0 +1,84 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import mock
+except ImportError:
+    raise ImportError(
+        "Please ensure both python-mock and python-nose are installed.")
+
+
+import profiler
+
+
+class ProfilerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(ProfilerTestCase, self).setUp()
+
+        self.trace_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.trace_dir)
+
+        self.profile = profiler.Profiler('config-changed', self.trace_dir)
+
+    def test_nested_spans(self):
+        inner = self.profile.traced('inner', lambda: 'result')
+        outer = self.profile.traced('outer', lambda: [inner(), inner()])
+
+        self.assertEqual(['result', 'result'], outer())
+
+        outer_span, = self.profile.root['children']
+        self.assertEqual('outer', outer_span['name'])
+        self.assertEqual(
+            ['inner', 'inner'],
+            [span['name'] for span in outer_span['children']])
+        self.assertTrue(outer_span['duration'] >= 0)
+
+    def test_instrument_object(self):
+        class Target(object):
+            def apply(self):
+                return 3
+
+        target = Target()
+
+        self.profile.instrument(target, names=['apply'], prefix='reconciler')
+
+        self.assertEqual(3, target.apply())
+        self.assertEqual(
+            'reconciler.apply', self.profile.root['children'][0]['name'])
+
+    def test_subprocess_spans_include_ansible_tasks(self):
+        trace_path = os.path.join(self.trace_dir, '.ansible.json')
+        with open(trace_path, 'w') as trace_file:
+            json.dump(
+                [{'name': 'Setup users.', 'start': 0, 'duration': 1.5}],
+                trace_file)
+
+        call = self.profile.traced_subprocess(lambda command: 0)
+
+        with mock.patch.dict(
+            'os.environ', {profiler.ansible_trace_env_var: trace_path}
+        ):
+            call(['ansible-playbook', 'playbook.yml'])
+
+        span, = self.profile.root['children']
+        self.assertEqual(
+            'subprocess: ansible-playbook playbook.yml', span['name'])
+        self.assertEqual(
+            'ansible task: Setup users.', span['children'][0]['name'])
+        self.assertFalse(os.path.exists(trace_path))
+
+    def test_summary_of_saved_traces(self):
+        for duration in (1, 3):
+            profile = profiler.Profiler('config-changed', self.trace_dir)
+            profile.root['children'].append({
+                'name': 'sh: make', 'start': 0, 'duration': duration,
+                'children': []})
+            profile.save()
+
+        spans = profiler.summarise(self.trace_dir, hook_count=2)
+
+        self.assertEqual(('sh: make', 2, 4, 3), spans[0])
@@ -0,0 +1,79 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import mock
+except ImportError:
+    raise ImportError(
+        "Please ensure both python-mock and python-nose are installed.")
+
+
+from reconcile import Reconciler
+
+
+class ReconcilerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(ReconcilerTestCase, self).setUp()
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.env_file_path = os.path.join(self.temp_dir, 'env.json')
+
+        self.reconciler = Reconciler(self.env_file_path)
+        self.update_target = mock.Mock()
+        self.send_settings = mock.Mock()
+        self.reconciler.register('update-target', self.update_target)
+        self.reconciler.register('wsgi-settings', self.send_settings)
+
+    def test_requested_actions_run_once(self):
+        for _ in range(3):
+            self.reconciler.request('wsgi-settings')
+            self.reconciler.request('update-target')
+
+        self.reconciler.apply()
+
+        self.update_target.assert_called_once_with()
+        self.send_settings.assert_called_once_with()
+
+    def test_actions_run_in_registration_order(self):
+        calls = []
+        self.update_target.side_effect = lambda: calls.append('target')
+        self.send_settings.side_effect = lambda: calls.append('settings')
+
+        self.reconciler.request('wsgi-settings')
+        self.reconciler.request('update-target')
+        self.reconciler.apply()
+
+        self.assertEqual(['target', 'settings'], calls)
+
+    def test_unknown_action(self):
+        self.assertRaises(KeyError, self.reconciler.request, 'nope')
+
+    def test_env_is_saved_once_before_actions(self):
+        self.update_target.side_effect = lambda: self.assertEqual(
+            {'A': '1'}, json.load(open(self.env_file_path)))
+
+        self.reconciler.set_env('A', '1')
+        self.reconciler.set_env('B', '2')
+        self.reconciler.unset_env('B')
+        self.reconciler.request('update-target')
+        self.reconciler.apply()
+
+        self.assertEqual(1, self.update_target.call_count)
+
+    def test_apply_resets_collected_changes(self):
+        self.reconciler.request('update-target')
+        self.reconciler.apply()
+        self.reconciler.apply()
+
+        self.assertEqual(1, self.update_target.call_count)
+
+    def test_set_env_reports_changes(self):
+        self.assertTrue(self.reconciler.set_env('A', '1'))
+        self.reconciler.apply()
+
+        self.assertFalse(self.reconciler.set_env('A', '1'))